@@ -1,20 +1,47 @@
+import asyncio
+import json
 import logging
 import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI, File, HTTPException, Request, UploadFile
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
-from rag_system import RAGSystem
+from collection_manager import CollectionManager
+from llm_backend import LLMError
+import prefork
+from metrics import ERRORS, REGISTRY
+from startup import StartupTracker
+from worker_pool import BoundedExecutor, JobRegistry, ServerBusyError
 
 # ロギングの設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(debug=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # ポートはすぐに開き、RAGSystemの読み込みはバックグラウンドで行う（状態は /readyz で確認）
+    startup.run_in_background(load_rag)
+    if SNAPSHOT_DIR:
+        threading.Thread(target=watch_snapshots, name="snapshots", daemon=True).start()
+    if COLLECTION_IDLE_SECONDS:
+        threading.Thread(target=unload_idle_collections, name="collections", daemon=True).start()
+    yield
+    # 形態素解析のプロセスプールを終了する（全コレクションで共有）
+    if rag is not None:
+        rag.tokenizer.close()
+
+
+app = FastAPI(debug=True, lifespan=lifespan)
 
 # CORSの設定
 app.add_middleware(
@@ -25,20 +52,219 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 検索（埋め込み・形態素解析）と索引更新はイベントループの外のスレッドプールで実行する
+# 実行中と待機中のタスクが上限を超えた場合は503を返す
+QUERY_WORKERS = os.cpu_count() or 1
+QUERY_QUEUE_LIMIT = 32
+INDEX_QUEUE_LIMIT = 2
+# /query/batch で1度に受け付ける質問数と、1つのバッチから同時に送る生成リクエスト数
+MAX_BATCH_SIZE = 256
+# アップロードされたファイルを読み書きする単位（バイト）。ファイル全体をメモリに載せない
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+BATCH_CONCURRENCY = 4
+# 生成バックエンド（LLM_BACKEND=fake でGPUなしの負荷試験）と、同時に生成するリクエスト数
+# （OllamaのOLLAMA_NUM_PARALLELと同じ値にする）・1リクエストの期限（秒）
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama")
+LLM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "300"))
+# ワーカープロセス数。2以上では索引をスナップショット（メモリマップ）で共有し、
+# 他のワーカーが公開した新しい版を SNAPSHOT_POLL_SECONDS 秒ごとに確認して切り替える
+WORKERS = int(os.environ.get("WORKERS", "1"))
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR") or ("knowledge_base_snapshots" if WORKERS > 1 else None)
+SNAPSHOT_POLL_SECONDS = float(os.environ.get("SNAPSHOT_POLL_SECONDS", "2"))
+# 名前つきのコレクション（COLLECTIONS_DIR/<名前>/ に文書・索引を置く）と、同時にメモリに置くコレクション数の上限・
+# 使われていないコレクションを外すまでの秒数（未設定なら上限を超えたときだけ外す）
+COLLECTIONS_DIR = os.environ.get("COLLECTIONS_DIR", "collections")
+MAX_LOADED_COLLECTIONS = int(os.environ.get("MAX_LOADED_COLLECTIONS", "4"))
+COLLECTION_IDLE_SECONDS = float(os.environ.get("COLLECTION_IDLE_SECONDS", "0")) or None
+query_executor = BoundedExecutor(max_workers=QUERY_WORKERS, max_queue=QUERY_QUEUE_LIMIT, name="query")
+index_executor = BoundedExecutor(max_workers=1, max_queue=INDEX_QUEUE_LIMIT, name="index")
+# 複数ワーカーではジョブの状態をファイルで共有し、どのワーカーからも /jobs/{job_id} で参照できるようにする
+jobs = JobRegistry(directory=os.path.join(SNAPSHOT_DIR, "jobs") if SNAPSHOT_DIR else None)
+
+
+def server_busy() -> HTTPException:
+    ERRORS.inc(type="busy")
+    return HTTPException(status_code=503, detail="Server is busy, please retry later", headers={"Retry-After": "1"})
+
+
 # テンプレートディレクトリを指定
 templates = Jinja2Templates(directory="templates")
 
-# RAGシステムのインスタンスを作成
-try:
-    rag = RAGSystem(model_name="gemma3:27b")
-    logger.info("RAGSystem initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize RAGSystem: {e}")
-    rag = None
+# 既定のコレクションのRAGシステム（読み込みが終わるまではNone）
+rag = None
+startup = StartupTracker(["import", "knowledge_base", "embedding_model"])
+
+
+def create_rag(**options):
+    """コレクションのRAGSystemを作成（ディレクトリと共有する部品は options で受け取る）"""
+    from rag_system import RAGSystem
+    return RAGSystem(model_name="gemma3:27b", llm_backend=LLM_BACKEND,
+                     llm_options={"max_parallel": LLM_PARALLEL, "timeout": LLM_TIMEOUT}, **options)
+
+
+# 既定のコレクションは従来どおり knowledge_base/ を使い、起動時に読み込んで常にメモリに置く
+collections = CollectionManager(create_rag, directory=COLLECTIONS_DIR,
+                                default_options={"data_dir": "knowledge_base", "snapshot_dir": SNAPSHOT_DIR},
+                                max_loaded=MAX_LOADED_COLLECTIONS, idle_seconds=COLLECTION_IDLE_SECONDS,
+                                snapshots=bool(SNAPSHOT_DIR))
+
+
+def load_rag():
+    """RAGSystemを読み込む（索引は永続化インデックスがあればそこから復元し、埋め込みモデルを準備しておく）"""
+    global rag
+    try:
+        with startup.stage("import"):
+            # sentence_transformers などの読み込みを含む（コレクションの作成時は読み込み済みのモジュールを使う）
+            import rag_system  # noqa: F401
+        with startup.stage("knowledge_base"):
+            # 返さずに借りたままにすることで、既定のコレクションはメモリから外れない
+            system = collections.acquire(None)
+        with startup.stage("embedding_model"):
+            system.embedder.warm_up()
+            if system.reranker:
+                system.reranker.warm_up()
+            rag = system
+        logger.info("RAGSystem initialized successfully")
+    except Exception as e:
+        logger.error(f"Failed to initialize RAGSystem (will retry): {e}")
+        raise
+
+
+def watch_snapshots():
+    """他のワーカーがアップロードを反映して公開したスナップショットに切り替える"""
+    while True:
+        time.sleep(SNAPSHOT_POLL_SECONDS)
+        for name, system in collections.loaded():
+            try:
+                if system.refresh_snapshot():
+                    logger.info(f"Switched collection {name} to snapshot {system.snapshot_version}")
+            except Exception as e:
+                logger.error(f"Failed to load snapshot of collection {name}: {e}")
+
+
+def unload_idle_collections():
+    """COLLECTION_IDLE_SECONDS の間使われていないコレクションをメモリから外す"""
+    while True:
+        time.sleep(max(1.0, COLLECTION_IDLE_SECONDS / 4))
+        collections.evict()
+
+
+def preload():
+    """fork前の親プロセスでモデルを読み込み、全ワーカーで重みを共有する"""
+    from rag_system import preload_models
+    preload_models()
+
+
+def init_worker(index: int):
+    """fork後の各ワーカーで、推論に使うCPUスレッドをワーカー間で分け合う"""
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(max(1, (os.cpu_count() or 1) // WORKERS))
+
+
+def require_rag():
+    """読み込み中は503を返す"""
+    if rag is None:
+        raise HTTPException(status_code=503, detail="RAGSystem is starting up, please retry later", headers={"Retry-After": "5"})
+    return rag
+
+
+def collection_name(name: str | None) -> str:
+    """コレクション名を確かめる（使えない名前は400）"""
+    try:
+        return collections.validate(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def require_collection(name: str | None) -> str:
+    """既存のコレクションの名前を返す（読み込み中は503、存在しなければ404）"""
+    require_rag()
+    name = collection_name(name)
+    if not collections.exists(name):
+        raise HTTPException(status_code=404, detail=f"Collection not found: {name}")
+    return name
+
+
+async def acquire_collection(name: str):
+    """コレクションのRAGSystemを借りる（読み込まれていなければイベントループの外で読み込む。使い終わったら release する）"""
+    try:
+        return await asyncio.to_thread(collections.acquire, name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Collection not found: {name}")
+
+
+def cache_counts(field: str) -> dict:
+    """各キャッシュのヒット数またはミス数（/metrics 用）"""
+    if not rag:
+        return {}
+    stats = rag.cache_stats()
+    answer = stats["answer"]
+    counts = {("answer",): answer["exact_hits"] + answer["semantic_hits"] if field == "hits" else answer["misses"]}
+    for name in ("query_embedding", "query_tokens", "retrieval"):
+        if stats[name] is not None:
+            counts[(name,)] = stats[name][field]
+    return counts
+
+
+# /metrics で公開するコーパスの大きさ・キャッシュ・処理待ちの件数（出力のたびに読み取る）
+REGISTRY.gauge("rag_corpus_documents", "Documents in the knowledge base", function=lambda: rag.document_count if rag else None)
+REGISTRY.gauge("rag_corpus_chunks", "Chunks in the search index",
+               function=lambda: (len(rag.retriever.chunks) if rag.retriever else 0) if rag else None)
+REGISTRY.gauge("rag_corpus_version", "Version of the knowledge base (incremented on every update)",
+               function=lambda: rag.corpus_version if rag else None)
+REGISTRY.counter("rag_cache_hits_total", "Cache hits by cache", ("cache",), function=lambda: cache_counts("hits"))
+REGISTRY.counter("rag_cache_misses_total", "Cache misses by cache", ("cache",), function=lambda: cache_counts("misses"))
+REGISTRY.gauge("rag_collections_loaded", "Knowledge-base collections held in memory",
+               function=lambda: len(collections.loaded()))
+REGISTRY.gauge("rag_executor_pending", "Tasks running or waiting in the worker pools", ("pool",),
+               function=lambda: {("query",): query_executor.pending, ("index",): index_executor.pending})
+
+
+class Filters(BaseModel):
+    """検索対象の絞り込み（値のリストはいずれかに一致、複数の項目はすべてに一致）"""
+    model_config = ConfigDict(extra="forbid")
+
+    chapter: str | list[str] | None = None
+    section: str | list[str] | None = None
+    # 文書を読み込んだナレッジベースのファイル名
+    source: str | list[str] | None = None
 
 
 class Question(BaseModel):
     text: str
+    # 検索するコレクション。省略時は既定のコレクション（knowledge_base/）
+    collection: str | None = None
+    # 再ランキングにかけてよい時間（ミリ秒）。省略時はRAGSystemの設定に従う
+    rerank_budget_ms: float | None = None
+    # 段階ごとの処理時間（ミリ秒）をレスポンスに含める（遅いリクエストの調査用）
+    timings: bool = False
+    filters: Filters | None = None
+
+
+class Questions(BaseModel):
+    texts: list[str]
+    collection: str | None = None
+    rerank_budget_ms: float | None = None
+    timings: bool = False
+    filters: Filters | None = None
+
+
+def filters_of(request: Question | Questions) -> dict | None:
+    return request.filters.model_dump(exclude_none=True) if request.filters else None
+
+
+@app.get("/healthz")
+async def healthz():
+    """プロセスが応答できるか（読み込み中も200を返す）と起動処理の進み具合"""
+    return {"status": "ok", **startup.report()}
+
+
+@app.get("/readyz")
+async def readyz():
+    """質問を受け付けられるか（すべての起動段階が終わるまでは503）"""
+    report = startup.report()
+    return JSONResponse(report, status_code=200 if report["ready"] and rag is not None else 503)
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -46,43 +272,174 @@ async def root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+def add_document_job(temp_path: str, filename: str, collection: str) -> dict:
+    """索引更新ジョブ：一時ファイルをコレクションのナレッジベースに移して文書を追加し、読み込み結果を返す"""
     try:
-        if not rag:
-            raise HTTPException(status_code=500, detail="RAGSystem not initialized")
+        system = collections.acquire(collection, create=True)
+        try:
+            report = system.add_document(temp_path, filename=filename, move=True)
+        finally:
+            collections.release(collection)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    if report["invalid_lines"]:
+        logger.warning(f"Skipped {report['invalid_lines']} invalid lines in {filename}: {report['errors'][:5]}")
+    return {**report, "collection": collection}
 
-        # 一時ファイルとして保存
-        temp_path = f"temp_{file.filename}"
-        with open(temp_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
 
-        # RAGシステムに追加
-        rag.add_document(temp_path)
+@app.post("/upload", status_code=202)
+async def upload_file(file: UploadFile = File(...), collection: str | None = Form(None)):
+    """ファイルを受け付け、索引の更新をバックグラウンドで行う（状態は /jobs/{job_id} で確認）
 
-        # 一時ファイルを削除
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    collection を指定するとそのコレクションに追加する（存在しなければ作成する）。
+    """
+    temp_path = None
+    try:
+        require_rag()
+        collection = collection_name(collection)
+        if index_executor.is_full:
+            raise server_busy()
+
+        # ナレッジベースのディレクトリに隠しファイルとして少しずつ書き出す（ジョブが名前を変えて取り込む）
+        data_dir = collections.options(collection)["data_dir"]
+        os.makedirs(data_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".upload_", suffix=".part", dir=data_dir)
+        with os.fdopen(fd, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                buffer.write(chunk)
+        os.chmod(temp_path, 0o644)
 
-        return {"message": "ファイルが正常にアップロードされました"}
+        # RAGシステムへの追加をジョブとして投入（ナレッジベースには元のファイル名で保存）
+        job_id = jobs.submit(index_executor, add_document_job, temp_path, file.filename, collection,
+                             description=f"upload {file.filename} to {collection}")
+        temp_path = None  # 以降の削除はジョブが行う
 
+        return {"message": "ファイルを受け付けました。索引を更新しています", "job_id": job_id}
+
+    except HTTPException:
+        raise
+    except ServerBusyError:
+        raise server_busy()
     except Exception as e:
         logger.error(f"Error in upload_file: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/collections")
+async def list_collections():
+    """コレクションの一覧と、それぞれがメモリに読み込まれているか"""
+    require_rag()
+    return {"default": collections.default, "max_loaded": collections.max_loaded, "collections": collections.report()}
+
+
+@app.get("/cache/stats")
+async def cache_stats(collection: str | None = None):
+    """回答・クエリの埋め込み・検索結果などのキャッシュの件数とヒット数（読み込み済みのコレクションのみ）"""
+    name = require_collection(collection)
+    system = dict(collections.loaded()).get(name)
+    if system is None:
+        raise HTTPException(status_code=404, detail=f"Collection is not loaded: {name}")
+    return system.cache_stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """段階ごとの処理時間・質問とエラーの件数・コーパスの大きさ（Prometheusのテキスト形式）"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/query")
 async def query(question: Question):
     try:
-        if not rag:
-            raise HTTPException(status_code=500, detail="RAGSystem not initialized")
-
-        response = rag.query(question.text)
+        collection = require_collection(question.collection)
+        system = await acquire_collection(collection)
+        try:
+            response = await system.query_async(question.text, run_blocking=query_executor.run,
+                                                rerank_budget_ms=question.rerank_budget_ms,
+                                                include_timings=question.timings, filters=filters_of(question))
+        finally:
+            collections.release(collection)
         return response  # レスポンス全体をそのまま返す
+    except HTTPException:
+        raise
+    except ServerBusyError:
+        raise server_busy()
+    except LLMError as e:
+        # 生成の期限切れは504、Ollamaに接続できない・生成に失敗した場合は502
+        logger.error(f"Error in query: {e}")
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         logger.error(f"Error in query: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.post("/query/stream")
+async def query_stream(question: Question):
+    """コンテキストを先に返し、回答をServer-Sent Eventsで逐次返す"""
+    collection = require_collection(question.collection)
+    if query_executor.is_full:
+        raise server_busy()
+
+    async def event_stream():
+        # 応答を返し終えるまでコレクションを借りておく
+        system = await acquire_collection(collection)
+        try:
+            async for event in system.query_stream(question.text, run_blocking=query_executor.run,
+                                                   rerank_budget_ms=question.rerank_budget_ms,
+                                                   include_timings=question.timings, filters=filters_of(question)):
+                if event["event"] == "error":
+                    logger.error(f"Error in query_stream: {event['message']}")
+                yield f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            collections.release(collection)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/query/batch")
+async def query_batch(questions: Questions):
+    """複数の質問に回答し、生成が終わった順にNDJSON（1行に1件のJSON）で返す"""
+    collection = require_collection(questions.collection)
+    if len(questions.texts) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Too many questions (max {MAX_BATCH_SIZE})")
+    if query_executor.is_full:
+        raise server_busy()
+
+    async def lines():
+        system = await acquire_collection(collection)
+        try:
+            async for result in system.query_batch(questions.texts, concurrency=BATCH_CONCURRENCY,
+                                                   run_blocking=query_executor.run,
+                                                   rerank_budget_ms=questions.rerank_budget_ms,
+                                                   include_timings=questions.timings, filters=filters_of(questions)):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            collections.release(collection)
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=3000)
+    if WORKERS > 1:
+        prefork.serve(app, host="127.0.0.1", port=3000, workers=WORKERS, preload=preload, on_fork=init_worker)
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=3000)
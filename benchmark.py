@@ -0,0 +1,556 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from context_builder import SENTENCE_END
+from fusion import FUSIONS, create_fusion
+from index_store import IndexStore
+from metrics import Timings
+from vector_index import FlatIndex, IVFIndex, create_vector_index, top_k_indices
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# compare で比較する指標（値が小さいほど良いもの・大きいほど良いもの）
+LOWER_IS_BETTER = ('_ms', '_s', '_mb')
+HIGHER_IS_BETTER = ('recall', 'qps', 'same_ranking_as_legacy')
+
+
+def environment() -> dict:
+    """結果を比較するための実行環境（コミット・バージョン・CPU数）"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def write_results(path: str | None, args, rows: list[dict]):
+    """結果を実行環境・オプションとともにJSONで書き出す（compare で別のコミットの結果と比較できる）"""
+    if not path:
+        return
+    options = {key: value for key, value in vars(args).items() if key not in ('func', 'output')}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'benchmark': args.command, 'environment': environment(), 'options': options, 'rows': rows},
+                  f, ensure_ascii=False, indent=2)
+
+
+def percentiles(latencies_ms, prefix: str = '') -> dict:
+    """p50 / p95 / p99（ミリ秒）"""
+    latencies_ms = np.asarray(latencies_ms)
+    if not len(latencies_ms):
+        return {}
+    return {f"{prefix}p{q}_ms": float(np.percentile(latencies_ms, q)) for q in (50, 95, 99)}
+
+
+def rss_mb() -> float:
+    """現在の常駐メモリ（MB）。/proc がない環境ではそれまでのピーク値"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """プロセス開始からの常駐メモリのピーク（MB）"""
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def synthetic_embeddings(n: int, dim: int, n_clusters: int = 256, seed: int = 0) -> np.ndarray:
+    """クラスタ構造を持つ正規化済みの疑似埋め込みを生成"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    embeddings = centers[rng.integers(0, n_clusters, n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+
+def load_embeddings(index_dir: str, model_name: str) -> np.ndarray:
+    """永続化インデックスから埋め込みを読み込む（保存形式はmanifestに従い、int8は刻み幅を掛けて戻す）"""
+    from rag_system import Embedder
+
+    # インデックスは埋め込みの設定の識別子（モデル名・接頭辞・正規化）で保存されている
+    signature = Embedder(model_name).signature
+    try:
+        with open(os.path.join(IndexStore(index_dir, signature).path, 'manifest.json'), 'r', encoding='utf-8') as f:
+            dtype = json.load(f).get('dtype', 'float32')
+    except (OSError, ValueError):
+        dtype = 'float32'
+    cached = IndexStore(index_dir, signature, dtype=dtype).load()
+    if cached is None:
+        raise SystemExit(f"No index for {signature} found in {index_dir}")
+    embeddings = np.asarray(cached['embeddings'])
+    if embeddings.dtype == np.int8:
+        return embeddings.astype(np.float32) * np.float32(cached['scale'])
+    return embeddings
+
+
+def make_queries(embeddings: np.ndarray, n_queries: int, seed: int = 1) -> np.ndarray:
+    """コーパス中のベクトルにノイズを加えてクエリとする"""
+    rng = np.random.default_rng(seed)
+    queries = embeddings[rng.integers(0, len(embeddings), n_queries)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def measure(index, queries: np.ndarray, k: int) -> tuple[list[np.ndarray], np.ndarray]:
+    """各クエリの上位k件と検索時間（ミリ秒）を計測"""
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        ids, _ = index.search(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids)
+    return results, np.array(latencies)
+
+
+def bench_vector(args):
+    """厳密検索（flat）に対するIVFの再現率と検索時間を比較"""
+    if args.index_dir:
+        embeddings = load_embeddings(args.index_dir, args.model)
+    else:
+        embeddings = synthetic_embeddings(args.n, args.dim, seed=args.seed)
+    queries = make_queries(embeddings, args.queries, seed=args.seed + 1)
+    k = min(args.k, len(embeddings))
+
+    flat = FlatIndex()
+    flat.build(embeddings)
+    exact, flat_latencies = measure(flat, queries, k)
+    rows = [{
+        'index': 'flat', 'n': len(embeddings), 'dim': embeddings.shape[1], 'k': k,
+        'build_s': 0.0, 'recall': 1.0, **percentiles(flat_latencies),
+    }]
+
+    ivf = IVFIndex(nlist=args.nlist, seed=args.seed)
+    start = time.perf_counter()
+    ivf.build(embeddings)
+    build_s = time.perf_counter() - start
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        approx, latencies = measure(ivf, queries, k)
+        recall = np.mean([len(np.intersect1d(a, e)) / k for a, e in zip(approx, exact)])
+        rows.append({
+            'index': f"ivf(nlist={len(ivf.lists)},nprobe={nprobe})", 'n': len(embeddings), 'dim': embeddings.shape[1], 'k': k,
+            'build_s': build_s, 'recall': float(recall), **percentiles(latencies),
+        })
+
+    print(f"{'index':<32} {'recall@' + str(k):>10} {'p50(ms)':>10} {'p95(ms)':>10} {'build(s)':>10}")
+    for row in rows:
+        print(f"{row['index']:<32} {row['recall']:>10.4f} {row['p50_ms']:>10.3f} {row['p95_ms']:>10.3f} {row['build_s']:>10.2f}")
+    write_results(args.output, args, rows)
+
+
+def legacy_linear_fusion(vector_ids, vector_scores, bm25_ids, bm25_scores, alpha):
+    """ベクトル化前のスコア統合（Pythonのmax/anyによる最大値正規化）。比較の基準"""
+    candidate_ids = np.union1d(vector_ids, bm25_ids)
+    candidate_vector_scores = np.zeros(len(candidate_ids))
+    candidate_vector_scores[np.searchsorted(candidate_ids, vector_ids)] = vector_scores
+    candidate_bm25_scores = np.zeros(len(candidate_ids))
+    candidate_bm25_scores[np.searchsorted(candidate_ids, bm25_ids)] = bm25_scores
+    max_vector_score = max(candidate_vector_scores) if any(candidate_vector_scores) else 1.0
+    normalized_vector_scores = candidate_vector_scores / max_vector_score if max_vector_score > 0 else candidate_vector_scores
+    max_bm25_score = max(candidate_bm25_scores) if any(candidate_bm25_scores) else 1.0
+    normalized_bm25_scores = candidate_bm25_scores / max_bm25_score if max_bm25_score > 0 else candidate_bm25_scores
+    combined_scores = alpha * normalized_vector_scores + (1 - alpha) * normalized_bm25_scores
+    return candidate_ids, combined_scores, normalized_vector_scores, normalized_bm25_scores
+
+
+def synthetic_candidates(n: int, n_bm25: int, n_queries: int, seed: int = 0) -> list[tuple]:
+    """ベクトル検索（全チャンク）とBM25（一部のチャンク）の疑似スコアを生成"""
+    rng = np.random.default_rng(seed)
+    candidates = []
+    for _ in range(n_queries):
+        vector_scores = rng.uniform(-0.2, 1.0, n).astype(np.float32)
+        bm25_ids = np.sort(rng.choice(n, min(n_bm25, n), replace=False))
+        bm25_scores = rng.gamma(2.0, 2.0, len(bm25_ids))
+        candidates.append((np.arange(n), vector_scores, bm25_ids, bm25_scores))
+    return candidates
+
+
+def top_candidates(ids: np.ndarray, scores: np.ndarray, n: int | None) -> tuple[np.ndarray, np.ndarray]:
+    """上位n件の候補を文書番号順に返す（nがNoneならすべて）"""
+    if n is None or len(ids) <= n:
+        return ids, scores
+    top = np.sort(top_k_indices(scores, n))
+    return ids[top], scores[top]
+
+
+def bench_fusion(args):
+    """スコア統合の方式ごとの処理時間と、旧実装（linear、全候補）との順位の一致を計測"""
+    candidates = synthetic_candidates(args.n, args.bm25_candidates, args.queries, seed=args.seed)
+    methods = [('legacy', legacy_linear_fusion, None)] + [
+        (name if n is None else f"{name}(top{n})", create_fusion(name), n)
+        for n in [None] + args.candidates for name in FUSIONS
+    ]
+    rankings, rows = {}, []
+    for name, fuse, n in methods:
+        latencies, rankings[name] = [], []
+        for vector_ids, vector_scores, bm25_ids, bm25_scores in candidates:
+            start = time.perf_counter()
+            vector_ids, vector_scores = top_candidates(vector_ids, vector_scores, n)
+            bm25_ids, bm25_scores = top_candidates(bm25_ids, bm25_scores, n)
+            candidate_ids, combined_scores, _, _ = fuse(vector_ids, vector_scores, bm25_ids, bm25_scores, args.alpha)
+            top = candidate_ids[top_k_indices(combined_scores, args.k)]
+            latencies.append((time.perf_counter() - start) * 1000)
+            rankings[name].append(top)
+        latencies = np.array(latencies)
+        rows.append({
+            'fusion': name, 'n': args.n, 'k': args.k,
+            'same_ranking_as_legacy': float(np.mean([np.array_equal(a, b) for a, b in zip(rankings[name], rankings['legacy'])])),
+            **percentiles(latencies),
+        })
+
+    print(f"{'fusion':<16} {'same ranking':>12} {'p50(ms)':>10} {'p95(ms)':>10}")
+    for row in rows:
+        print(f"{row['fusion']:<16} {row['same_ranking_as_legacy']:>12.4f} {row['p50_ms']:>10.3f} {row['p95_ms']:>10.3f}")
+    write_results(args.output, args, rows)
+
+
+def load_questions(paths: list[str]) -> list[str]:
+    """問答集のCSV（1列目が番号、2列目が問題文）から質問を読み込む"""
+    questions = []
+    for path in paths:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            questions.extend(row[1].strip() for row in csv.reader(f) if len(row) > 1 and row[1].strip())
+    return questions
+
+
+def synthetic_corpus(documents: list[dict], n: int, tokenizer, embedder, sentences_per_chunk: int = 4,
+                     noise: float = 0.05, seed: int = 0) -> tuple[list[str], list[dict], list[list[str]], np.ndarray]:
+    """JCSの文を組み合わせた n 件の合成チャンクを作る
+
+    トークン列は文ごとの解析結果をつなげ、埋め込みは文の埋め込みの平均にノイズを加えて近似する。
+    文の数だけ解析・埋め込みすればよいため、100万件でも埋め込みモデルを通さずに作れる。
+    (本文, メタデータ, トークン列, 埋め込み) を返す。
+    """
+    sentences, sources, seen = [], [], set()
+    for doc in documents:
+        for sentence in SENTENCE_END.split(doc['text']):
+            if len(sentence.strip()) >= 5 and sentence not in seen:
+                seen.add(sentence)
+                sentences.append(sentence)
+                sources.append(doc)
+    sentence_tokens = tokenizer.tokenize_many(sentences)
+    sentence_embeddings = embedder.encode_passages(sentences)
+
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(sentences), (n, sentences_per_chunk))
+    texts = [''.join(sentences[i] for i in row) for row in picks]
+    tokens = [[word for i in row for word in sentence_tokens[i]] for row in picks]
+    metadata = [{'id': f"synthetic-{j}", 'chapter': sources[row[0]].get('chapter', ''), 'section': sources[row[0]].get('section', '')}
+                for j, row in enumerate(picks)]
+    embeddings = np.empty((n, sentence_embeddings.shape[1]), dtype=np.float32)
+    for start in range(0, n, 65536):
+        block = sentence_embeddings[picks[start:start + 65536]].mean(axis=1)
+        block += noise * rng.standard_normal(block.shape).astype(np.float32)
+        embeddings[start:start + 65536] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return texts, metadata, tokens, embeddings
+
+
+def measure_retrieval(retriever, questions: list[str], k: int, alpha: float) -> tuple[list[list[str]], np.ndarray, dict]:
+    """各質問の検索結果（チャンクのid）・検索時間（ミリ秒）・段階ごとの時間（ミリ秒）を計測"""
+    results, latencies, stages = [], [], {}
+    for question in questions:
+        timings = Timings()
+        start = time.perf_counter()
+        items = retriever.retrieve(question, top_k=k, alpha=alpha, timings=timings)
+        latencies.append((time.perf_counter() - start) * 1000)
+        for stage, seconds in timings.stages.items():
+            stages.setdefault(stage, []).append(seconds * 1000)
+        results.append([item.get('id') for item in items])
+    return results, np.array(latencies), stages
+
+
+def measure_qps(retriever, questions: list[str], k: int, alpha: float, concurrency: int, rounds: int) -> float:
+    """concurrency 個のスレッドから同時に検索したときの1秒あたりの処理件数"""
+    queries = questions * rounds
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda question: retriever.retrieve(question, top_k=k, alpha=alpha), queries))
+        elapsed = time.perf_counter() - start
+    return len(queries) / elapsed
+
+
+def bench_retrieval(args):
+    """JCSのチャンクと合成コーパスで、索引の構築時間・メモリ・検索時間・QPS・厳密検索に対する再現率を計測
+
+    生成は行わない。キャッシュ（クエリの埋め込み・形態素解析・検索結果）は無効にして毎回計算する。
+    合成コーパスは永続化インデックスに書き出してから読み込むため、構築時間は再起動時（解析・埋め込み済み）の時間になる。
+    """
+    from rag_system import Embedder, HybridRetriever, JapaneseTokenizer, RAGSystem
+
+    documents = RAGSystem._load_documents(args.chunks)
+    questions = load_questions(args.questions)
+    embedder = Embedder(args.model, dtype=args.dtype, query_cache_size=0)
+    tokenizer = JapaneseTokenizer(query_cache_size=0)
+    print(f"{len(documents)} chunks, {len(questions)} questions")
+
+    rows = []
+    for corpus in args.corpus:
+        workdir = tempfile.mkdtemp(prefix='bench_')
+        try:
+            if corpus == 'jcs':
+                texts = [doc['text'] for doc in documents]
+                metadata = [RAGSystem._metadata(doc) for doc in documents]
+                build = 'cold'
+            else:
+                texts, metadata, tokens, embeddings = synthetic_corpus(documents, int(corpus), tokenizer, embedder, seed=args.seed)
+                keys = [IndexStore.chunk_key(text, embedder.signature) for text in texts]
+                embeddings, scale = embedder.quantize(embeddings)
+                IndexStore(workdir, embedder.signature, tokenizer.signature, embedder.dtype).save(keys, tokens, embeddings, scale)
+                del tokens, embeddings, keys
+                build = 'warm'
+
+            rss_before = rss_mb()
+            start = time.perf_counter()
+            retriever = HybridRetriever(texts, metadata, index_dir=workdir, tokenizer=tokenizer, embedder=embedder,
+                                        result_cache_size=0, fusion=args.fusion, candidates=args.candidates)
+            build_s = time.perf_counter() - start
+            base = {'corpus': 'jcs' if corpus == 'jcs' else 'synthetic', 'n': len(texts), 'k': args.k,
+                    'dtype': args.dtype, 'fusion': args.fusion, 'build': build,
+                    'index_mb': rss_mb() - rss_before, 'peak_rss_mb': peak_rss_mb()}
+
+            configs = [('flat', retriever, build_s)]
+            for nprobe in args.nprobe:
+                approximate = retriever.copy()
+                approximate.vector_index = create_vector_index('ivf', nprobe=nprobe, seed=args.seed)
+                start = time.perf_counter()
+                approximate.vector_index.build(approximate.embeddings)
+                configs.append((f"ivf(nprobe={nprobe})", approximate, time.perf_counter() - start))
+
+            exact = None
+            for name, candidate, config_build_s in configs:
+                measure_retrieval(candidate, questions[:2], args.k, args.alpha)  # ウォームアップ
+                results, latencies, stages = measure_retrieval(candidate, questions, args.k, args.alpha)
+                exact = exact or results
+                recall = np.mean([len(set(approx) & set(ids)) / max(len(ids), 1) for approx, ids in zip(results, exact)])
+                row = {**base, 'index': name, 'build_s': config_build_s, 'recall': float(recall), **percentiles(latencies)}
+                for stage, stage_latencies in stages.items():
+                    row[f"{stage}_p50_ms"] = float(np.percentile(stage_latencies, 50))
+                for concurrency in args.concurrency:
+                    row[f"qps_c{concurrency}"] = measure_qps(candidate, questions, args.k, args.alpha, concurrency, args.rounds)
+                rows.append(row)
+            del retriever, configs
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    qps_columns = [f"qps_c{concurrency}" for concurrency in args.concurrency]
+    print(f"{'corpus':<10} {'n':>8} {'index':<16} {'build(s)':>9} {'mem(MB)':>8} {'recall@' + str(args.k):>9} "
+          f"{'p50(ms)':>8} {'p95(ms)':>8} {'p99(ms)':>8} " + ' '.join(f"{column:>8}" for column in qps_columns))
+    for row in rows:
+        qps = ' '.join(f"{row[column]:>8.1f}" for column in qps_columns)
+        print(f"{row['corpus']:<10} {row['n']:>8} {row['index']:<16} {row['build_s']:>9.2f} {row['index_mb']:>8.0f} "
+              f"{row['recall']:>9.4f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {qps}")
+    write_results(args.output, args, rows)
+
+
+def clear_caches(rag):
+    """回答・埋め込み・形態素解析・検索結果のキャッシュを空にする（同じ質問でも毎回計算させる）"""
+    rag.answer_cache.invalidate()
+    rag.embedder.query_cache.clear()
+    rag.tokenizer.tokenize_query.cache_clear()
+    if rag.retriever:
+        rag.retriever.result_cache.clear()
+
+
+async def run_questions(rag, questions: list[str], concurrency: int, rounds: int) -> tuple[float, list[dict]]:
+    """同時に concurrency 件ずつ質問し、(合計の経過秒数, レスポンス) を返す"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def ask(question: str) -> dict:
+        async with semaphore:
+            return await rag.query_async(question, include_timings=True)
+
+    elapsed, responses = 0.0, []
+    for _ in range(rounds):
+        clear_caches(rag)
+        start = time.perf_counter()
+        responses.extend(await asyncio.gather(*(ask(question) for question in questions)))
+        elapsed += time.perf_counter() - start
+    return elapsed, responses
+
+
+def bench_e2e(args):
+    """問答集の質問でRAGSystem全体（検索からプロンプトの構築・生成まで）の応答時間とQPSを計測
+
+    生成は負荷試験用のバックエンド（fake）で模擬する。キャッシュは計測の前に毎回空にする。
+    """
+    from rag_system import RAGSystem
+
+    questions = load_questions(args.questions)
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        data_dir = os.path.join(workdir, 'knowledge_base')
+        os.makedirs(data_dir)
+        shutil.copy(args.chunks, data_dir)
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        rag = RAGSystem(
+            data_dir=data_dir, model_name='fake', index_dir=os.path.join(workdir, 'index'), top_k=args.k,
+            llm_backend='fake', llm_options={'max_parallel': max(args.concurrency), 'tokens_per_second': args.tokens_per_second,
+                                             'answer_tokens': args.answer_tokens,
+                                             'prefill_chars_per_second': args.prefill_chars_per_second},
+        )
+        base = {'corpus': 'jcs', 'n': rag.document_count, 'k': args.k, 'build_s': time.perf_counter() - start,
+                'index_mb': rss_mb() - rss_before}
+
+        async def run_all() -> list[dict]:
+            rows = []
+            for concurrency in args.concurrency:
+                elapsed, responses = await run_questions(rag, questions, concurrency, args.rounds)
+                timings = [response['timings'] for response in responses if 'timings' in response]
+                row = {**base, 'concurrency': concurrency, 'errors': len(responses) - len(timings),
+                       'qps': len(responses) / elapsed, **percentiles([t['total'] for t in timings])}
+                for stage in dict.fromkeys(stage for t in timings for stage in t):
+                    if stage != 'total':
+                        row[f"{stage}_p50_ms"] = float(np.percentile([t[stage] for t in timings if stage in t], 50))
+                rows.append(row)
+            return rows
+
+        rows = asyncio.run(run_all())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'concurrency':>11} {'qps':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'errors':>7}")
+    for row in rows:
+        print(f"{row['concurrency']:>11} {row['qps']:>8.2f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['errors']:>7}")
+    write_results(args.output, args, rows)
+
+
+IDENTITY_FIELDS = ('n', 'k', 'dim', 'concurrency')
+
+
+def row_key(row: dict) -> tuple:
+    """同じ条件の行を対応付けるためのキー（文字列の項目と n / k / dim / concurrency）"""
+    return tuple((key, value) for key, value in row.items() if isinstance(value, str) or key in IDENTITY_FIELDS)
+
+
+def load_rows(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        results = json.load(f)
+    return results['rows'] if isinstance(results, dict) else results
+
+
+def bench_compare(args):
+    """2つの結果ファイル（例: 変更前と変更後のコミット）を比べ、threshold を超えて悪化した指標を示す
+
+    悪化した指標があれば終了コード1で終わる。
+    """
+    baseline = {row_key(row): row for row in load_rows(args.baseline)}
+    regressions = 0
+    print(f"{'condition':<60} {'metric':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for row in load_rows(args.current):
+        before = baseline.get(row_key(row))
+        if before is None:
+            continue
+        condition = ' '.join(str(value) for _, value in row_key(row))
+        for metric, value in row.items():
+            if metric in IDENTITY_FIELDS or not isinstance(value, (int, float)) or not isinstance(before.get(metric), (int, float)):
+                continue
+            direction = -1 if metric.endswith(LOWER_IS_BETTER) else 1 if metric.startswith(HIGHER_IS_BETTER) else 0
+            if direction == 0 or before[metric] == 0:
+                continue
+            change = (value - before[metric]) / abs(before[metric])
+            worse = direction * change < -args.threshold
+            regressions += worse
+            print(f"{condition[:60]:<60} {metric:<24} {before[metric]:>10.4g} {value:>10.4g} {change:>+8.1%}{'  !' if worse else ''}")
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAGシステムのベンチマーク")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    vector = subparsers.add_parser('vector', help="ベクトル索引の再現率と検索時間")
+    vector.add_argument('--n', type=int, default=100000, help="疑似コーパスのチャンク数")
+    vector.add_argument('--dim', type=int, default=768, help="疑似埋め込みの次元数")
+    vector.add_argument('--index-dir', help="疑似データの代わりに使う永続化インデックスのディレクトリ")
+    vector.add_argument('--model', default='intfloat/multilingual-e5-base', help="永続化インデックスの埋め込みモデル名")
+    vector.add_argument('--queries', type=int, default=200)
+    vector.add_argument('--k', type=int, default=10)
+    vector.add_argument('--nlist', type=int, default=None, help="IVFのクラスタ数（省略時はsqrt(n)）")
+    vector.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    vector.add_argument('--seed', type=int, default=0)
+    vector.add_argument('--output', help="結果を書き出すJSONファイル")
+    vector.set_defaults(func=bench_vector)
+
+    fusion = subparsers.add_parser('fusion', help="スコア統合の処理時間と旧実装との順位の一致")
+    fusion.add_argument('--n', type=int, default=100000, help="ベクトル検索の候補数（flat索引ではチャンク数）")
+    fusion.add_argument('--bm25-candidates', type=int, default=5000, help="BM25の候補数（クエリ語を含むチャンク数）")
+    fusion.add_argument('--queries', type=int, default=50)
+    fusion.add_argument('--k', type=int, default=10)
+    fusion.add_argument('--alpha', type=float, default=0.5)
+    fusion.add_argument('--candidates', type=int, nargs='*', default=[100, 1000], help="各検索から上位何件を候補にするか")
+    fusion.add_argument('--seed', type=int, default=0)
+    fusion.add_argument('--output', help="結果を書き出すJSONファイル")
+    fusion.set_defaults(func=bench_fusion)
+
+    retrieval = subparsers.add_parser('retrieval', help="JCS・合成コーパスでの構築時間・メモリ・検索時間・QPS・再現率")
+    retrieval.add_argument('--corpus', nargs='+', default=['jcs', '10000', '100000'],
+                           help="jcs（チャンクファイルそのもの）または合成コーパスのチャンク数（例: 1000000）")
+    retrieval.add_argument('--chunks', default='JCS2025_Iwamoto_chunks_highlighted.jsonl', help="チャンクのJSONLファイル")
+    retrieval.add_argument('--questions', nargs='+', default=['問答集.csv', '問答集(記述).csv'], help="クエリに使う問答集のCSV")
+    retrieval.add_argument('--model', default='intfloat/multilingual-e5-base', help="埋め込みモデル名")
+    retrieval.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'int8'], help="埋め込みの保存形式")
+    retrieval.add_argument('--fusion', default='linear', choices=list(FUSIONS))
+    retrieval.add_argument('--candidates', type=int, default=None, help="各検索から統合の候補にする件数")
+    retrieval.add_argument('--k', type=int, default=3)
+    retrieval.add_argument('--alpha', type=float, default=0.5)
+    retrieval.add_argument('--nprobe', type=int, nargs='*', default=[4, 16], help="比較するIVFのnprobe（厳密検索に対する再現率を計測）")
+    retrieval.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8], help="QPSを計測する同時実行数")
+    retrieval.add_argument('--rounds', type=int, default=3, help="QPSの計測で質問を繰り返す回数")
+    retrieval.add_argument('--seed', type=int, default=0)
+    retrieval.add_argument('--output', help="結果を書き出すJSONファイル")
+    retrieval.set_defaults(func=bench_retrieval)
+
+    e2e = subparsers.add_parser('e2e', help="生成を模擬したRAGSystem全体の応答時間とQPS")
+    e2e.add_argument('--chunks', default='JCS2025_Iwamoto_chunks_highlighted.jsonl', help="チャンクのJSONLファイル")
+    e2e.add_argument('--questions', nargs='+', default=['問答集.csv', '問答集(記述).csv'], help="問答集のCSV")
+    e2e.add_argument('--k', type=int, default=3)
+    e2e.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    e2e.add_argument('--rounds', type=int, default=3)
+    e2e.add_argument('--tokens-per-second', type=float, default=1000.0, help="模擬する生成の速さ")
+    e2e.add_argument('--answer-tokens', type=int, default=32, help="模擬する回答のトークン数")
+    e2e.add_argument('--prefill-chars-per-second', type=float, default=5000.0, help="模擬するプロンプトの処理の速さ")
+    e2e.add_argument('--output', help="結果を書き出すJSONファイル")
+    e2e.set_defaults(func=bench_e2e)
+
+    compare = subparsers.add_parser('compare', help="2つの結果ファイルを比べて悪化した指標を示す")
+    compare.add_argument('baseline', help="基準の結果（例: 変更前のコミットで --output に書き出したもの）")
+    compare.add_argument('current', help="比較する結果")
+    compare.add_argument('--threshold', type=float, default=0.1, help="悪化とみなす変化の割合")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
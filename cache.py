@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUCache:
+    """件数の上限（LRU）と有効期限（TTL、秒）つきのスレッドセーフなキャッシュ"""
+    def __init__(self, maxsize: int = 256, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self) -> list[tuple]:
+        """有効期限内の(キー, 値)の一覧（古い順）"""
+        with self._lock:
+            now = time.monotonic()
+            return [(key, value) for key, (stored_at, value) in self._data.items()
+                    if self.ttl is None or now - stored_at <= self.ttl]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """件数とヒット・ミスの回数"""
+        return {'entries': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class AnswerCache:
+    """質問に対する回答のキャッシュ
+
+    1段目は正規化した質問文の完全一致、2段目は質問の埋め込みのコサイン類似度が
+    semantic_threshold 以上の過去の質問を探す。エントリにはコーパスのバージョンを記録し、
+    ナレッジベースが更新された後の古い回答は使わない。scope（検索の絞り込み条件など）が異なる回答は使わない。
+    """
+    def __init__(self, maxsize: int = 256, ttl: float | None = 3600.0, semantic_threshold: float | None = 0.95):
+        self.semantic_threshold = semantic_threshold
+        self._entries = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def get_exact(self, key: str, version: int, scope: tuple = ()) -> dict | None:
+        """正規化した質問文が一致する回答"""
+        entry = self._entries.get((key, scope))
+        if entry is None or entry['version'] != version:
+            return None
+        return self._hit(entry, 'exact')
+
+    def get_semantic(self, embedding: np.ndarray, version: int, scope: tuple = ()) -> dict | None:
+        """埋め込みが十分に近い質問の回答（見つからなければミスとして数える）"""
+        if self.semantic_threshold is not None:
+            entries = [entry for (_, entry_scope), entry in self._entries.items() if entry['version'] == version and entry_scope == scope]
+            if entries:
+                matrix = np.stack([entry['embedding'] for entry in entries])
+                similarities = matrix @ self._unit(embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.semantic_threshold:
+                    return self._hit(entries[best], 'semantic')
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, embedding: np.ndarray, version: int, response: dict, latency: float, scope: tuple = ()):
+        """回答を登録（latencyはキャッシュなしで回答にかかった秒数）"""
+        self._entries.put((key, scope), {
+            'embedding': self._unit(embedding),
+            'version': version,
+            'response': response,
+            'latency': latency,
+        })
+
+    def invalidate(self):
+        """すべての回答を破棄"""
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """ヒット率と節約できた時間"""
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_rate': (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                'saved_seconds': self.saved_seconds,
+            }
+
+    def _hit(self, entry: dict, level: str) -> dict:
+        with self._lock:
+            if level == 'exact':
+                self.exact_hits += 1
+            else:
+                self.semantic_hits += 1
+            self.saved_seconds += entry['latency']
+        return {**entry['response'], 'cached': level}
+
+    @staticmethod
+    def _unit(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
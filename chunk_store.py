@@ -0,0 +1,272 @@
+import copy
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def _reserve(buffer: np.ndarray, size: int, needed: int) -> np.ndarray:
+    """先頭 size 件を保ったまま needed 件まで書き込める配列を返す（足りなければ容量を倍にして確保し直す）
+
+    メモリマップなど書き込めない配列も確保し直す。
+    """
+    if needed <= len(buffer) and buffer.flags.writeable:
+        return buffer
+    grown = np.empty((max(needed, 2 * len(buffer)),) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:size] = buffer[:size]
+    return grown
+
+
+class _StringColumn:
+    """可変長の文字列を、1つのバイト列と行ごとの開始位置（offsets）で持つ列"""
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self.size = 0
+        self.data = np.empty(0, dtype=np.uint8)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def __getitem__(self, row: int) -> str:
+        return self.data[self.offsets[row]:self.offsets[row + 1]].tobytes().decode(self.encoding)
+
+    def append(self, strings: list[str]):
+        encoded = [string.encode(self.encoding) for string in strings]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        encoded = b''.join(encoded)
+        start, end = int(self.offsets[self.size]), int(self.offsets[self.size]) + len(encoded)
+        self.data = _reserve(self.data, start, end)
+        self.data[start:end] = np.frombuffer(encoded, dtype=np.uint8)
+        self.offsets = _reserve(self.offsets, self.size + 1, self.size + len(strings) + 1)
+        self.offsets[self.size + 1:self.size + len(strings) + 1] = start + np.cumsum(lengths)
+        self.size += len(strings)
+
+    def take(self, rows: np.ndarray) -> '_StringColumn':
+        """rows（昇順）の行だけを詰めた列"""
+        offsets = self.offsets[:self.size + 1]
+        lengths = np.diff(offsets)
+        keep = np.zeros(self.size, dtype=bool)
+        keep[rows] = True
+        column = _StringColumn(self.encoding)
+        column.size = len(rows)
+        column.data = self.data[:offsets[-1]][np.repeat(keep, lengths)]
+        column.offsets = np.concatenate([[0], np.cumsum(lengths[rows])]).astype(np.int64)
+        return column
+
+    def to_arrays(self, name: str) -> dict[str, np.ndarray]:
+        return {f"{name}_data": self.data[:self.offsets[self.size]], f"{name}_offsets": self.offsets[:self.size + 1]}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray], name: str, encoding: str) -> '_StringColumn':
+        column = cls(encoding)
+        column.data = arrays[f"{name}_data"]
+        column.offsets = arrays[f"{name}_offsets"]
+        column.size = len(column.offsets) - 1
+        return column
+
+
+class _CategoryColumn:
+    """種類の少ない文字列を、値の一覧への番号で持つ列（同じ値の文字列は1つだけ持つ）"""
+    def __init__(self, values: list[str] = ()):
+        self.values = list(values)
+        self.index = {value: code for code, value in enumerate(self.values)}
+        self.size = 0
+        self.codes = np.empty(0, dtype=np.int32)
+
+    def __getitem__(self, row: int) -> str:
+        return self.values[self.codes[row]]
+
+    def append(self, strings: list[str]):
+        codes = np.fromiter((self._code(string) for string in strings), dtype=np.int32, count=len(strings))
+        self.codes = _reserve(self.codes, self.size, self.size + len(strings))
+        self.codes[self.size:self.size + len(strings)] = codes
+        self.size += len(strings)
+
+    def _code(self, value: str) -> int:
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def copy(self) -> '_CategoryColumn':
+        """値の一覧だけを複製し、番号の配列は共有する"""
+        clone = copy.copy(self)
+        clone.values = list(self.values)
+        clone.index = dict(self.index)
+        return clone
+
+    def take(self, rows: np.ndarray) -> '_CategoryColumn':
+        column = _CategoryColumn(self.values)
+        column.size = len(rows)
+        column.codes = self.codes[:self.size][rows]
+        return column
+
+
+def filter_key(filters: dict | None) -> tuple:
+    """絞り込み条件を、キャッシュのキーに使える正規化したタプルにする（条件なしは空のタプル）"""
+    return tuple(sorted(
+        (name, tuple(sorted({values} if isinstance(values, str) else set(values))))
+        for name, values in (filters or {}).items() if values is not None
+    ))
+
+
+class ChunkStore:
+    """チャンクの本文・メタデータ（id・chapter・section・source）・キーを列ごとの配列で持つ表
+
+    本文はUTF-16（日本語は1文字2バイトで、UTF-8の3バイトより小さい）、IDはUTF-8で、それぞれ1つの
+    バイト列と行ごとの開始位置に詰める。章・節・読み込んだファイル名は値の一覧への番号、
+    キー（IndexStore.chunk_key）は固定長のバイト列の配列で持ち、チャンクごとのPythonオブジェクトを作らない。
+    配列は容量を倍々に確保して追記し、copy() した複製は元の表からは見えない行にだけ書き込む。
+    章・節・ファイル名での絞り込み（select）には、値ごとの行番号の一覧（転置リスト）を使う。
+    """
+    FIELDS = ('id', 'chapter', 'section', 'source')
+    CATEGORIES = ('chapter', 'section', 'source')
+    KEY_DTYPE = 'S64'
+
+    def __init__(self):
+        self.texts = _StringColumn('utf-16-le')
+        self.ids = _StringColumn('utf-8')
+        self.categories = {name: _CategoryColumn() for name in self.CATEGORIES}
+        self._keys = np.empty(0, dtype=self.KEY_DTYPE)
+        self._row_indexes = {}
+
+    def __len__(self) -> int:
+        return self.texts.size
+
+    @property
+    def keys(self) -> np.ndarray:
+        """各チャンクのキー（16進数のASCII文字列）の配列"""
+        return self._keys[:len(self)]
+
+    def text(self, row: int) -> str:
+        return self.texts[row]
+
+    def get(self, row: int, field: str) -> str:
+        """メタデータの値（id / chapter / section / source）"""
+        return self.ids[row] if field == 'id' else self.categories[field][row]
+
+    def append(self, texts: list[str], metadata: list[dict], keys: list | np.ndarray):
+        """チャンクを末尾に追加する（metadata の id / chapter / section / source 以外の項目は持たない）"""
+        size = len(self)
+        self._row_indexes = {}
+        metadata = metadata or [{}] * len(texts)
+        self._keys = _reserve(self._keys, size, size + len(texts))
+        self._keys[size:size + len(texts)] = keys
+        self.texts.append(texts)
+        self.ids.append([str(meta.get('id', '')) for meta in metadata])
+        for name, column in self.categories.items():
+            column.append([str(meta.get(name, '')) for meta in metadata])
+
+    def copy(self) -> 'ChunkStore':
+        """元の表での読み出しに影響を与えずに追記できる複製（配列は共有する）"""
+        clone = copy.copy(self)
+        clone.texts = copy.copy(self.texts)
+        clone.ids = copy.copy(self.ids)
+        clone.categories = {name: column.copy() for name, column in self.categories.items()}
+        clone._row_indexes = dict(self._row_indexes)
+        return clone
+
+    def take(self, rows: np.ndarray) -> 'ChunkStore':
+        """rows（昇順）の行だけを残した表"""
+        store = ChunkStore()
+        store.texts = self.texts.take(rows)
+        store.ids = self.ids.take(rows)
+        store.categories = {name: column.take(rows) for name, column in self.categories.items()}
+        store._keys = self.keys[rows]
+        return store
+
+    def row_index(self, name: str) -> tuple[np.ndarray, np.ndarray]:
+        """列の値ごとの行番号の一覧 (offsets, rows)。値の番号 code の行は rows[offsets[code]:offsets[code + 1]]（昇順）
+
+        初回に作って表が変わるまで使い回す（スナップショットには作ったものを書き出す）。
+        """
+        index = self._row_indexes.get(name)
+        if index is None:
+            column = self.categories[name]
+            codes = column.codes[:column.size]
+            counts = np.bincount(codes, minlength=len(column.values))
+            rows = np.argsort(codes, kind='stable').astype(np.int32)
+            index = self._row_indexes[name] = (np.concatenate([[0], np.cumsum(counts)]).astype(np.int64), rows)
+        return index
+
+    def select(self, filters: dict | None) -> np.ndarray | None:
+        """絞り込み条件（列名 → 値または値のリスト）にすべて一致する行番号（昇順）。条件がなければNone
+
+        同じ列の値のリストはいずれかに一致、複数の列はすべてに一致する行を返す。
+        """
+        selected = None
+        for name, values in filter_key(filters):
+            if name not in self.categories:
+                raise ValueError(f"Unknown filter field: {name} (choose from {', '.join(self.CATEGORIES)})")
+            offsets, rows = self.row_index(name)
+            codes = [code for code in map(self.categories[name].index.get, values) if code is not None]
+            matched = [rows[offsets[code]:offsets[code + 1]] for code in codes]
+            matched = matched[0] if len(matched) == 1 else np.sort(np.concatenate(matched or [np.empty(0, dtype=np.int32)]))
+            selected = matched if selected is None else np.intersect1d(selected, matched, assume_unique=True)
+        return selected
+
+    def to_arrays(self) -> tuple[dict[str, np.ndarray], dict]:
+        """スナップショットに書き出すための (配列, 章・節・ファイル名の値の一覧)"""
+        arrays = {**self.texts.to_arrays('chunk_text'), **self.ids.to_arrays('chunk_id'), 'chunk_keys': self.keys}
+        for name, column in self.categories.items():
+            arrays[f"chunk_{name}"] = column.codes[:column.size]
+            arrays[f"chunk_{name}_offsets"], arrays[f"chunk_{name}_rows"] = self.row_index(name)
+        return arrays, {name: column.values for name, column in self.categories.items()}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray], values: dict) -> 'ChunkStore':
+        """to_arrays の結果から復元する（配列はコピーせずそのまま参照する）"""
+        store = cls()
+        store.texts = _StringColumn.from_arrays(arrays, 'chunk_text', 'utf-16-le')
+        store.ids = _StringColumn.from_arrays(arrays, 'chunk_id', 'utf-8')
+        for name in cls.CATEGORIES:
+            column = _CategoryColumn(values[name])
+            column.codes = arrays[f"chunk_{name}"]
+            column.size = len(column.codes)
+            store.categories[name] = column
+            store._row_indexes[name] = (arrays[f"chunk_{name}_offsets"], arrays[f"chunk_{name}_rows"])
+        store._keys = arrays['chunk_keys']
+        return store
+
+
+class ChunkView(Mapping):
+    """検索結果1件を表す読み取り専用のマッピング
+
+    本文・メタデータは参照先の ChunkStore から読み出すため、結果ごとに辞書や本文の複製を作らない。
+    キーは text / score / vector_score / bm25_score / id / chapter / section / source（再ランキング後は rerank_score も）。
+    """
+    __slots__ = ('store', 'row', 'score', 'vector_score', 'bm25_score', 'rerank_score')
+    SCORES = ('score', 'vector_score', 'bm25_score')
+
+    def __init__(self, store: ChunkStore, row: int, score: float, vector_score: float, bm25_score: float,
+                 rerank_score: float | None = None):
+        self.store = store
+        self.row = row
+        self.score = score
+        self.vector_score = vector_score
+        self.bm25_score = bm25_score
+        self.rerank_score = rerank_score
+
+    def __getitem__(self, key: str):
+        if key == 'text':
+            return self.store.text(self.row)
+        if key in ChunkStore.FIELDS:
+            return self.store.get(self.row, key)
+        if key in self.SCORES or (key == 'rerank_score' and self.rerank_score is not None):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield 'text'
+        yield from self.SCORES
+        yield from ChunkStore.FIELDS
+        if self.rerank_score is not None:
+            yield 'rerank_score'
+
+    def __len__(self) -> int:
+        return 1 + len(self.SCORES) + len(ChunkStore.FIELDS) + (self.rerank_score is not None)
+
+    def __repr__(self) -> str:
+        return f"ChunkView({dict(self)!r})"
+
+    def with_rerank_score(self, rerank_score: float) -> 'ChunkView':
+        """再ランキングのスコアを付けた新しい結果"""
+        return ChunkView(self.store, self.row, self.score, self.vector_score, self.bm25_score, rerank_score)
@@ -0,0 +1,156 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    """読み込み中・読み込み済みのコレクション"""
+    def __init__(self):
+        self.system = None
+        self.error = None
+        self.ready = threading.Event()
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class CollectionManager:
+    """名前つきのナレッジベース（コレクション）ごとのRAGSystemを、最初に使われた時点で読み込んで保持する
+
+    コレクションはそれぞれ文書・永続化インデックス（・スナップショット）のディレクトリを持ち、索引は独立している。
+    読み込み済みの数が max_loaded を超えると、使用中でないものを最後に使われた順の古い方からメモリから外す
+    （idle_seconds を指定すると、その時間使われていないものも外す）。外したコレクションは次に使われたときに
+    永続化インデックスから復元する。形態素解析・埋め込み・再ランキングのモデルと生成バックエンドは
+    最初に読み込んだRAGSystemのものを全コレクションで共有する。
+    既定のコレクション（default）は従来どおりのディレクトリ（default_options）を使う。
+    """
+    NAME_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9_-]{0,63}')
+
+    def __init__(self, factory, directory: str = 'collections', default: str = 'default',
+                 default_options: dict | None = None, max_loaded: int = 4, idle_seconds: float | None = None,
+                 snapshots: bool = False):
+        # factory(data_dir=..., index_dir=..., snapshot_dir=..., components=...) でRAGSystemを作る
+        self.factory = factory
+        self.directory = directory
+        self.default = default
+        self.default_options = default_options or {}
+        self.max_loaded = max_loaded
+        self.idle_seconds = idle_seconds
+        self.snapshots = snapshots
+        self._entries = OrderedDict()
+        self._components = None
+        self._lock = threading.Lock()
+
+    def validate(self, name: str | None) -> str:
+        """コレクション名を確かめて返す（省略時は既定のコレクション）"""
+        if not name:
+            return self.default
+        if not self.NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid collection name: {name!r} (letters, digits, '_' and '-', up to 64 characters)")
+        return name
+
+    def options(self, name: str) -> dict:
+        """コレクションのディレクトリ（data_dir / index_dir / snapshot_dir）"""
+        if name == self.default:
+            return dict(self.default_options)
+        root = os.path.join(self.directory, name)
+        return {
+            'data_dir': os.path.join(root, 'documents'),
+            'index_dir': os.path.join(root, 'index'),
+            'snapshot_dir': os.path.join(root, 'snapshots') if self.snapshots else None,
+        }
+
+    def exists(self, name: str) -> bool:
+        return name == self.default or os.path.isdir(self.options(name)['data_dir'])
+
+    def names(self) -> list[str]:
+        """既定のコレクションとディスク上のコレクションの名前"""
+        names = []
+        if os.path.isdir(self.directory):
+            names = sorted(entry.name for entry in os.scandir(self.directory)
+                           if entry.name != self.default and self.NAME_PATTERN.fullmatch(entry.name) and self.exists(entry.name))
+        return [self.default] + names
+
+    def acquire(self, name: str | None, create: bool = False):
+        """コレクションのRAGSystemを借りる（読み込まれていなければ読み込む。release するまでメモリから外さない）
+
+        存在しないコレクションは create=True でなければ KeyError。同じコレクションを同時に要求された場合、読み込みは1度だけ行う。
+        """
+        name = self.validate(name)
+        with self._lock:
+            entry = self._entries.get(name)
+            loading = entry is None
+            if loading:
+                if not create and not self.exists(name):
+                    raise KeyError(f"Collection not found: {name}")
+                entry = self._entries[name] = _Entry()
+            entry.users += 1
+            self._entries.move_to_end(name)
+
+        if loading:
+            try:
+                entry.system = self._load(name)
+            except Exception as e:
+                entry.error = e
+                with self._lock:
+                    self._entries.pop(name, None)
+                raise
+            finally:
+                entry.ready.set()
+            self.evict()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+        return entry.system
+
+    def release(self, name: str | None):
+        """acquire で借りたコレクションを返す"""
+        name = self.validate(name)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+        self.evict()
+
+    def _load(self, name: str):
+        started = time.perf_counter()
+        system = self.factory(**self.options(name), components=self._components)
+        if self._components is None:
+            self._components = system.components()
+        logger.info(f"Loaded collection {name} ({time.perf_counter() - started:.1f}s)")
+        return system
+
+    def evict(self):
+        """上限を超えた分と、idle_seconds 以上使われていないコレクションのうち使用中でないものを外す"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [name for name, entry in self._entries.items() if entry.users == 0 and entry.ready.is_set()]
+            excess = len(self._entries) - self.max_loaded
+            evicted = []
+            for name in idle:
+                if excess > 0 or (self.idle_seconds is not None and now - self._entries[name].last_used >= self.idle_seconds):
+                    del self._entries[name]
+                    evicted.append(name)
+                    excess -= 1
+        for name in evicted:
+            logger.info(f"Unloaded collection {name}")
+
+    def loaded(self) -> list[tuple[str, object]]:
+        """読み込み済みのコレクション (名前, RAGSystem)（最後に使われた順の古い方から）"""
+        with self._lock:
+            return [(name, entry.system) for name, entry in self._entries.items() if entry.system is not None]
+
+    def report(self) -> list[dict]:
+        """コレクションごとの読み込み状態と文書数（読み込み済みのもののみ）"""
+        loaded = dict(self.loaded())
+        return [
+            {'name': name, 'loaded': name in loaded,
+             'documents': loaded[name].document_count if name in loaded else None}
+            for name in self.names()
+        ]
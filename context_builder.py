@@ -0,0 +1,121 @@
+import math
+import re
+
+# 文の区切り（句点・感嘆符・疑問符・改行の直後）
+SENTENCE_END = re.compile(r'(?<=[。．！？!?\n])')
+# 日本語の文字（ひらがな・カタカナ・漢字・全角記号）
+CJK_CHARS = re.compile(r'[\u3000-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+class TokenCounter:
+    """プロンプトのトークン数を数える
+
+    tokenizer_name にHugging Faceのトークナイザー名（例: "google/gemma-3-27b-it"）を指定すると
+    生成モデルと同じトークナイザーで数える。省略時は文字種からの概算（日本語1文字を1トークン、
+    それ以外は4文字を1トークン）を使う。
+    """
+    def __init__(self, tokenizer_name: str | None = None):
+        self.tokenizer_name = tokenizer_name
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        """トークナイザー（transformersは重いため初回利用時に読み込む）"""
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        return self._tokenizer
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.tokenizer_name:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        cjk = len(CJK_CHARS.findall(text))
+        others = len(text) - cjk - text.count(' ')
+        return cjk + math.ceil(max(others, 0) / 4)
+
+
+class ContextBuilder:
+    """検索結果からトークン数の上限内に収まるコンテキストを組み立てる
+
+    同じ章・節のチャンクは1つのブロックにまとめて出典の見出しを1度だけ付ける。
+    上限を超える場合は文単位で、クエリ語を含む文 → その前後の文 → 残りの文 の順に
+    検索順位の高いブロックから採用し、省いた箇所は「…」で示す。
+    """
+    def __init__(self, max_tokens: int | None = 1536, tokenizer_name: str | None = None, merge_sections: bool = True):
+        self.max_tokens = max_tokens
+        self.merge_sections = merge_sections
+        self.counter = TokenCounter(tokenizer_name)
+
+    def _blocks(self, retrieved_contexts: list[dict]) -> list[dict]:
+        """検索結果を章・節ごとのブロックにまとめる（ブロックの順はその中の最上位の検索順位）"""
+        blocks, by_source = [], {}
+        for item in retrieved_contexts:
+            source = (item.get('chapter', ''), item.get('section', ''))
+            block = by_source.get(source) if self.merge_sections else None
+            if block is None:
+                block = {'chapter': source[0], 'section': source[1], 'sentences': []}
+                blocks.append(block)
+                by_source[source] = block
+            # 重なりのあるチャンクを結合しても同じ文が繰り返されないようにする
+            seen = set(block['sentences'])
+            for sentence in SENTENCE_END.split(item['text']):
+                if sentence.strip() and sentence not in seen:
+                    block['sentences'].append(sentence)
+                    seen.add(sentence)
+        return blocks
+
+    @staticmethod
+    def _header(rank: int, block: dict) -> str:
+        relevance = "非常に関連性が高い" if rank <= 2 else "参考情報"
+        return f"[重要度: {relevance} | 出典: {block['chapter']} - {block['section']}]\n"
+
+    def build(self, retrieved_contexts: list[dict], query_terms: tuple[str, ...] = ()) -> str:
+        """上限内のコンテキスト文字列を返す"""
+        blocks = self._blocks(retrieved_contexts)
+        headers = [self._header(rank, block) for rank, block in enumerate(blocks, 1)]
+        if self.max_tokens is None:
+            return '---\n'.join(header + ''.join(block['sentences']).rstrip('\n') + '\n' for header, block in zip(headers, blocks))
+
+        # 文ごとの優先度: 0 = クエリ語を含む文、1 = その前後の文、2 = それ以外
+        terms = [term for term in query_terms if len(term) > 1 or not term.isascii()]
+        candidates = []
+        for b, block in enumerate(blocks):
+            sentences = block['sentences']
+            hits = [any(term in sentence for term in terms) for sentence in sentences]
+            for s, sentence in enumerate(sentences):
+                near = (s > 0 and hits[s - 1]) or (s + 1 < len(sentences) and hits[s + 1])
+                priority = 0 if hits[s] else 1 if near else 2
+                candidates.append((priority, b, s))
+        candidates.sort()
+
+        selected = [set() for _ in blocks]
+        used = 0
+        for _, b, s in candidates:
+            cost = self.counter.count(blocks[b]['sentences'][s])
+            if not selected[b]:
+                cost += self.counter.count(headers[b])
+            if used + cost > self.max_tokens:
+                continue
+            selected[b].add(s)
+            used += cost
+
+        parts = []
+        for header, block, chosen in zip(headers, blocks, selected):
+            if not chosen:
+                continue
+            text, previous = '', -1
+            for s in sorted(chosen):
+                if s != previous + 1:
+                    text += '…'
+                text += block['sentences'][s]
+                previous = s
+            if previous != len(block['sentences']) - 1:
+                text += '…'
+            parts.append(header + text.rstrip('\n') + '\n')
+        return '---\n'.join(parts)
+
+    def count_messages(self, messages: list[dict]) -> int:
+        """メッセージ全体の（概算の）トークン数"""
+        return sum(self.counter.count(message['content']) for message in messages)
@@ -0,0 +1,80 @@
+from functools import partial
+
+import numpy as np
+
+
+def linear(scores: np.ndarray, present: np.ndarray) -> np.ndarray:
+    """最大値で割る（最大値が0以下ならそのまま）。候補に挙がらなかったチャンクは0として扱う"""
+    peak = scores.max() if len(scores) else 0.0
+    return scores / peak if peak > 0 else scores
+
+
+def minmax(scores: np.ndarray, present: np.ndarray) -> np.ndarray:
+    """候補に挙がったチャンクのスコアを0〜1に線形変換する（挙がらなかったチャンクは0）"""
+    normalized = np.zeros(len(scores))
+    if present.any():
+        low, high = scores[present].min(), scores[present].max()
+        normalized[present] = (scores[present] - low) / (high - low) if high > low else 1.0
+    return normalized
+
+
+def zscore(scores: np.ndarray, present: np.ndarray) -> np.ndarray:
+    """候補に挙がったチャンクのスコアを標準化する（挙がらなかったチャンクは候補中の最小値）"""
+    normalized = np.zeros(len(scores))
+    if present.any():
+        values = scores[present]
+        std = values.std()
+        standardized = (values - values.mean()) / std if std > 0 else np.zeros(len(values))
+        normalized[~present] = standardized.min()
+        normalized[present] = standardized
+    return normalized
+
+
+def rrf(scores: np.ndarray, present: np.ndarray, k: int = 60) -> np.ndarray:
+    """Reciprocal Rank Fusion: 順位rのチャンクに 1 / (k + r) を与える（挙がらなかったチャンクは0）"""
+    normalized = np.zeros(len(scores))
+    ids = np.flatnonzero(present)
+    order = ids[np.argsort(-scores[ids], kind='stable')]
+    normalized[order] = 1.0 / (k + np.arange(1, len(order) + 1))
+    return normalized
+
+
+FUSIONS = {
+    'linear': linear,
+    'minmax': minmax,
+    'zscore': zscore,
+    'rrf': rrf,
+}
+
+
+def fuse(vector_ids: np.ndarray, vector_scores: np.ndarray, bm25_ids: np.ndarray, bm25_scores: np.ndarray,
+         alpha: float = 0.5, normalize=linear) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ベクトル検索とBM25の候補（疎なスコア）を合わせて正規化し、alphaで重み付けして足し合わせる
+
+    (候補のチャンク番号, 統合スコア, 正規化したベクトルのスコア, 正規化したBM25スコア) を返す。
+    片方にしか現れないチャンクのもう一方のスコアは0として正規化関数に渡す。
+    """
+    candidate_ids = np.union1d(vector_ids, bm25_ids)
+    vector_positions = np.searchsorted(candidate_ids, vector_ids)
+    bm25_positions = np.searchsorted(candidate_ids, bm25_ids)
+
+    candidate_vector_scores = np.zeros(len(candidate_ids))
+    candidate_vector_scores[vector_positions] = vector_scores
+    vector_present = np.zeros(len(candidate_ids), dtype=bool)
+    vector_present[vector_positions] = True
+    candidate_bm25_scores = np.zeros(len(candidate_ids))
+    candidate_bm25_scores[bm25_positions] = bm25_scores
+    bm25_present = np.zeros(len(candidate_ids), dtype=bool)
+    bm25_present[bm25_positions] = True
+
+    normalized_vector_scores = normalize(candidate_vector_scores, vector_present)
+    normalized_bm25_scores = normalize(candidate_bm25_scores, bm25_present)
+    combined_scores = alpha * normalized_vector_scores + (1 - alpha) * normalized_bm25_scores
+    return candidate_ids, combined_scores, normalized_vector_scores, normalized_bm25_scores
+
+
+def create_fusion(name: str = 'linear', **options):
+    """名前からスコア統合の関数を作成（optionsは正規化関数の引数、例: rrfの k）"""
+    if name not in FUSIONS:
+        raise ValueError(f"Unknown fusion: {name} (choose from {', '.join(FUSIONS)})")
+    return partial(fuse, normalize=partial(FUSIONS[name], **options))
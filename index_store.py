@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class IndexStore:
+    """HybridRetrieverの埋め込み・トークン列をディスクに永続化するインデックス
+
+    チャンク本文と埋め込みモデル名のハッシュをキーとして保存し、
+    再起動時には変更のあったチャンクだけを再計算できるようにする。
+    埋め込みは保存形式（float32 / float16 / int8）の追記可能な生の配列、キーは固定長（64バイト）の
+    バイト列の配列、トークン列はJSONLで保持し、manifestに記録された件数・バイト数までを有効なデータとして扱う。
+    """
+    FORMAT_VERSION = 4
+    KEY_DTYPE = np.dtype('S64')
+
+    def __init__(self, index_dir: str, model_name: str, tokenizer_signature: str = '', dtype: str = 'float32'):
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.tokenizer_signature = tokenizer_signature
+        self.dtype = np.dtype(dtype)
+        self.path = os.path.join(index_dir, f"v{self.FORMAT_VERSION}")
+        self.manifest = None
+
+    @staticmethod
+    def chunk_key(text: str, model_name: str) -> str:
+        """チャンク本文とモデル名からキャッシュキーを計算"""
+        return hashlib.sha256(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def load(self) -> dict | None:
+        """保存済みインデックスを読み込む（埋め込みはメモリマップ）"""
+        manifest_path = self._file('manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != self.FORMAT_VERSION or manifest.get('model_name') != self.model_name:
+                return None
+            count, dim = manifest['count'], manifest['dim']
+
+            # manifest以降に追記された（コミットされていない）データは読み飛ばす
+            with open(self._file('keys.bin'), 'rb') as f:
+                keys = np.frombuffer(f.read(count * self.KEY_DTYPE.itemsize), dtype=self.KEY_DTYPE)
+            with open(self._file('tokens.jsonl'), 'rb') as f:
+                lines = f.read(manifest['tokens_bytes']).splitlines()
+            tokens = [json.loads(line) for line in lines]
+            dtype = np.dtype(manifest['dtype'])
+            if count:
+                embeddings = np.memmap(self._file('embeddings.bin'), dtype=dtype, mode='r', shape=(count, dim))
+            else:
+                embeddings = np.empty((0, dim), dtype=dtype)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if len(tokens) != count or len(keys) != count:
+            return None
+        self.manifest = manifest
+        # 形態素解析の設定や埋め込みの保存形式が変わった場合、変わっていない方だけを再利用する
+        if manifest.get('tokenizer', '') != self.tokenizer_signature:
+            tokens = None
+        if dtype != self.dtype:
+            embeddings = None
+        return {'keys': keys, 'tokens': tokens, 'embeddings': embeddings, 'scale': manifest.get('scale', 1.0)}
+
+    @staticmethod
+    def _token_lines(tokens: list[list[str]]):
+        return (json.dumps(words, ensure_ascii=False).encode('utf-8') + b'\n' for words in tokens)
+
+    def _replace(self, keys: np.ndarray, token_lines, embedding_blocks) -> int:
+        """キー・トークン列（JSONLの行）・埋め込み（ブロックごと）を新しいファイルに書いて置き換え、トークン列のバイト数を返す
+
+        既存ファイルをメモリマップしている読み手がいても壊れないよう、上書きせずに置き換える。
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file('keys.bin.tmp'), 'wb') as f:
+            f.write(np.ascontiguousarray(keys, dtype=self.KEY_DTYPE).tobytes())
+        with open(self._file('embeddings.bin.tmp'), 'wb') as f:
+            for block in embedding_blocks:
+                f.write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+        with open(self._file('tokens.jsonl.tmp'), 'wb') as f:
+            f.writelines(token_lines)
+            tokens_bytes = f.tell()
+        for name in ('keys.bin', 'embeddings.bin', 'tokens.jsonl'):
+            os.replace(self._file(f"{name}.tmp"), self._file(name))
+        return tokens_bytes
+
+    def save(self, keys: list[str] | np.ndarray, tokens: list[list[str]], embeddings: np.ndarray, scale: float = 1.0):
+        """インデックス全体を書き出す（scaleはint8で保存する場合の量子化の刻み幅）"""
+        tokens_bytes = self._replace(keys, self._token_lines(tokens), [embeddings])
+        self._commit({
+            'version': self.FORMAT_VERSION,
+            'model_name': self.model_name,
+            'tokenizer': self.tokenizer_signature,
+            'dtype': self.dtype.name,
+            'scale': float(scale),
+            'dim': int(embeddings.shape[1]),
+            'count': len(keys),
+            'tokens_bytes': tokens_bytes,
+        })
+
+    def append(self, keys: list[str] | np.ndarray, tokens: list[list[str]], embeddings: np.ndarray):
+        """チャンクをインデックスの末尾に追記する"""
+        if self.manifest is None:
+            self.save(keys, tokens, embeddings)
+            return
+        manifest = self.manifest
+        count = manifest['count']
+
+        # 前回の書き込みが途中で失敗していた場合に備え、コミット済みの位置から書き直す
+        with open(self._file('keys.bin'), 'r+b') as f:
+            f.truncate(count * self.KEY_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(keys, dtype=self.KEY_DTYPE).tobytes())
+        with open(self._file('embeddings.bin'), 'r+b') as f:
+            f.truncate(count * manifest['dim'] * self.dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+        with open(self._file('tokens.jsonl'), 'r+b') as f:
+            f.truncate(manifest['tokens_bytes'])
+            f.seek(0, os.SEEK_END)
+            f.writelines(self._token_lines(tokens))
+            tokens_bytes = f.tell()
+        self._commit({**manifest, 'count': count + len(keys), 'tokens_bytes': tokens_bytes})
+
+    def compact(self, rows: np.ndarray, block_size: int = 65536):
+        """rows（昇順）の行だけを残して書き直す（トークン列は1行ずつ、埋め込みはブロックごとに読み書きする）"""
+        manifest = self.manifest
+        count, dim = manifest['count'], manifest['dim']
+        with open(self._file('keys.bin'), 'rb') as f:
+            keys = np.frombuffer(f.read(count * self.KEY_DTYPE.itemsize), dtype=self.KEY_DTYPE)[rows]
+        keep = np.zeros(count, dtype=bool)
+        keep[rows] = True
+        embeddings = np.memmap(self._file('embeddings.bin'), dtype=self.dtype, mode='r', shape=(count, dim)) if count else None
+        with open(self._file('tokens.jsonl'), 'rb') as f:
+            tokens_bytes = self._replace(
+                keys,
+                (line for kept, line in zip(keep, f) if kept),
+                (embeddings[rows[start:start + block_size]] for start in range(0, len(rows), block_size)),
+            )
+        self._commit({**manifest, 'count': len(rows), 'tokens_bytes': tokens_bytes})
+
+    def rescale(self, scale: float, block_size: int = 65536):
+        """int8の埋め込みを新しい刻み幅で量子化し直して書き直す（キー・トークン列はそのまま、埋め込みはブロックごとに読み書きする）"""
+        manifest = self.manifest
+        count, dim = manifest['count'], manifest['dim']
+        factor = manifest['scale'] / scale
+        with open(self._file('keys.bin'), 'rb') as f:
+            keys = np.frombuffer(f.read(count * self.KEY_DTYPE.itemsize), dtype=self.KEY_DTYPE)
+        embeddings = np.memmap(self._file('embeddings.bin'), dtype=self.dtype, mode='r', shape=(count, dim)) if count else None
+        with open(self._file('tokens.jsonl'), 'rb') as f:
+            tokens_bytes = self._replace(
+                keys,
+                (line for _, line in zip(range(count), f)),
+                (np.rint(embeddings[start:start + block_size].astype(np.float32) * factor) for start in range(0, count, block_size)),
+            )
+        self._commit({**manifest, 'scale': float(scale), 'tokens_bytes': tokens_bytes})
+
+    def _commit(self, manifest: dict):
+        """manifestを置き換えて書き込みを確定する"""
+        tmp_manifest = self._file('manifest.json.tmp')
+        with open(tmp_manifest, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_manifest, self._file('manifest.json'))
+        self.manifest = manifest
@@ -0,0 +1,319 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class LLMError(RuntimeError):
+    """生成に失敗した（再試行しても回復しなかった）"""
+    status_code = 502
+
+
+class LLMTimeoutError(LLMError):
+    """期限内に生成が終わらなかった"""
+    status_code = 504
+
+
+class _Slots:
+    """同期・非同期の呼び出し元で共有する、同時に生成するリクエスト数の上限
+
+    枠は1つの threading.BoundedSemaphore で数える。非同期の呼び出し元はスレッドを使わずに待ち、
+    枠が返されるたびにイベントループ上で起こされて取得を試み直す（取得に失敗した待機は枠を持たない）。
+    """
+    def __init__(self, size: int):
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def acquire(self, timeout: float) -> bool:
+        """枠を取得する（同期版。timeout 秒以内に取得できなければ False）"""
+        return self._semaphore.acquire(timeout=timeout)
+
+    async def acquire_async(self):
+        """枠が空くまで待って取得する（期限は呼び出し元の asyncio.timeout で指定する）"""
+        loop = asyncio.get_running_loop()
+        while not self._semaphore.acquire(blocking=False):
+            waiter = (loop, loop.create_future())
+            with self._lock:
+                self._waiters.append(waiter)
+            try:
+                # 登録する前に返された枠を見落とさないよう、登録後にもう1度試す
+                if self._semaphore.acquire(blocking=False):
+                    return
+                await waiter[1]
+            finally:
+                with self._lock:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+
+    def release(self):
+        """枠を返し、待っている非同期の呼び出し元を起こす"""
+        self._semaphore.release()
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # イベントループが終了している
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMBackend:
+    """回答を生成するバックエンドの共通処理
+
+    同時に生成するリクエストを同期・非同期の呼び出しを合わせて max_parallel 件（GPUの並列スロット数）までに制限し、
+    スロットの待ち時間を含めて timeout 秒を期限とする。接続エラーなど一時的な失敗は
+    指数的に伸ばした待ち時間にランダムなゆらぎを加えて retries 回まで再試行する。
+    サブクラスは _chat / _stream / _chat_sync と _retryable を実装する。
+    生成結果は {"content": 本文, "prompt_eval_count": プロンプトのトークン数} の辞書で返す。
+    """
+    def __init__(self, model: str, max_parallel: int = 4, timeout: float = 300.0, retries: int = 2, backoff: float = 0.5):
+        self.model = model
+        self.max_parallel = max_parallel
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._slots = _Slots(max_parallel)
+
+    def _delay(self, attempt: int) -> float:
+        """再試行までの待ち時間（full jitter）"""
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def _retryable(self, error: Exception) -> bool:
+        return False
+
+    def _timed_out(self, error: Exception) -> bool:
+        return isinstance(error, TimeoutError)
+
+    async def chat(self, messages: list[dict], timeout: float | None = None) -> dict:
+        """回答をまとめて生成"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        attempt = 0
+        try:
+            async with asyncio.timeout_at(deadline):
+                while True:
+                    try:
+                        await self._slots.acquire_async()
+                        try:
+                            return await self._chat(messages)
+                        finally:
+                            self._slots.release()
+                    except Exception as e:
+                        if attempt >= self.retries or not self._retryable(e):
+                            raise LLMError(f"Generation failed: {e}") from e
+                    await asyncio.sleep(self._delay(attempt))
+                    attempt += 1
+        except TimeoutError as e:
+            raise LLMTimeoutError(f"Generation did not finish within {timeout or self.timeout:g}s") from e
+
+    async def stream_chat(self, messages: list[dict], timeout: float | None = None):
+        """回答を断片ごとに生成する非同期ジェネレータ（最初の断片を返す前の失敗のみ再試行する）"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        attempt = 0
+        try:
+            while True:
+                started = False
+                try:
+                    # 期限は各待機にだけ適用し、yield をまたいだタイムアウトが呼び出し元を取り消さないようにする
+                    async with asyncio.timeout_at(deadline):
+                        await self._slots.acquire_async()
+                    parts = self._stream(messages)
+                    try:
+                        while True:
+                            async with asyncio.timeout_at(deadline):
+                                try:
+                                    part = await parts.__anext__()
+                                except StopAsyncIteration:
+                                    return
+                            started = True
+                            yield part
+                    finally:
+                        await parts.aclose()
+                        self._slots.release()
+                except (TimeoutError, GeneratorExit, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    if started or attempt >= self.retries or not self._retryable(e):
+                        raise LLMError(f"Generation failed: {e}") from e
+                async with asyncio.timeout_at(deadline):
+                    await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+        except TimeoutError as e:
+            raise LLMTimeoutError(f"Generation did not finish within {timeout or self.timeout:g}s") from e
+
+    def chat_sync(self, messages: list[dict], timeout: float | None = None) -> dict:
+        """回答をまとめて生成（同期版）"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+                raise LLMTimeoutError(f"Generation did not finish within {timeout or self.timeout:g}s")
+            try:
+                return self._chat_sync(messages)
+            except Exception as e:
+                if self._timed_out(e):
+                    raise LLMTimeoutError(f"Generation did not finish within {timeout or self.timeout:g}s") from e
+                if attempt >= self.retries or not self._retryable(e):
+                    raise LLMError(f"Generation failed: {e}") from e
+            finally:
+                self._slots.release()
+            time.sleep(min(self._delay(attempt), max(deadline - time.monotonic(), 0)))
+            attempt += 1
+
+    async def _chat(self, messages: list[dict]) -> dict:
+        raise NotImplementedError
+
+    async def _stream(self, messages: list[dict]):
+        raise NotImplementedError
+        yield
+
+    def _chat_sync(self, messages: list[dict]) -> dict:
+        raise NotImplementedError
+
+
+class OllamaBackend(LLMBackend):
+    """Ollamaによる生成
+
+    HTTP接続はkeep-aliveで使い回し（接続数は max_connections まで）、モデルは keep_alive の間
+    GPUに載せたままにする。max_parallel はOllama側の OLLAMA_NUM_PARALLEL に合わせる。
+    ollama・httpxは起動を速くするため、使うときに読み込む。
+    """
+    def __init__(self, model: str, host: str | None = None, keep_alive: str | float | None = '30m',
+                 options: dict | None = None, max_connections: int | None = None, **kwargs):
+        import httpx
+
+        super().__init__(model, **kwargs)
+        self.host = host
+        self.keep_alive = keep_alive
+        self.options = options
+        self._limits = httpx.Limits(
+            max_connections=max_connections or 2 * self.max_parallel,
+            max_keepalive_connections=self.max_parallel,
+            keepalive_expiry=60.0,
+        )
+        self._async_client = None
+        self._client = None
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import ollama
+            self._async_client = ollama.AsyncClient(host=self.host, limits=self._limits)
+        return self._async_client
+
+    @property
+    def client(self):
+        if self._client is None:
+            import ollama
+            # 同期クライアントでは期限をHTTPのタイムアウトとして渡す
+            self._client = ollama.Client(host=self.host, timeout=self.timeout, limits=self._limits)
+        return self._client
+
+    def _retryable(self, error: Exception) -> bool:
+        """接続できない・サーバーが一時的に応答できない場合のみ再試行する"""
+        import httpx
+        import ollama
+
+        if isinstance(error, ollama.ResponseError):
+            return error.status_code >= 500 or error.status_code == 429
+        return isinstance(error, (ConnectionError, httpx.TransportError))
+
+    def _timed_out(self, error: Exception) -> bool:
+        import httpx
+
+        return isinstance(error, httpx.TimeoutException)
+
+    @staticmethod
+    def _result(response) -> dict:
+        return {"content": response.message.content or '', "prompt_eval_count": getattr(response, 'prompt_eval_count', None)}
+
+    async def _chat(self, messages: list[dict]) -> dict:
+        response = await self.async_client.chat(model=self.model, messages=messages, stream=False,
+                                                keep_alive=self.keep_alive, options=self.options)
+        return self._result(response)
+
+    async def _stream(self, messages: list[dict]):
+        stream = await self.async_client.chat(model=self.model, messages=messages, stream=True,
+                                              keep_alive=self.keep_alive, options=self.options)
+        try:
+            async for part in stream:
+                yield self._result(part)
+        finally:
+            # 途中で打ち切った場合もHTTP接続をプールへ戻す
+            await stream.aclose()
+
+    def _chat_sync(self, messages: list[dict]) -> dict:
+        response = self.client.chat(model=self.model, messages=messages, stream=False,
+                                    keep_alive=self.keep_alive, options=self.options)
+        return self._result(response)
+
+
+class FakeBackend(LLMBackend):
+    """GPUやネットワークなしでパイプライン全体の負荷試験を行うための生成バックエンド
+
+    プロンプトの長さに比例したプレフィル時間と、tokens_per_second での逐次生成を模擬する。
+    failure_rate の確率で一時的なエラー（再試行の対象）を起こす。
+    """
+    def __init__(self, model: str = 'fake', prefill_chars_per_second: float = 5000.0, tokens_per_second: float = 30.0,
+                 answer_tokens: int = 32, failure_rate: float = 0.0, **kwargs):
+        super().__init__(model, **kwargs)
+        self.prefill_chars_per_second = prefill_chars_per_second
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.failure_rate = failure_rate
+
+    def _retryable(self, error: Exception) -> bool:
+        return isinstance(error, ConnectionError)
+
+    def _prefill_seconds(self, messages: list[dict]) -> float:
+        return sum(len(message['content']) for message in messages) / self.prefill_chars_per_second
+
+    def _maybe_fail(self):
+        if random.random() < self.failure_rate:
+            raise ConnectionError("simulated failure")
+
+    def _prompt_eval_count(self, messages: list[dict]) -> int:
+        return sum(len(message['content']) for message in messages)
+
+    async def _chat(self, messages: list[dict]) -> dict:
+        self._maybe_fail()
+        await asyncio.sleep(self._prefill_seconds(messages) + self.answer_tokens / self.tokens_per_second)
+        return {"content": "負荷試験用の回答です。" * max(1, self.answer_tokens // 8), "prompt_eval_count": self._prompt_eval_count(messages)}
+
+    async def _stream(self, messages: list[dict]):
+        self._maybe_fail()
+        await asyncio.sleep(self._prefill_seconds(messages))
+        for i in range(self.answer_tokens):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            last = i == self.answer_tokens - 1
+            yield {"content": "回答" if not last else "。", "prompt_eval_count": self._prompt_eval_count(messages) if last else None}
+
+    def _chat_sync(self, messages: list[dict]) -> dict:
+        self._maybe_fail()
+        seconds = self._prefill_seconds(messages) + self.answer_tokens / self.tokens_per_second
+        if seconds > self.timeout:
+            time.sleep(self.timeout)
+            raise TimeoutError("simulated timeout")
+        time.sleep(seconds)
+        return {"content": "負荷試験用の回答です。" * max(1, self.answer_tokens // 8), "prompt_eval_count": self._prompt_eval_count(messages)}
+
+
+LLM_BACKENDS = {
+    'ollama': OllamaBackend,
+    'fake': FakeBackend,
+}
+
+
+def create_llm_backend(name: str = 'ollama', **options) -> LLMBackend:
+    """名前から生成バックエンドを作成"""
+    if name not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM backend: {name} (choose from {', '.join(LLM_BACKENDS)})")
+    return LLM_BACKENDS[name](**options)
@@ -0,0 +1,175 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# 処理時間のヒストグラムの区切り（秒）。形態素解析など1ms未満の段階から生成の数十秒までを覆う
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labelnames: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """ラベルつきの値の集まり（Prometheusのテキスト形式で出力する）
+
+    function を指定すると出力のたびに呼び出し、その戻り値（ラベルなしなら数値、
+    ラベルつきなら {ラベル値のタプル: 数値}）を値とする。他のオブジェクトが持つ件数などに使う。
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """(名前の接尾辞, ラベル, 値) の一覧"""
+        if self.function is not None:
+            values = self.function()
+            values = values if isinstance(values, dict) else {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', _labels(self.labelnames, key), value) for key, value in values.items() if value is not None]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各区切り以下の件数（区切りごと、累積前）..., 区切りを超えた件数, 合計]
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        with self._lock:
+            values = {key: list(state) for key, state in self._values.items()}
+        samples = []
+        for key, state in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                samples.append(('_bucket', _labels(self.labelnames, key, f'le="{le}"'), cumulative))
+            samples.append(('_sum', _labels(self.labelnames, key), state[-1]))
+            samples.append(('_count', _labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """メトリクスの登録と、Prometheusのテキスト形式（/metrics）への出力"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Duplicated metric: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), function=None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), function=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{labels} {float(value):g}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# 検索・生成の各段階の処理時間と、質問の件数・エラーの件数
+STAGE_SECONDS = REGISTRY.histogram(
+    'rag_stage_seconds', 'Time spent in each stage of answering a question', ('stage',)
+)
+QUERIES = REGISTRY.counter(
+    'rag_queries_total', 'Questions answered, by answer cache result (miss / exact / semantic)', ('cache',)
+)
+ERRORS = REGISTRY.counter(
+    'rag_errors_total', 'Failed questions, by cause (timeout / llm / busy / internal)', ('type',)
+)
+
+
+class Timings:
+    """1件の質問の段階ごとの処理時間（秒）を記録し、ヒストグラムにも反映する
+
+    同じ段階を複数回計測した場合は合計する（バッチ検索を質問ごとに分けない場合など）。
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def as_ms(self) -> dict:
+        """レスポンスに含めるための、段階ごとのミリ秒"""
+        return {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()}
@@ -0,0 +1,69 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+def serve(app, host: str, port: int, workers: int, preload=None, on_fork=None, restart_delay: float = 1.0, **config):
+    """待ち受けソケットを開き、preload を済ませてから workers 個のワーカープロセスをforkしてアプリを実行する
+
+    preload で読み込んだモデルなどは、fork後のワーカーが親プロセスのメモリをコピーオンライトで共有する。
+    on_fork(ワーカー番号) はfork直後の各ワーカーで呼ばれる。異常終了したワーカーは起動し直し、
+    SIGINT / SIGTERM を受け取るとすべてのワーカーに SIGTERM を送って終了を待つ。
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    if preload:
+        preload()
+
+    children = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                if on_fork:
+                    on_fork(index)
+                uvicorn.Server(uvicorn.Config(app, **config)).run(sockets=[sock])
+            except BaseException:
+                logger.exception(f"Worker {index} crashed")
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = index
+        logger.info(f"Started worker {index} (pid {pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            logger.warning(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            time.sleep(restart_delay)
+            if not stopping:
+                spawn(index)
+    sock.close()
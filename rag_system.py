@@ -1,191 +1,1632 @@
 import json
+import multiprocessing
 import os
+import asyncio
+import copy
+import hashlib
+import itertools
+import re
 import shutil
+import threading
+import time
+import unicodedata
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 
 import numpy as np
-import ollama
 from janome.tokenizer import Tokenizer
-from rank_bm25 import BM25Okapi
-from sentence_transformers import SentenceTransformer
+
+from cache import AnswerCache, LRUCache
+from chunk_store import ChunkStore, ChunkView, filter_key
+from context_builder import ContextBuilder
+from fusion import create_fusion
+from index_store import IndexStore
+from llm_backend import LLMError, LLMTimeoutError, create_llm_backend
+from metrics import ERRORS, QUERIES, Timings
+from snapshot import SnapshotStore
+from vector_index import create_vector_index, top_k_indices
+from worker_pool import ServerBusyError
+
+
+def normalize_text(text: str) -> str:
+    """NFKC正規化と空白の統一"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+def content_hash(text: str) -> str:
+    """正規化した本文のハッシュ"""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class JapaneseTokenizer:
+    """Janomeによる形態素解析
+
+    索引構築時は複数プロセスで並列に解析し、クエリの解析結果はLRUキャッシュで再利用する。
+    並列解析のプロセスプールは最初に必要になった時点で1度だけ作り、close() まで使い回す。
+    プールのプロセスはサーバーのスレッドやモデルを引き継がないよう、fork ではなく forkserver（なければ spawn）で起動する。
+    pos_filterに品詞を指定するとその品詞の基本形だけを、Noneを指定すると
+    わかち書き（表層形のみ、Tokenオブジェクトを生成しない）の結果を返す。
+    """
+    DEFAULT_POS_FILTER = ('名詞', '動詞', '形容詞', '副詞')
+
+    def __init__(self, pos_filter: tuple[str, ...] | None = DEFAULT_POS_FILTER, workers: int | None = None,
+                 parallel_threshold: int = 256, query_cache_size: int = 1024):
+        self.pos_filter = frozenset(pos_filter) if pos_filter else None
+        self.workers = workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self._tokenizer = Tokenizer(wakati=self.pos_filter is None)
+        self.tokenize_query = lru_cache(maxsize=query_cache_size)(self._tokenize_query)
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def signature(self) -> str:
+        """トークン列の互換性を判定するための設定の識別子"""
+        return 'janome:' + (','.join(sorted(self.pos_filter)) if self.pos_filter else 'wakati')
+
+    def tokenize(self, text: str) -> list[str]:
+        """1つのテキストを解析"""
+        if self.pos_filter is None:
+            return list(self._tokenizer.tokenize(text, wakati=True))
+        pos_filter = self.pos_filter
+        return [token.base_form for token in self._tokenizer.tokenize(text)
+                if token.part_of_speech.partition(',')[0] in pos_filter]
+
+    def tokenize_many(self, texts: list[str]) -> list[list[str]]:
+        """複数のテキストを解析（件数が多い場合はプロセスプールで並列化）"""
+        if self.workers <= 1 or len(texts) < self.parallel_threshold:
+            return [self.tokenize(text) for text in texts]
+        chunksize = max(1, len(texts) // (self.workers * 4))
+        pool = self._process_pool()
+        try:
+            return list(pool.map(_tokenize_in_worker, texts, chunksize=chunksize))
+        except BrokenProcessPool:
+            # ワーカーが異常終了したプールは捨て、次の呼び出しで作り直す
+            self._discard_pool(pool)
+            raise
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        """並列解析のプロセスプール（fork したプロセスでは親のプールを使えないため作り直す）"""
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                pos_filter = tuple(self.pos_filter) if self.pos_filter else None
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                 initializer=_init_tokenizer_worker, initargs=(pos_filter,))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _discard_pool(self, pool: ProcessPoolExecutor):
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        """並列解析のプロセスプールを終了する（次に必要になれば作り直す）"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+            owned = self._pool_pid == os.getpid()
+        if pool is not None and owned:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def tokenize_queries(self, texts: list[str]) -> list[tuple[str, ...]]:
+        """複数のクエリを解析（件数が多い場合はキャッシュを通さずプロセスプールで並列化）"""
+        if self.workers <= 1 or len(texts) < self.parallel_threshold:
+            return [self.tokenize_query(text) for text in texts]
+        return [tuple(words) for words in self.tokenize_many(texts)]
+
+    def _tokenize_query(self, text: str) -> tuple[str, ...]:
+        return tuple(self.tokenize(text))
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(pos_filter: tuple[str, ...] | None):
+    """プロセスプールの各ワーカーで形態素解析器を1度だけ作成"""
+    global _worker_tokenizer
+    _worker_tokenizer = JapaneseTokenizer(pos_filter, workers=1)
+
+
+def _tokenize_in_worker(text: str) -> list[str]:
+    return _worker_tokenizer.tokenize(text)
+
+
+class PostingLists:
+    """CSR形式の配列（offsets・doc_ids・freqs）上の転置リスト
+
+    単語番号 i の転置リストは doc_ids[offsets[i]:offsets[i + 1]] で、スライスは元の配列
+    （スナップショットのメモリマップ）を参照するためコピーを作らない。読み取り専用。
+    """
+    def __init__(self, offsets: np.ndarray, doc_ids: np.ndarray, freqs: np.ndarray):
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.freqs = freqs
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id: int) -> tuple[np.ndarray, np.ndarray]:
+        lo, hi = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+        return self.doc_ids[lo:hi], self.freqs[lo:hi]
+
+    def __iter__(self):
+        return (self[term_id] for term_id in range(len(self)))
+
+
+class BM25Index:
+    """転置インデックスによるBM25（Okapi）スコアリング
+
+    単語ごとに(文書番号, 出現回数)のNumPy配列を持ち、クエリ語を含む文書だけを計算する。
+    パラメータとIDFの下限（負のIDFは epsilon * 平均IDF）は rank_bm25.BM25Okapi と同じ。
+    """
+    def __init__(self, tokenized_texts: list[list[str]] = (), k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocabulary = {}
+        self.postings = []
+        self.doc_len = np.empty(0, dtype=np.float32)
+        self.idf = np.empty(0, dtype=np.float64)
+        self.avgdl = 0.0
+        self.add(tokenized_texts)
+
+    @property
+    def corpus_size(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, tokenized_texts: list[list[str]]):
+        """文書を追加し、文書長・転置リスト・IDFを更新"""
+        if not tokenized_texts:
+            return
+        start = self.corpus_size
+        end = start + len(tokenized_texts)
+        vocabulary = self.vocabulary
+        term_ids = np.array([vocabulary.setdefault(word, len(vocabulary)) for words in tokenized_texts for word in words], dtype=np.int64)
+        doc_ids = np.repeat(np.arange(start, end), [len(words) for words in tokenized_texts])
+
+        # (単語, 文書)の組を数え上げ、単語ごとに文書番号順の転置リストにまとめる
+        pairs, freqs = np.unique(term_ids * end + doc_ids, return_counts=True)
+        pair_terms = pairs // end
+        terms, bounds = np.unique(pair_terms, return_index=True)
+        bounds = np.append(bounds, len(pairs))
+
+        empty = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+        self.postings.extend([empty] * (len(vocabulary) - len(self.postings)))
+        for term_id, lo, hi in zip(terms.tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+            old_ids, old_freqs = self.postings[term_id]
+            new_ids = (pairs[lo:hi] % end).astype(np.int32)
+            new_freqs = freqs[lo:hi].astype(np.float32)
+            self.postings[term_id] = (
+                np.concatenate([old_ids, new_ids]) if len(old_ids) else new_ids,
+                np.concatenate([old_freqs, new_freqs]) if len(old_ids) else new_freqs,
+            )
+
+        lengths = np.array([len(words) for words in tokenized_texts], dtype=np.float32)
+        self.doc_len = np.concatenate([self.doc_len, lengths])
+        self.avgdl = float(self.doc_len.sum()) / self.corpus_size
+        self._calc_idf()
+
+    def copy(self) -> 'BM25Index':
+        """元の索引での検索に影響を与えずに更新できる複製（転置リストの配列は共有する）"""
+        clone = copy.copy(self)
+        clone.vocabulary = dict(self.vocabulary)
+        clone.postings = list(self.postings)
+        return clone
+
+    def take(self, rows: np.ndarray) -> 'BM25Index':
+        """rows（昇順）の文書だけを残した索引（文書番号は詰め直し、どの文書にも現れなくなった語は語彙から外す）
+
+        転置リストを絞り込むだけで、トークン列からの再構築と同じスコアになる。
+        """
+        arrays, params = self.to_arrays()
+        remap = np.full(self.corpus_size, -1, dtype=np.int64)
+        remap[rows] = np.arange(len(rows))
+        doc_ids = remap[arrays['bm25_doc_ids']]
+        kept = doc_ids >= 0
+        term_ids = np.repeat(np.arange(len(params['vocabulary'])), np.diff(arrays['bm25_offsets']))[kept]
+        doc_ids, freqs = doc_ids[kept].astype(np.int32), arrays['bm25_freqs'][kept]
+        counts = np.bincount(term_ids, minlength=len(params['vocabulary']))
+        bounds = np.concatenate([[0], np.cumsum(counts[counts > 0])])
+
+        index = BM25Index(k1=self.k1, b=self.b, epsilon=self.epsilon)
+        index.vocabulary = {word: term_id for term_id, word in enumerate(np.array(params['vocabulary'], dtype=object)[counts > 0])}
+        index.postings = [(doc_ids[lo:hi], freqs[lo:hi]) for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        index.doc_len = self.doc_len[rows]
+        index.avgdl = float(index.doc_len.sum()) / index.corpus_size if index.corpus_size else 0.0
+        index._calc_idf()
+        return index
+
+    def to_arrays(self) -> tuple[dict[str, np.ndarray], dict]:
+        """スナップショットに書き出すための (CSR形式の配列, 語彙とパラメータ)"""
+        postings = list(self.postings)
+        lengths = np.array([len(doc_ids) for doc_ids, _ in postings], dtype=np.int64)
+        arrays = {
+            'bm25_offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            'bm25_doc_ids': np.concatenate([doc_ids for doc_ids, _ in postings] or [np.empty(0, dtype=np.int32)]),
+            'bm25_freqs': np.concatenate([freqs for _, freqs in postings] or [np.empty(0, dtype=np.float32)]),
+            'bm25_doc_len': self.doc_len,
+            'bm25_idf': self.idf,
+        }
+        params = {'vocabulary': list(self.vocabulary), 'k1': self.k1, 'b': self.b, 'epsilon': self.epsilon, 'avgdl': self.avgdl}
+        return arrays, params
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray], params: dict) -> 'BM25Index':
+        """to_arrays の結果から復元する（配列はコピーせずそのまま参照する）"""
+        index = cls(k1=params['k1'], b=params['b'], epsilon=params['epsilon'])
+        index.vocabulary = {word: term_id for term_id, word in enumerate(params['vocabulary'])}
+        index.postings = PostingLists(arrays['bm25_offsets'], arrays['bm25_doc_ids'], arrays['bm25_freqs'])
+        index.doc_len = arrays['bm25_doc_len']
+        index.idf = arrays['bm25_idf']
+        index.avgdl = params['avgdl']
+        return index
+
+    def _calc_idf(self):
+        """IDFを語彙全体について計算（文書数が変わると全語のIDFが変わる）"""
+        document_frequency = np.array([len(doc_ids) for doc_ids, _ in self.postings], dtype=np.float64)
+        idf = np.log(self.corpus_size - document_frequency + 0.5) - np.log(document_frequency + 0.5)
+        average_idf = idf.mean() if len(idf) else 0.0
+        idf[idf < 0] = self.epsilon * average_idf
+        self.idf = idf
+
+    def get_sparse_scores(self, query: list[str], allowed: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """クエリ語を含む文書だけの(文書番号, BM25スコア)を文書番号順に返す
+
+        allowed（文書ごとの真偽値）を指定すると、転置リストをその文書に絞り込んでからスコアを計算する。
+        """
+        ids, contributions = [], []
+        for word in query:
+            term_id = self.vocabulary.get(word)
+            if term_id is None:
+                continue
+            doc_ids, freqs = self.postings[term_id]
+            if allowed is not None:
+                kept = allowed[doc_ids]
+                doc_ids, freqs = doc_ids[kept], freqs[kept]
+            if not len(doc_ids):
+                continue
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_ids] / self.avgdl)
+            ids.append(doc_ids)
+            contributions.append(self.idf[term_id] * (freqs * (self.k1 + 1) / (freqs + norm)))
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        unique_ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions), minlength=len(unique_ids))
+        return unique_ids.astype(np.int64), scores
+
+    def get_scores(self, query: list[str]) -> np.ndarray:
+        """全文書のBM25スコア（クエリ語を含まない文書は0）"""
+        scores = np.zeros(self.corpus_size)
+        ids, sparse_scores = self.get_sparse_scores(query)
+        scores[ids] = sparse_scores
+        return scores
+
+
+# 読み込み済みのモデル（同じ設定のモデルはプロセス内で1つだけ持ち、複数ワーカーで起動する場合は
+# 親プロセスで読み込んでからforkすることで、モデルの重みを全ワーカーで共有する）
+_models = {}
+_models_lock = threading.Lock()
+
+
+def load_model(kind: str, model_name: str, **options):
+    """sentence_transformersのモデル（'SentenceTransformer' / 'CrossEncoder'）を読み込む"""
+    key = (kind, model_name, tuple(sorted(options.items())))
+    with _models_lock:
+        if key not in _models:
+            import sentence_transformers
+            _models[key] = getattr(sentence_transformers, kind)(model_name, **options)
+        return _models[key]
+
+
+def preload_models(embedding_options: dict | None = None, reranker_options: dict | None = None):
+    """埋め込み・再ランキングのモデルと形態素解析の辞書を推論せずに読み込んでおく（fork前の親プロセスで呼ぶ）"""
+    # Janomeの辞書はプロセス内で共有されるため、解析器を1度作れば読み込まれる
+    JapaneseTokenizer()
+    Embedder(**(embedding_options or {})).model
+    if reranker_options is not None:
+        Reranker(**reranker_options).model
+
+
+class Embedder:
+    """SentenceTransformerによるチャンク・クエリの埋め込み計算
+
+    e5系のモデルでは "query: " / "passage: " の接頭辞を付ける。L2正規化したベクトルを返すため
+    内積がそのままコサイン類似度になる。コーパスの保存形式は float32 / float16 / int8 から選べる。
+    クエリの埋め込みはLRUキャッシュで再利用する（コーパスに依存しないため無効化は不要）。
+    """
+    DTYPES = ('float32', 'float16', 'int8')
+
+    def __init__(self, model_name: str = 'intfloat/multilingual-e5-base', batch_size: int = 32,
+                 normalize: bool = True, dtype: str = 'float32', query_prefix: str | None = None,
+                 passage_prefix: str | None = None, block_size: int = 1024, query_cache_size: int = 1024):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {dtype} (choose from {', '.join(self.DTYPES)})")
+        is_e5 = 'e5' in model_name.lower()
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.normalize = normalize
+        self.dtype = dtype
+        self.query_prefix = ('query: ' if is_e5 else '') if query_prefix is None else query_prefix
+        self.passage_prefix = ('passage: ' if is_e5 else '') if passage_prefix is None else passage_prefix
+        self.block_size = block_size
+        self.query_cache = LRUCache(query_cache_size)
+        self._model = None
+
+    @property
+    def model(self):
+        """埋め込みモデル（sentence_transformers・torchの読み込みも含め、初回利用時に行う）"""
+        if self._model is None:
+            self._model = load_model('SentenceTransformer', self.model_name)
+        return self._model
+
+    def warm_up(self):
+        """モデルを読み込み、1度推論しておく（最初の質問で読み込みの時間がかからないように）"""
+        self._encode([self.query_prefix + 'ウォームアップ'])
+
+    @property
+    def signature(self) -> str:
+        """埋め込みの互換性を判定するための設定の識別子"""
+        return f"{self.model_name}|{self.passage_prefix}|{'normalized' if self.normalize else 'raw'}"
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        embeddings = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=self.normalize,
+                                       convert_to_numpy=True, show_progress_bar=False)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    @property
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def iter_passages(self, texts: list[str]):
+        """チャンクの埋め込みを block_size 件ずつ (textsでの位置, 埋め込み) として返すジェネレータ
+
+        長さ順に並べてバッチ内のパディングを減らす。呼び出し側がブロックごとに保存形式へ変換すれば、
+        float32の埋め込み行列全体を持たずに済む。
+        """
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        for start in range(0, len(order), self.block_size):
+            block = order[start:start + self.block_size]
+            yield block, self._encode([self.passage_prefix + texts[i] for i in block])
+
+    def encode_passages(self, texts: list[str]) -> np.ndarray:
+        """チャンクの埋め込み"""
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for block, encoded in self.iter_passages(texts):
+            embeddings[block] = encoded
+        return embeddings
+
+    def encode_query(self, text: str) -> np.ndarray:
+        """クエリの埋め込み（キャッシュ済みのものは読み取り専用の配列を共有する）"""
+        embedding = self.query_cache.get(text)
+        if embedding is None:
+            embedding = self._encode([self.query_prefix + text])[0]
+            embedding.setflags(write=False)
+            self.query_cache.put(text, embedding)
+        return embedding
+
+    def encode_queries(self, texts: list[str]) -> np.ndarray:
+        """複数クエリの埋め込み行列（キャッシュにないクエリだけを1回のバッチで計算）"""
+        cached = [self.query_cache.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, cached) if embedding is None))
+        encoded = {}
+        if missing:
+            embeddings = self._encode([self.query_prefix + text for text in missing])
+            embeddings.setflags(write=False)
+            for text, embedding in zip(missing, embeddings):
+                encoded[text] = embedding
+                self.query_cache.put(text, embedding)
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.stack([encoded[text] if embedding is None else embedding for text, embedding in zip(texts, cached)])
+
+    def quantize(self, embeddings: np.ndarray, scale: float | None = None) -> tuple[np.ndarray, float]:
+        """保存形式に変換し、(変換後の行列, 刻み幅)を返す
+
+        int8では コーパス全体で共通の刻み幅 scale を使い、元のベクトルは 行列 * scale で近似される。
+        scaleを省略すると行列の最大絶対値から決め、scaleに収まらない値がある場合は切り詰めずに刻み幅を広げる
+        （広げた刻み幅を返すため、同じコーパスの量子化済みの行は呼び出し側が requantize で合わせる）。
+        float32 / float16 では scale は常に1。
+        """
+        if self.dtype != 'int8':
+            return embeddings.astype(self.dtype, copy=False), 1.0
+        max_abs = float(np.abs(embeddings).max()) if embeddings.size else 0.0
+        if scale is None or max_abs > 127 * scale:
+            scale = max_abs / 127 if max_abs > 0 else (scale or 1.0)
+        return np.clip(np.rint(embeddings / scale), -127, 127).astype(np.int8), scale
+
+    def requantize(self, embeddings: np.ndarray, scale: float, new_scale: float, out: np.ndarray | None = None) -> np.ndarray:
+        """刻み幅 scale でint8に量子化した行列を new_scale の刻み幅に変換（block_size 行ずつ計算して out に書く）"""
+        out = np.empty(embeddings.shape, dtype=np.int8) if out is None else out
+        for start in range(0, len(embeddings), self.block_size):
+            block = np.asarray(embeddings[start:start + self.block_size], dtype=np.float32)
+            out[start:start + len(block)] = np.rint(block * (scale / new_scale))
+        return out
+
+
+class Reranker:
+    """CrossEncoderによる検索結果の並べ替え（2段階目の検索）
+
+    ハイブリッド検索の上位 candidates 件を (クエリ, チャンク) の組にして batch_size 件ずつCPUで推論する。
+    budget_ms を指定すると、次のバッチが予算内に終わらない見込みになった時点で推論を打ち切り、
+    残りの候補はハイブリッド検索の順位のまま後ろに並べる。
+    """
+    def __init__(self, model_name: str = 'hotchpotch/japanese-reranker-cross-encoder-xsmall-v1', candidates: int = 20,
+                 batch_size: int = 8, max_length: int = 512, budget_ms: float | None = None, device: str = 'cpu'):
+        self.model_name = model_name
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.budget_ms = budget_ms
+        self.device = device
+        self.reranked = 0
+        self.fallbacks = 0
+        self._batch_seconds = 0.0
+        self._model = None
+
+    @property
+    def model(self):
+        """並べ替えモデル（初回利用時に読み込む）"""
+        if self._model is None:
+            self._model = load_model('CrossEncoder', self.model_name, device=self.device, max_length=self.max_length)
+        return self._model
+
+    def warm_up(self):
+        """モデルを読み込み、1度推論しておく"""
+        self.model.predict([('ウォームアップ', 'ウォームアップ')], batch_size=1, show_progress_bar=False)
+
+    def rerank(self, query: str, results: list[ChunkView], top_k: int, budget_ms: float | None = None) -> list[ChunkView]:
+        """検索結果を並べ替えて上位top_k件を返す（推論できた結果には 'rerank_score' を付ける）"""
+        model = self.model
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        deadline = None if budget_ms is None else time.perf_counter() + budget_ms / 1000
+        scores = []
+        for start in range(0, len(results), self.batch_size):
+            if deadline is not None and time.perf_counter() + self._batch_seconds > deadline:
+                # 1回の遅いバッチで推定値が予算を超えたままにならないよう、打ち切るたびに減衰させる
+                self._batch_seconds /= 2
+                break
+            batch_started = time.perf_counter()
+            batch = results[start:start + self.batch_size]
+            scores.extend(model.predict([(query, item['text']) for item in batch],
+                                        batch_size=self.batch_size, show_progress_bar=False))
+            elapsed = time.perf_counter() - batch_started
+            self._batch_seconds = 0.8 * self._batch_seconds + 0.2 * elapsed if self._batch_seconds else elapsed
+
+        self.reranked += 1
+        if len(scores) < len(results):
+            self.fallbacks += 1
+        reranked = [item.with_rerank_score(float(score)) for item, score in zip(results, scores)]
+        reranked.sort(key=lambda item: item.rerank_score, reverse=True)
+        return (reranked + results[len(scores):])[:top_k]
+
+
+# 検索結果のキャッシュのキーに使うコーパスのバージョン（複製間でも重複しないよう全体で採番する）
+_corpus_versions = itertools.count(1)
 
 
 class HybridRetriever:
-    """ベクトル検索とBM25を組み合わせたハイブリッド検索"""
-    def __init__(self, texts: list[str], metadata: list[dict] = list()):
-        self.tokenizer = Tokenizer()
-        self.texts = texts
-        self.metadata = metadata if metadata else [{}] * len(texts)
-
-        # Janomeを用いたテキストの形態素解析
-        self.tokenized_texts = []
-        for text in self.texts:
-            tokens = self.tokenizer.tokenize(text)
-            words = [token.base_form for token in tokens if token.part_of_speech.split(',')[0] in ['名詞', '動詞', '形容詞', '副詞']]
-            self.tokenized_texts.append(words)
+    """ベクトル検索とBM25を組み合わせたハイブリッド検索
+
+    検索結果は (クエリ, top_k, alpha, コーパスのバージョン) をキーにLRUキャッシュで再利用する。
+    チャンクを追加・削除するとバージョンが変わり、以前の結果は使われなくなる。
+    スコアの統合方式は fusion（linear / minmax / zscore / rrf）で選び、candidates を指定すると
+    ベクトル検索とBM25はそれぞれ上位candidates件だけを候補として返す（省略時は該当する全チャンク）。
+    チャンクの本文・メタデータは列ごとの配列（ChunkStore）に持ち、検索結果はそれを参照する ChunkView で返す。
+    トークン列はBM25の構築にだけ使い、メモリには残さない（永続化インデックスには保存する）。
+    """
+    def __init__(self, texts: list[str], metadata: list[dict] = list(),
+                 embedding_model: str = 'intfloat/multilingual-e5-base', index_dir: str | None = None,
+                 vector_index: str = 'flat', vector_index_options: dict | None = None,
+                 tokenizer: JapaneseTokenizer | None = None, embedder: Embedder | None = None,
+                 result_cache_size: int = 1024, fusion: str = 'linear', fusion_options: dict | None = None,
+                 candidates: int | None = None):
+        self._configure(tokenizer or JapaneseTokenizer(), embedder or Embedder(embedding_model),
+                        result_cache_size, fusion, fusion_options, candidates)
+        keys = self._chunk_keys(texts)
+        self.chunks = ChunkStore()
+        self.chunks.append(texts, metadata, keys)
+
+        # 永続化インデックスから変更のないチャンクのトークン列・埋め込みを復元
+        self.store = IndexStore(index_dir, self.embedder.signature, self.tokenizer.signature, self.embedder.dtype) if index_dir else None
+        cached = self.store.load() if self.store else None
+        self.embedding_scale = cached['scale'] if cached and cached['embeddings'] is not None else None
+        if cached and cached['tokens'] is not None and cached['embeddings'] is not None and np.array_equal(keys, cached['keys']):
+            tokenized_texts = cached['tokens']
+            self.embeddings = cached['embeddings']
+        else:
+            tokenized_texts, self.embeddings = self._encode_chunks(texts, keys, cached)
+            if self.store:
+                self.store.save(keys, tokenized_texts, self.embeddings, self.embedding_scale)
+        self._capacity = len(texts)
+
+        # ベクトル索引の構築（flat: 厳密検索、ivf: 近似最近傍検索）
+        self.vector_index = create_vector_index(vector_index, **(vector_index_options or {}))
+        self.vector_index.build(self.embeddings)
 
         # BM25の初期化
-        self.bm25 = BM25Okapi(self.tokenized_texts)
-
-        # Embedding modelの初期化
-        self.model = SentenceTransformer('intfloat/multilingual-e5-base')
-        self.embeddings = self.model.encode(texts)
-
-    def retrieve(self, query: str, top_k: int = 1, alpha: float = 0.5) -> list[dict]:
-        # ベクトルの類似度スコアの計算
-        query_embedding = self.model.encode(query)
-        vector_scores = np.dot(self.embeddings, query_embedding)
-        max_vector_score = max(vector_scores) if any(vector_scores) else 1.0
-        normalized_vector_scores = vector_scores / max_vector_score if max_vector_score > 0 else vector_scores
-
-        # BM25スコアの計算
-        query_tokens = self.tokenizer.tokenize(query)
-        query_words = [token.base_form for token in query_tokens
-                       if token.part_of_speech.split(',')[0] in ['名詞', '動詞', '形容詞', '副詞']]
-        bm25_scores = self.bm25.get_scores(query_words)
-        max_bm25_score = max(bm25_scores) if any(bm25_scores) else 1.0
-        normalized_bm25_scores = bm25_scores / max_bm25_score if max_bm25_score > 0 else bm25_scores
-
-        # スコアの組み合わせ
-        combined_scores = alpha * normalized_vector_scores + (1 - alpha) * normalized_bm25_scores
-
-        # 上位k件の結果を返す（スコアの高い順）
-        top_indices = np.argsort(combined_scores)[-top_k:][::-1]
+        self.bm25 = BM25Index(tokenized_texts)
+
+    def _configure(self, tokenizer: JapaneseTokenizer, embedder: Embedder, result_cache_size: int,
+                   fusion: str, fusion_options: dict | None, candidates: int | None):
+        """コーパスに依存しない設定（解析器・埋め込み・スコアの統合方式・結果キャッシュ）"""
+        self.tokenizer = tokenizer
+        self.embedder = embedder
+        self.fusion = create_fusion(fusion, **(fusion_options or {}))
+        self.candidates = candidates
+        self.version = next(_corpus_versions)
+        self.result_cache = LRUCache(result_cache_size)
+
+    def _chunk_keys(self, texts: list[str]) -> np.ndarray:
+        """チャンクのキー（IndexStore.chunk_key）の固定長バイト列の配列"""
+        signature = self.embedder.signature
+        return np.array([IndexStore.chunk_key(text, signature) for text in texts], dtype=ChunkStore.KEY_DTYPE)
+
+    def to_snapshot(self) -> tuple[dict[str, np.ndarray], dict]:
+        """SnapshotStore.publish に渡す (配列, manifest)"""
+        arrays, bm25 = self.bm25.to_arrays()
+        chunk_arrays, categories = self.chunks.to_arrays()
+        arrays.update(chunk_arrays, embeddings=np.asarray(self.embeddings))
+        return arrays, {'embedding_scale': self.embedding_scale, 'bm25': bm25, 'chunks': categories}
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict, vector_index: str = 'flat', vector_index_options: dict | None = None,
+                      tokenizer: JapaneseTokenizer | None = None, embedder: Embedder | None = None,
+                      result_cache_size: int = 1024, fusion: str = 'linear', fusion_options: dict | None = None,
+                      candidates: int | None = None) -> 'HybridRetriever':
+        """SnapshotStore.load で読み込んだ版から検索専用の索引を作る
+
+        チャンクの本文・メタデータ、埋め込み行列、BM25の配列はメモリマップをそのまま参照する。
+        チャンクの追加・削除はできない（更新はスナップショットを作り直して行う）。
+        """
+        retriever = cls.__new__(cls)
+        retriever._configure(tokenizer or JapaneseTokenizer(), embedder or Embedder(),
+                             result_cache_size, fusion, fusion_options, candidates)
+        manifest, arrays = snapshot['manifest'], snapshot['arrays']
+        retriever.chunks = ChunkStore.from_arrays(arrays, manifest['chunks'])
+        retriever.store = None
+        retriever.embedding_scale = manifest['embedding_scale']
+        retriever.embeddings = arrays['embeddings']
+        retriever._capacity = len(retriever.chunks)
+        retriever.vector_index = create_vector_index(vector_index, **(vector_index_options or {}))
+        retriever.vector_index.build(retriever.embeddings)
+        retriever.bm25 = BM25Index.from_arrays(arrays, manifest['bm25'])
+        return retriever
+
+    def _encode_chunks(self, texts: list[str], keys: np.ndarray, cached: dict | None = None) -> tuple[list[list[str]], np.ndarray]:
+        """チャンクのトークン列と埋め込みを計算（キャッシュにあるものは再利用）"""
+        keys = keys.tolist()
+        cached_rows = {key: row for row, key in enumerate(cached['keys'].tolist())} if cached else {}
+        missing = [i for i, key in enumerate(keys) if key not in cached_rows]
+
+        # Janomeを用いたテキストの形態素解析（キャッシュにないチャンクのみ、件数が多ければ並列）
+        if cached and cached['tokens'] is not None:
+            tokenized_texts = [cached['tokens'][cached_rows[key]] if key in cached_rows else None for key in keys]
+            untokenized = missing
+        else:
+            tokenized_texts = [None] * len(texts)
+            untokenized = range(len(texts))
+        for i, words in zip(untokenized, self.tokenizer.tokenize_many([texts[i] for i in untokenized])):
+            tokenized_texts[i] = words
+
+        # 埋め込みの計算（キャッシュにないチャンクのみ）。ブロックごとに保存形式へ変換して書き込み、
+        # float32の行列全体は持たない（int8の刻み幅が後のブロックで広がった場合は書き込み済みの行を量子化し直す）
+        if not (cached and cached['embeddings'] is not None):
+            cached_rows, missing = {}, list(range(len(texts)))
+        dim = cached['embeddings'].shape[1] if cached_rows else self.embedder.dimension
+        embeddings = np.empty((len(texts), dim), dtype=self.embedder.dtype)
+        for i, key in enumerate(keys):
+            if key in cached_rows:
+                embeddings[i] = cached['embeddings'][cached_rows[key]]
+        missing = np.asarray(missing, dtype=np.int64)
+        for block, encoded in self.embedder.iter_passages([texts[i] for i in missing]):
+            scale = self.embedding_scale
+            quantized, self.embedding_scale = self.embedder.quantize(encoded, scale)
+            if scale is not None and self.embedding_scale != scale:
+                # 未書き込みの行も変換されるが、後のブロックで上書きされる
+                self.embedder.requantize(embeddings, scale, self.embedding_scale, out=embeddings)
+            embeddings[missing[block]] = quantized
+        return tokenized_texts, embeddings
+
+    def add_documents(self, texts: list[str], metadata: list[dict] = list()):
+        """チャンクを追加し、新しいチャンクだけを解析・埋め込みしてインデックスを更新"""
+        if not texts:
+            return
+        keys = self._chunk_keys(texts)
+        scale = self.embedding_scale
+        tokenized_texts, embeddings = self._encode_chunks(texts, keys)
+        size = len(self.chunks)
+        # int8の刻み幅が広がった場合は既存の行も量子化し直す
+        rescaled = size > 0 and scale is not None and self.embedding_scale != scale
+
+        # 埋め込み行列は容量を倍々に確保して追記し、毎回の全体コピーを避ける
+        # （量子化し直す場合、元の行列は検索中のスナップショットが参照しているため新しい領域に書く）
+        if size + len(texts) > self._capacity or isinstance(self.embeddings, np.memmap) or rescaled:
+            if size + len(texts) > self._capacity:
+                self._capacity = max(size + len(texts), 2 * self._capacity)
+            buffer = np.empty((self._capacity, self.embeddings.shape[1]), dtype=self.embeddings.dtype)
+            if rescaled:
+                self.embedder.requantize(self.embeddings, scale, self.embedding_scale, out=buffer[:size])
+            else:
+                buffer[:size] = self.embeddings
+            self._embedding_buffer = buffer
+        self._embedding_buffer[size:size + len(texts)] = embeddings
+        self.embeddings = self._embedding_buffer[:size + len(texts)]
+        if rescaled:
+            self.vector_index.build(self.embeddings)
+        else:
+            self.vector_index.add(self.embeddings)
+
+        self.chunks.append(texts, metadata, keys)
+        self.bm25.add(tokenized_texts)
+
+        if self.store:
+            if rescaled:
+                self.store.rescale(self.embedding_scale)
+            self.store.append(keys, tokenized_texts, embeddings)
+        self.version = next(_corpus_versions)
+
+    def copy(self) -> 'HybridRetriever':
+        """検索中のスナップショットに影響を与えずに更新できる複製
+
+        索引の入れ物だけを複製し、チャンクの列・埋め込み行列・転置リストの配列は共有する。
+        チャンクと埋め込みの追記は元のスナップショットからは見えない行にだけ書き込まれる。
+        """
+        clone = copy.copy(self)
+        clone.chunks = self.chunks.copy()
+        clone.vector_index = self.vector_index.copy()
+        clone.bm25 = self.bm25.copy()
+        return clone
+
+    def remove_documents(self, keys: list[str]):
+        """指定したキー（IndexStore.chunk_key）のチャンクを削除し、インデックスを詰め直す"""
+        keep = np.flatnonzero(~np.isin(self.chunks.keys, np.array(keys, dtype=ChunkStore.KEY_DTYPE)))
+        if len(keep) == len(self.chunks):
+            return
+
+        self.chunks = self.chunks.take(keep)
+        self.embeddings = np.asarray(self.embeddings)[keep]
+        self._capacity = len(keep)
+        self.vector_index.build(self.embeddings)
+
+        # BM25は転置リストを絞り込み、永続化インデックスは残す行だけを書き直す（形態素解析・埋め込みは不要）
+        self.bm25 = self.bm25.take(keep)
+        if self.store:
+            self.store.compact(keep)
+        self.version = next(_corpus_versions)
+
+    def retrieve(self, query: str, top_k: int = 1, alpha: float = 0.5, query_embedding: np.ndarray | None = None,
+                 timings: Timings | None = None, filters: dict | None = None) -> list[ChunkView]:
+        """クエリに近いチャンクを返す
+
+        計算済みのクエリの埋め込みがあれば query_embedding に渡す。段階ごとの処理時間は timings に記録する。
+        filters（例: {'chapter': '第2章', 'source': ['a.jsonl', 'b.jsonl']}）を指定すると、章・節・ファイル名の
+        行番号の索引で対象のチャンクを先に絞り込み、ベクトル検索とBM25はそのチャンクだけをスコアリングする。
+        """
+        cache_key = (query, top_k, alpha, self.version, filter_key(filters))
+        cached = self.result_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+        timings = timings or Timings()
+        with timings.stage('filter'):
+            rows = self.chunks.select(filters)
+
+        # ベクトルの類似度スコアの計算（近似索引では候補に挙がったチャンクのみ）
+        # int8で保存した場合は刻み幅をクエリ側に掛けてコサイン類似度の尺度に戻す
+        if query_embedding is None:
+            with timings.stage('query_embedding'):
+                query_embedding = self.embedder.encode_query(query)
+        with timings.stage('vector_search'):
+            vector_ids, vector_scores = self.vector_index.search(query_embedding * (self.embedding_scale or 1.0), self.candidates, rows)
+
+        # BM25スコアの計算（クエリ語を含むチャンクのみ）
+        with timings.stage('tokenize'):
+            query_words = self.tokenizer.tokenize_query(query)
+        with timings.stage('bm25'):
+            bm25_ids, bm25_scores = self._bm25_candidates(query_words, rows)
+
+        with timings.stage('fusion'):
+            results = self._fuse(vector_ids, vector_scores, bm25_ids, bm25_scores, top_k, alpha)
+        self.result_cache.put(cache_key, tuple(results))
+        return results
+
+    def retrieve_batch(self, queries: list[str], top_k: int = 1, alpha: float = 0.5,
+                       query_embeddings: np.ndarray | None = None, batch_size: int = 64,
+                       timings: Timings | None = None, filters: dict | None = None) -> list[list[ChunkView]]:
+        """複数クエリの検索結果を返す
+
+        埋め込みはまとめて1回のバッチで計算し、ベクトルのスコアは batch_size 件ずつ
+        (クエリ数, 次元数) の行列とコーパスの行列積で求める。形態素解析は件数が多ければ並列化する。
+        filters は全クエリに共通の絞り込み条件（retrieve と同じ）。
+        """
+        cache_keys = [(query, top_k, alpha, self.version, filter_key(filters)) for query in queries]
         results = []
-        for idx in top_indices:
-            result = {
-                'text': self.texts[idx],
-                'score': float(combined_scores[idx]),
-                'vector_score': float(normalized_vector_scores[idx]),
-                'bm25_score': float(normalized_bm25_scores[idx]),
-                **self.metadata[idx]
-            }
-            results.append(result)
+        for cache_key in cache_keys:
+            cached = self.result_cache.get(cache_key)
+            results.append(None if cached is None else list(cached))
+        # 同じクエリが複数回含まれる場合は最初の1件だけを計算する
+        first = {}
+        for i, result in enumerate(results):
+            if result is None:
+                first.setdefault(queries[i], i)
+        pending = list(first.values())
+        if not pending:
+            return results
+        timings = timings or Timings()
+        with timings.stage('filter'):
+            rows = self.chunks.select(filters)
+
+        if query_embeddings is None:
+            with timings.stage('query_embedding'):
+                query_embeddings = self.embedder.encode_queries([queries[i] for i in pending])
+        else:
+            query_embeddings = np.asarray(query_embeddings)[pending]
+        with timings.stage('tokenize'):
+            query_words = self.tokenizer.tokenize_queries([queries[i] for i in pending])
+        for start in range(0, len(pending), batch_size):
+            block = pending[start:start + batch_size]
+            with timings.stage('vector_search'):
+                vector_results = self.vector_index.search_batch(query_embeddings[start:start + batch_size] * (self.embedding_scale or 1.0), self.candidates, rows)
+            for i, (vector_ids, vector_scores), words in zip(block, vector_results, query_words[start:start + batch_size]):
+                with timings.stage('bm25'):
+                    bm25_ids, bm25_scores = self._bm25_candidates(words, rows)
+                with timings.stage('fusion'):
+                    results[i] = self._fuse(vector_ids, vector_scores, bm25_ids, bm25_scores, top_k, alpha)
+                self.result_cache.put(cache_keys[i], tuple(results[i]))
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = list(results[first[queries[i]]])
+        return results
+
+    def _bm25_candidates(self, query_words: tuple[str, ...], rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """BM25の候補（candidatesを指定した場合は上位candidates件、rowsを指定した場合はそのチャンクのみ）を文書番号順に返す"""
+        allowed = None
+        if rows is not None:
+            allowed = np.zeros(len(self.chunks), dtype=bool)
+            allowed[rows] = True
+        ids, scores = self.bm25.get_sparse_scores(query_words, allowed)
+        if self.candidates is not None and len(ids) > self.candidates:
+            top = np.sort(top_k_indices(scores, self.candidates))
+            ids, scores = ids[top], scores[top]
+        return ids, scores
+
+    def _fuse(self, vector_ids: np.ndarray, vector_scores: np.ndarray, bm25_ids: np.ndarray, bm25_scores: np.ndarray,
+              top_k: int, alpha: float) -> list[ChunkView]:
+        """ベクトル検索とBM25の候補のスコアを組み合わせ、上位top_k件の結果を返す"""
+        candidate_ids, combined_scores, normalized_vector_scores, normalized_bm25_scores = self.fusion(
+            vector_ids, vector_scores, bm25_ids, bm25_scores, alpha
+        )
+
+        # 上位k件の結果を返す（スコアの高い順）。本文・メタデータは複製せずチャンクの表を参照する
+        top_indices = top_k_indices(combined_scores, top_k)
+        results = [
+            ChunkView(self.chunks, int(candidate_ids[idx]), float(combined_scores[idx]),
+                      float(normalized_vector_scores[idx]), float(normalized_bm25_scores[idx]))
+            for idx in top_indices
+        ]
 
         # スコアの高い順にソート
-        results.sort(key=lambda x: x['score'], reverse=True)
+        results.sort(key=lambda result: result.score, reverse=True)
         return results
 
 
+def _batched(items: Iterable, size: int):
+    """リストやジェネレータを size 件ずつのリストに分けて返すジェネレータ"""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
 class RAGSystem:
-    def __init__(self, data_dir="knowledge_base", model_name="mistral"):
+    # アップロード結果に含める、読み込めなかった行の件数の上限
+    MAX_REPORTED_ERRORS = 100
+    # 絞り込み条件に一致するチャンクがない場合の回答（根拠のない回答を生成しない）
+    NO_MATCH_ANSWER = "エラー: 絞り込み条件に一致するチャンクがありません。条件を見直してください。"
+
+    def __init__(self, data_dir="knowledge_base", model_name="mistral", index_dir=None,
+                 vector_index="flat", vector_index_options=None, tokenizer_options=None, embedding_options=None,
+                 answer_cache_options=None, fusion="linear", fusion_options=None, candidates=None,
+                 top_k=3, reranker_options=None, context_options=None, llm_backend="ollama", llm_options=None,
+                 snapshot_dir=None, ingest_batch_size=2048, components=None):
         # データディレクトリの作成（存在しない場合）
         os.makedirs(data_dir, exist_ok=True)
         self.data_dir = data_dir
         self.model_name = model_name
+        # 永続化インデックスはナレッジベースと同じ階層に置く（例: knowledge_base_index/）
+        self.index_dir = index_dir or f"{os.path.normpath(data_dir)}_index"
+        self.vector_index = vector_index
+        self.vector_index_options = vector_index_options
+        self.fusion = fusion
+        self.fusion_options = fusion_options
+        self.candidates = candidates
+        self.top_k = top_k
+        # 文書の追加時に1度に解析・埋め込みする件数（作業用のメモリの上限を決める）
+        self.ingest_batch_size = ingest_batch_size
+        # 複数のナレッジベースで共有する形態素解析・埋め込み・再ランキング・生成（components()の結果）
+        components = components or {}
+        self.tokenizer = components.get('tokenizer') or JapaneseTokenizer(**(tokenizer_options or {}))
+        self.embedder = components.get('embedder') or Embedder(**(embedding_options or {}))
+        # 再ランキング（reranker_optionsを指定した場合のみ、例: {} で既定のモデル）
+        if 'reranker' in components:
+            self.reranker = components['reranker']
+        else:
+            self.reranker = Reranker(**reranker_options) if reranker_options is not None else None
+        # プロンプトに入れるコンテキストの組み立て（トークン数の上限つき）
+        self.context_builder = ContextBuilder(**(context_options or {}))
+        # 回答キャッシュ（ナレッジベースが更新されるたびに corpus_version が進み、古い回答は使われない）
+        self.answer_cache = AnswerCache(**(answer_cache_options or {}))
+        self.corpus_version = 0
+        # 回答の生成（"ollama" または負荷試験用の "fake"。llm_optionsで並列数・期限・再試行を指定）
+        self.llm = components.get('llm') or create_llm_backend(llm_backend, model=model_name, **(llm_options or {}))
+        # 複数ワーカーで索引を共有する場合のスナップショット（snapshot_dirを指定した場合のみ）
+        self.snapshots = SnapshotStore(snapshot_dir) if snapshot_dir else None
+        self.snapshot_version = None
+        self._snapshot_lock = threading.RLock()
 
         # 検索システムの初期化
-        self.documents = []
+        self.document_count = 0
         self.retriever = None
+        self._reset_registry()
         self.initialize_system()
 
+    def components(self) -> dict:
+        """コーパスに依存しない部品（形態素解析・埋め込み・再ランキング・生成）。別のRAGSystemの components に渡して共有する
+
+        モデルやクエリのキャッシュ、生成の同時実行数の上限を、ナレッジベースごとに持たずに済む。
+        """
+        return {'tokenizer': self.tokenizer, 'embedder': self.embedder, 'reranker': self.reranker, 'llm': self.llm}
+
+    def _reset_registry(self):
+        """重複排除用の索引（文書キー → チャンクのキー・本文ハッシュ・その文書を含むファイル名）を初期化
+
+        文書の本文やメタデータは検索システムのチャンクの表にだけ持ち、ここには持たない。
+        """
+        self._chunk_key_by_key = {}
+        self._hash_by_key = {}
+        self._key_by_hash = {}
+        self._source_by_key = {}
+
     def initialize_system(self):
         """システムの初期化"""
-        if os.path.exists(self.data_dir) and any(os.scandir(self.data_dir)):
-            # ドキュメントの読み込み
-            self.documents = []
-            for file in os.listdir(self.data_dir):
-                file_path = os.path.join(self.data_dir, file)
-                if os.path.isfile(file_path):
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        for line in f:
-                            try:
-                                doc = json.loads(line.strip())
-                                self.documents.append(doc)
-                            except json.JSONDecodeError:
-                                continue
-
-            # 検索システムの初期化
-            if self.documents:
-                self.retriever = HybridRetriever(
-                    texts=[doc['text'] for doc in self.documents],
-                    metadata=[
-                        {
-                            'id': doc.get('id', ''),
-                            'chapter': doc.get('chapter', ''),
-                            'section': doc.get('section', '')
-                        }
-                        for doc in self.documents
-                    ]
-                )
+        if self.snapshots:
+            self._initialize_from_snapshot()
+        else:
+            self._load_knowledge_base()
+
+    def _knowledge_base_files(self) -> list[os.DirEntry]:
+        """ナレッジベースのファイル（アップロード途中の隠しファイルは除く）"""
+        return [entry for entry in os.scandir(self.data_dir) if entry.is_file() and not entry.name.startswith('.')]
+
+    def _load_knowledge_base(self) -> dict[str, dict]:
+        """ナレッジベースのファイルをすべて読み込んで検索システムを構築し、ファイルごとの読み込み結果を返す"""
+        files = self._knowledge_base_files() if os.path.exists(self.data_dir) else []
+        reports = {}
+        if files:
+            # ドキュメントの読み込み（更新日時の古い順に読み、後から追加された文書で置き換える）
+            # 1度目は文書キーと本文のハッシュだけで重複を除き、各文書をどのファイルから使うかを決める
+            self._reset_registry()
+            files = sorted(files, key=lambda entry: (entry.stat().st_mtime, entry.path))
+            owners = {}
+            for entry in files:
+                reports[entry.name] = {}
+                added, _ = self._register(self._iter_documents(entry.path, reports[entry.name]), entry.name)
+                owners.update((key, entry.name) for key in added)
+            added_by_file = {entry.name: {} for entry in files}
+            for key, name in owners.items():
+                if key in self._hash_by_key:
+                    added_by_file[name][key] = self._hash_by_key[key]
+
+            # 2度目は使う文書だけを読み直し、本文とメタデータだけを持つ（元の文書の辞書は持たない）
+            texts, metadata = [], []
+            for entry in files:
+                for doc in self._iter_added(entry.path, added_by_file[entry.name]):
+                    texts.append(doc['text'])
+                    metadata.append(self._metadata(doc, entry.name))
+
+            # 検索システムの初期化（構築が終わってから差し替える）
+            self._publish(self._build_retriever(texts, metadata) if texts else None, len(texts))
+        return reports
+
+    def _publish(self, retriever: HybridRetriever | None, document_count: int):
+        """新しいスナップショットに差し替える
+
+        検索側は self.retriever を1度だけ参照するため、代入の時点で新旧が原子的に切り替わる。
+        バージョンは差し替えの後に進めるため、新しいバージョンを読んだ検索は必ず新しい索引を使う。
+        """
+        self.document_count = document_count
+        self.retriever = retriever
+        self.corpus_version += 1
+        self.answer_cache.invalidate()
+
+    def _snapshot_identity(self) -> dict:
+        """スナップショットを使い回せるかの判定に使う値（ナレッジベースのファイル一覧と埋め込み・解析の設定）"""
+        files = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in self._knowledge_base_files())
+        return {
+            'knowledge_base': hashlib.sha256(json.dumps(files).encode('utf-8')).hexdigest(),
+            'embedder': self.embedder.signature,
+            'tokenizer': self.tokenizer.signature,
+            'dtype': self.embedder.dtype,
+        }
+
+    def _snapshot_matches(self, version: str | None) -> bool:
+        manifest = self.snapshots.manifest(version) if version else None
+        return manifest is not None and all(manifest.get(key) == value for key, value in self._snapshot_identity().items())
+
+    def _initialize_from_snapshot(self):
+        """最新のスナップショットを読み込む（ナレッジベースや設定と合わない場合は作り直して公開する）"""
+        version = self.snapshots.current()
+        if not self._snapshot_matches(version):
+            with self.snapshots.lock():
+                # ロックを待つ間に他のワーカーが作り直していればそれを使う
+                version = self.snapshots.current()
+                if not self._snapshot_matches(version):
+                    version, _ = self._publish_snapshot()
+        self._use_snapshot(version)
+
+    def _publish_snapshot(self) -> tuple[str, dict[str, dict]]:
+        """ナレッジベース全体から検索システムを構築して新しい版として公開し、(版, ファイルごとの読み込み結果)を返す
+
+        変更のないチャンクのトークン列・埋め込みは永続化インデックスから再利用する。SnapshotStore.lock() の中で呼ぶ。
+        """
+        reports = self._load_knowledge_base()
+        arrays, manifest = self.retriever.to_snapshot() if self.retriever else ({}, {})
+        version = self.snapshots.publish(arrays, {**manifest, **self._snapshot_identity(), 'documents': self.document_count})
+        return version, reports
+
+    def _use_snapshot(self, version: str):
+        """スナップショットの版に切り替える（文書の一覧や重複排除用の索引はメモリに持たない）"""
+        with self._snapshot_lock:
+            snapshot = self.snapshots.load(version)
+            if snapshot is None:
+                raise RuntimeError(f"Snapshot {version} could not be loaded")
+            retriever = HybridRetriever.from_snapshot(
+                snapshot,
+                vector_index=self.vector_index,
+                vector_index_options=self.vector_index_options,
+                tokenizer=self.tokenizer,
+                embedder=self.embedder,
+                fusion=self.fusion,
+                fusion_options=self.fusion_options,
+                candidates=self.candidates
+            ) if snapshot['arrays'] else None
+            self._reset_registry()
+            self._publish(retriever, snapshot['manifest']['documents'])
+            self.snapshot_version = version
+
+    def refresh_snapshot(self) -> bool:
+        """他のワーカーが新しい版を公開していれば切り替え、切り替えたかどうかを返す"""
+        if not self.snapshots:
+            return False
+        with self._snapshot_lock:
+            version = self.snapshots.current()
+            if version is None or version == self.snapshot_version:
+                return False
+            self._use_snapshot(version)
+            return True
 
-    def add_document(self, file_path):
-        """新しい文書をナレッジベースに追加"""
-        filename = os.path.basename(file_path)
+    def _build_retriever(self, texts: list[str], metadata: list[dict]) -> HybridRetriever:
+        """チャンクの本文とメタデータ（_metadata）の一覧から検索システムを構築"""
+        return HybridRetriever(
+            texts=texts,
+            metadata=metadata,
+            index_dir=self.index_dir,
+            vector_index=self.vector_index,
+            vector_index_options=self.vector_index_options,
+            tokenizer=self.tokenizer,
+            embedder=self.embedder,
+            fusion=self.fusion,
+            fusion_options=self.fusion_options,
+            candidates=self.candidates
+        )
+
+    def _register(self, documents: Iterable[dict], source: str, unseen: set | None = None) -> tuple[dict[str, str], list[str]]:
+        """IDと正規化本文のハッシュで重複を除いて登録し、({追加した文書のキー: 本文のハッシュ}, 置き換えられたチャンクのキー)を返す
+
+        同じIDの文書は新しい内容で置き換え、別のIDでも本文が同じ文書は追加しない。
+        1つのファイル内でIDが重複している場合は別のチャンクとして本文のハッシュで区別する。
+        documents は1度だけ順に読み（ジェネレータでよい）、文書そのものは持たない（追加した文書は _iter_added で読み直す）。
+        unseen を渡すと、読んだ文書のキー（本文が同じ既存のチャンクに重ねた場合はそのチャンクのキー）をそこから取り除く。
+        """
+        added, removed = {}, []
+        batch_ids = set()
+        for doc in documents:
+            digest = content_hash(doc['text'])
+            key = self._document_key(doc, digest, batch_ids)
+            if unseen is not None:
+                unseen.discard(key)
+            if key in self._chunk_key_by_key:
+                if self._hash_by_key[key] == digest:
+                    self._source_by_key[key].add(source)
+                    continue
+                old = self._unregister(key)
+                if added.pop(key, None) is None:
+                    removed.append(old)
+            if digest in self._key_by_hash:
+                # 本文が同じ既存のチャンク（IDが変わった文書など）は、このファイルの所属のまま残す
+                owner = self._key_by_hash[digest]
+                self._source_by_key[owner].add(source)
+                if unseen is not None:
+                    unseen.discard(owner)
+                continue
+            self._chunk_key_by_key[key] = IndexStore.chunk_key(doc['text'], self.embedder.signature)
+            self._hash_by_key[key] = digest
+            self._key_by_hash[digest] = key
+            self._source_by_key[key] = {source}
+            added[key] = digest
+        return added, removed
+
+    def _iter_added(self, file_path: str, added: dict[str, str]):
+        """_register で追加した文書を、ファイルを読み直して1件ずつ返すジェネレータ（返した文書は added から取り除く）"""
+        batch_ids = set()
+        for doc in self._iter_documents(file_path):
+            digest = content_hash(doc['text'])
+            key = self._document_key(doc, digest, batch_ids)
+            if added.get(key) == digest:
+                del added[key]
+                yield doc
+
+    @staticmethod
+    def _document_key(doc: dict, digest: str, batch_ids: set) -> str:
+        """重複排除に使う文書キー（IDがなければ本文のハッシュ）"""
+        doc_id = doc.get('id')
+        if not doc_id or doc_id in batch_ids:
+            return digest
+        batch_ids.add(doc_id)
+        return doc_id
+
+    def _unregister(self, key: str) -> str:
+        """文書を重複排除用の索引から外し、そのチャンクのキーを返す"""
+        del self._key_by_hash[self._hash_by_key.pop(key)]
+        del self._source_by_key[key]
+        return self._chunk_key_by_key.pop(key)
+
+    @classmethod
+    def _iter_documents(cls, file_path: str, report: dict | None = None):
+        """JSONLファイルから文書を1行ずつ読み込むジェネレータ
+
+        読み込めない行（JSONとして解釈できない・本文がない）は読み飛ばし、report に行数・文書数と
+        読み飛ばした行数、最初の MAX_REPORTED_ERRORS 件の行番号と理由を記録する。
+        """
+        report = {} if report is None else report
+        report.update(lines=0, documents=0, invalid_lines=0, errors=[])
+        with open(file_path, 'rb') as f:
+            for line_number, line in enumerate(f, 1):
+                report['lines'] = line_number
+                if not line.strip():
+                    continue
+                try:
+                    doc = json.loads(line)
+                    # 本文のない行は検索対象にできない
+                    error = None if isinstance(doc, dict) and isinstance(doc.get('text'), str) else "no 'text' string"
+                except json.JSONDecodeError as e:
+                    error = f"invalid JSON: {e.msg} (column {e.colno})"
+                except UnicodeDecodeError:
+                    error = "invalid UTF-8"
+                if error:
+                    report['invalid_lines'] += 1
+                    if len(report['errors']) < cls.MAX_REPORTED_ERRORS:
+                        report['errors'].append({'line': line_number, 'error': error})
+                    continue
+                report['documents'] += 1
+                yield doc
+
+    @classmethod
+    def _load_documents(cls, file_path: str) -> list[dict]:
+        """JSONLファイルから文書を読み込む"""
+        return list(cls._iter_documents(file_path))
+
+    @staticmethod
+    def _metadata(doc: dict, source: str = '') -> dict:
+        """検索結果に付与するメタデータ（source は文書を読み込んだファイル名）"""
+        return {
+            'id': doc.get('id', ''),
+            'chapter': doc.get('chapter', ''),
+            'section': doc.get('section', ''),
+            'source': source
+        }
+
+    def add_document(self, file_path, filename=None, move=False) -> dict:
+        """新しい文書をナレッジベースに追加し、読み込み結果を返す（同じIDの文書は置き換え、同じ本文の文書は追加しない）
+
+        検索中のスナップショットは変更せず、更新した複製ができあがってから差し替える。
+        ファイルは1行ずつ読み、追加する文書は ingest_batch_size 件ずつ解析・埋め込みするため、
+        作業用のメモリはファイルの大きさによらない。move を指定するとファイルを複製せずに移動する。
+        索引の更新は同時に1つだけ実行されることを前提とする。
+        """
+        filename = os.path.basename(filename or file_path)
         dest_path = os.path.join(self.data_dir, filename)
-        shutil.copy2(file_path, dest_path)
-        # システムを再初期化
-        self.initialize_system()
+        if self.snapshots:
+            # 複数ワーカー: ナレッジベース全体から作り直した版を公開する（他のワーカーは次の確認で切り替える）
+            with self.snapshots.lock():
+                # 追加・削除したチャンクの数は、他のワーカーが公開したものも含む最新の版との差分で数える
+                self.refresh_snapshot()
+                previous = self._chunk_keys()
+                self._store_file(file_path, dest_path, move)
+                version, reports = self._publish_snapshot()
+                current = self._chunk_keys()
+                self._use_snapshot(version)
+            counts = {'added': int(np.count_nonzero(~np.isin(current, previous))),
+                      'removed': int(np.count_nonzero(~np.isin(previous, current)))}
+            return self._upload_report(filename, reports.get(filename, {}), **counts)
+        self._store_file(file_path, dest_path, move)
+
+        # 初回追加の場合はシステムを初期化
+        if self.retriever is None:
+            reports = self._load_knowledge_base()
+            return self._upload_report(filename, reports.get(filename, {}))
+
+        try:
+            # 同名ファイルの再アップロードでは、新しいファイルに含まれない旧チャンクを
+            # そのファイルの所属から外し、どのファイルにも含まれなくなったものを削除する
+            report = {}
+            dropped = {key for key, sources in self._source_by_key.items() if filename in sources}
+            added, removed = self._register(self._iter_documents(dest_path, report), filename, unseen=dropped)
+            for key in dropped:
+                sources = self._source_by_key.get(key)
+                if sources is None:
+                    continue
+                sources.discard(filename)
+                if not sources:
+                    removed.append(self._unregister(key))
+            counts = {'added': len(added), 'removed': len(removed)}
+
+            if len(removed) >= len(self.retriever.chunks):
+                # 既存のチャンクがすべて削除される場合、残るのは今回追加した文書だけ（最初のバッチから作り直す）
+                retriever = None
+            else:
+                retriever = self.retriever.copy()
+                if removed:
+                    retriever.remove_documents(removed)
+            # 追加する文書はファイルを読み直して ingest_batch_size 件ずつ解析・埋め込みする
+            for batch in _batched(self._iter_added(dest_path, added), self.ingest_batch_size):
+                texts = [doc['text'] for doc in batch]
+                metadata = [self._metadata(doc, filename) for doc in batch]
+                if retriever is None:
+                    retriever = self._build_retriever(texts, metadata)
+                else:
+                    retriever.add_documents(texts=texts, metadata=metadata)
+            self._publish(retriever, len(self._chunk_key_by_key))
+            return self._upload_report(filename, report, **counts)
+        except Exception:
+            # 重複排除用の索引が途中まで更新されている可能性があるため、ディスク上の状態から作り直す
+            self.initialize_system()
+            raise
+
+    def _chunk_keys(self) -> np.ndarray:
+        """現在の検索システムのチャンクのキー（空なら長さ0の配列）"""
+        return self.retriever.chunks.keys if self.retriever else np.empty(0, dtype=ChunkStore.KEY_DTYPE)
+
+    @staticmethod
+    def _store_file(file_path: str, dest_path: str, move: bool):
+        """ファイルをナレッジベースに置く（同じファイルシステム上の移動は名前の変更だけで済む）"""
+        if move:
+            shutil.move(file_path, dest_path)
+        else:
+            shutil.copyfile(file_path, dest_path)
+
+    def _upload_report(self, filename: str, report: dict, **counts) -> dict:
+        """アップロードしたファイルの読み込み結果（行数・文書数・読み飛ばした行）と更新後のチャンク数"""
+        return {'filename': filename, **report, **counts, 'chunks': len(self.retriever.chunks) if self.retriever else 0}
+
+    def _retrieve_contexts(self, question: str, retriever: HybridRetriever | None = None,
+                           query_embedding: np.ndarray | None = None,
+                           rerank_budget_ms: float | None = None,
+                           timings: Timings | None = None,
+                           filters: dict | None = None) -> tuple[list[dict], list[dict]]:
+        """コンテキストを取得し、(検索結果, 表示用のコンテキスト)を返す"""
+        retriever = retriever or self.retriever
+        timings = timings or Timings()
+        retrieved_contexts = retriever.retrieve(question, top_k=self._retrieval_size, query_embedding=query_embedding,
+                                                timings=timings, filters=filters)
+        retrieved_contexts = self._rerank(question, retrieved_contexts, rerank_budget_ms, timings)
+        return retrieved_contexts, self._format_contexts(retrieved_contexts)
+
+    @property
+    def _retrieval_size(self) -> int:
+        """1段目の検索で取得する件数（再ランキングする場合はその候補数）"""
+        return max(self.top_k, self.reranker.candidates) if self.reranker else self.top_k
+
+    def _rerank(self, question: str, retrieved_contexts: list[dict], budget_ms: float | None = None,
+                timings: Timings | None = None) -> list[dict]:
+        """再ランキングが有効なら上位top_k件に絞り込む"""
+        if self.reranker is None:
+            return retrieved_contexts
+        with (timings or Timings()).stage('rerank'):
+            return self.reranker.rerank(question, retrieved_contexts, self.top_k, budget_ms)
+
+    @staticmethod
+    def _format_contexts(retrieved_contexts: list[dict]) -> list[dict]:
+        """検索結果を表示用のコンテキストに変換"""
+        return [
+            {
+                "text": item['text'],
+                "source": f"{item['chapter']} - {item['section']}",
+                "score": f"{item['score']:.4f}",
+                "vector_score": f"{item['vector_score']:.4f}",
+                "bm25_score": f"{item['bm25_score']:.4f}",
+                **({"rerank_score": f"{item['rerank_score']:.4f}"} if 'rerank_score' in item else {})
+            }
+            for item in retrieved_contexts
+        ]
+
+    def _prepare(self, question: str, rerank_budget_ms: float | None = None, filters: dict | None = None) -> dict:
+        """回答キャッシュを引き、なければコンテキストを検索する
+
+        完全一致（正規化した質問文）、意味的な一致（質問の埋め込み）の順に探し、
+        見つかれば 'cached' に回答を入れて返す。埋め込みは検索にもそのまま使う。
+        絞り込み条件（filters）が異なる回答は別のものとして扱う。段階ごとの処理時間は 'timings' に記録する。
+        """
+        started = time.perf_counter()
+        # バージョンを先に読むことで、古いバージョンに新しい索引の回答が登録されることはあっても逆は起きない
+        version = self.corpus_version
+        retriever = self.retriever
+        timings = Timings()
+        prepared = {'key': normalize_text(question), 'scope': filter_key(filters), 'version': version, 'started': started,
+                    'embedding': None, 'timings': timings}
+        with timings.stage('answer_cache'):
+            prepared['cached'] = self.answer_cache.get_exact(prepared['key'], version, prepared['scope'])
+        if prepared['cached'] is not None:
+            return prepared
+        with timings.stage('query_embedding'):
+            prepared['embedding'] = retriever.embedder.encode_query(question)
+        with timings.stage('answer_cache'):
+            prepared['cached'] = self.answer_cache.get_semantic(prepared['embedding'], version, prepared['scope'])
+        if prepared['cached'] is not None:
+            return prepared
+        prepared['retrieved'], prepared['contexts'] = self._retrieve_contexts(
+            question, retriever, prepared['embedding'], rerank_budget_ms, timings, filters
+        )
+        if prepared['retrieved']:
+            self._attach_prompt(prepared, question)
+        return prepared
+
+    def _prepare_batch(self, questions: list[str], rerank_budget_ms: float | None = None,
+                       filters: dict | None = None) -> list[dict]:
+        """複数の質問について _prepare と同じ処理を行う（埋め込みと検索はまとめて計算、filters は全質問に共通）
 
-    def query(self, question: str) -> dict:
-        """質問に対する回答を生成"""
-        if not self.documents:
+        バッチ全体でまとめて行った段階の処理時間は 'batch_timings'（全質問で共有）に記録する。
+        """
+        started = time.perf_counter()
+        version = self.corpus_version
+        retriever = self.retriever
+        scope = filter_key(filters)
+        batch_timings = Timings()
+        prepared = []
+        with batch_timings.stage('answer_cache'):
+            for question in questions:
+                key = normalize_text(question)
+                prepared.append({'key': key, 'scope': scope, 'version': version, 'started': started, 'embedding': None,
+                                 'timings': Timings(), 'batch_timings': batch_timings,
+                                 'cached': self.answer_cache.get_exact(key, version, scope)})
+
+        pending = [i for i, item in enumerate(prepared) if item['cached'] is None]
+        if pending:
+            with batch_timings.stage('query_embedding'):
+                embeddings = retriever.embedder.encode_queries([questions[i] for i in pending])
+            with batch_timings.stage('answer_cache'):
+                for i, embedding in zip(pending, embeddings):
+                    prepared[i]['embedding'] = embedding
+                    prepared[i]['cached'] = self.answer_cache.get_semantic(embedding, version, scope)
+            pending = [i for i in pending if prepared[i]['cached'] is None]
+        if pending:
+            retrieved = retriever.retrieve_batch(
+                [questions[i] for i in pending], top_k=self._retrieval_size,
+                query_embeddings=np.stack([prepared[i]['embedding'] for i in pending]), timings=batch_timings,
+                filters=filters
+            )
+            for i, retrieved_contexts in zip(pending, retrieved):
+                retrieved_contexts = self._rerank(questions[i], retrieved_contexts, rerank_budget_ms, prepared[i]['timings'])
+                prepared[i]['retrieved'] = retrieved_contexts
+                prepared[i]['contexts'] = self._format_contexts(retrieved_contexts)
+                if retrieved_contexts:
+                    self._attach_prompt(prepared[i], questions[i])
+        return prepared
+
+    def _attach_prompt(self, prepared: dict, question: str):
+        """Ollamaに渡すメッセージとそのトークン数を準備する（CPU処理のため検索と同じスレッドで行う）"""
+        with prepared['timings'].stage('prompt'):
+            prepared['messages'] = self._build_messages(question, prepared['retrieved'])
+            prepared['prompt_tokens'] = self.context_builder.count_messages(prepared['messages'])
+
+    def _no_match(self) -> dict:
+        """検索結果が空（絞り込み条件に一致するチャンクがない）場合に、生成せずに返す回答"""
+        return {"answer": self.NO_MATCH_ANSWER, "contexts": [], "no_match": True}
+
+    def _remember(self, prepared: dict, response: dict):
+        """生成した回答をキャッシュに登録（生成中にナレッジベースが更新された場合は登録しない）"""
+        if prepared['version'] != self.corpus_version:
+            return
+        latency = time.perf_counter() - prepared['started']
+        self.answer_cache.put(prepared['key'], prepared['embedding'], prepared['version'], response, latency, prepared['scope'])
+
+    @staticmethod
+    def _finish(prepared: dict, result: dict, include_timings: bool = False) -> dict:
+        """全体の処理時間と質問の件数を記録し、include_timings ならレスポンスに段階ごとの処理時間（ミリ秒）を付ける"""
+        timings = prepared['timings']
+        timings.record('total', time.perf_counter() - prepared['started'])
+        QUERIES.inc(cache=result.get('cached', 'miss'))
+        if not include_timings:
+            return result
+        batch_timings = prepared.get('batch_timings')
+        return {**result, 'timings': {**(batch_timings.as_ms() if batch_timings else {}), **timings.as_ms()}}
+
+    @staticmethod
+    def _count_error(error: Exception):
+        """失敗した質問を原因ごとに数える"""
+        if isinstance(error, LLMTimeoutError):
+            cause = 'timeout'
+        elif isinstance(error, LLMError):
+            cause = 'llm'
+        elif isinstance(error, ServerBusyError):
+            cause = 'busy'
+        else:
+            cause = 'internal'
+        ERRORS.inc(type=cause)
+
+    def cache_stats(self) -> dict:
+        """回答・クエリの埋め込み・クエリのトークン列・検索結果の各キャッシュの統計"""
+        token_cache = self.tokenizer.tokenize_query.cache_info()
+        return {
+            'answer': self.answer_cache.stats(),
+            'query_embedding': self.embedder.query_cache.stats(),
+            'query_tokens': {'entries': token_cache.currsize, 'hits': token_cache.hits, 'misses': token_cache.misses},
+            'retrieval': self.retriever.result_cache.stats() if self.retriever else None,
+        }
+
+    def _build_messages(self, question: str, retrieved_contexts: list[dict]) -> list[dict]:
+        """検索結果からOllamaに渡すメッセージを組み立てる"""
+        # コンテキストを重要度順に並べ、トークン数の上限に収まるよう質問に関係する文を残す
+        context_text = self.context_builder.build(retrieved_contexts, self.tokenizer.tokenize_query(question))
+
+        return [
+            {
+                "role": "system",
+                "content": (
+                    "あなたは学校心臓検診に関する文献に基づいて質問に答える、医学的に正確かつ丁寧な医療アシスタントです。\n"
+                    "以下のルールに従って回答してください：\n"
+                    "1. 『重要度: 非常に関連性が高い』の情報を最優先して参照すること。\n"
+                    "2. 抜粋をそのまま使用せず、読者にわかりやすい自然な日本語に要約・言い換えること。\n"
+                    "3. 回答の最後までしっかりと出力し、途中で途切れないようにすること。\n"
+                    "4. 使用した情報の出典（章・出典名）を明記すること。\n"
+                    "5. 医療専門家に向けた内容として、用語の正確性と論理性を重視すること。"
+                )
+            },
+            {
+                "role": "user",
+                "content": (
+                    "以下のコンテキストは、「学校心臓検診」に関する資料から抽出したテキストです。\n"
+                    "『重要度: 非常に関連性が高い』のものを最優先して使用してください。\n\n"
+                    f"コンテキスト:\n{context_text}\n\n質問:\n{question}"
+                )
+            }
+        ]
+
+    def query(self, question: str, rerank_budget_ms: float | None = None, include_timings: bool = False,
+              filters: dict | None = None) -> dict:
+        """質問に対する回答を生成
+
+        rerank_budget_ms で再ランキングの時間の上限を指定できる。include_timings を指定すると
+        レスポンスの "timings" に段階ごとの処理時間（ミリ秒）を含める。filters（chapter / section / source の
+        値または値のリスト）を指定すると、一致するチャンクだけから検索する（一致するチャンクがなければ生成せず、
+        NO_MATCH_ANSWER を "no_match": true とともに返す）。
+        """
+        if self.retriever is None:
             return {
                 "answer": "エラー: ナレッジベースが空です。先にドキュメントを追加してください。",
                 "contexts": []
             }
 
         try:
-            # コンテキストの取得
-            retrieved_contexts = self.retriever.retrieve(question, top_k=3)
-            contexts_with_scores = [
-                {
-                    "text": item['text'],
-                    "source": f"{item['chapter']} - {item['section']}",
-                    "score": f"{item['score']:.4f}",
-                    "vector_score": f"{item['vector_score']:.4f}",
-                    "bm25_score": f"{item['bm25_score']:.4f}"
-                }
-                for item in retrieved_contexts
-            ]
-
-            # コンテキストを重要度順に並べて表示（スコアの高い順）
-            context_parts = []
-            for i, item in enumerate(retrieved_contexts, 1):
-                relevance = "非常に関連性が高い" if i <= 2 else "参考情報"
-                context_parts.append(
-                    f"[重要度: {relevance}]\n"
-                    f"[出典: {item['chapter']} - {item['section']}]\n"
-                    f"[スコア: {item['score']:.4f}]\n"
-                    f"{item['text']}\n"
-                )
-            # プロンプトの組み立て
-            context_text = '---\n'.join(context_parts)
-
-            # Ollamaで回答を生成
-            response = ollama.chat(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "あなたは学校心臓検診に関する文献に基づいて質問に答える、医学的に正確かつ丁寧な医療アシスタントです。\n"
-                            "以下のルールに従って回答してください：\n"
-                            "1. 『重要度: 非常に関連性が高い』の情報を最優先して参照すること。\n"
-                            "2. 抜粋をそのまま使用せず、読者にわかりやすい自然な日本語に要約・言い換えること。\n"
-                            "3. 回答の最後までしっかりと出力し、途中で途切れないようにすること。\n"
-                            "4. 使用した情報の出典（章・出典名）を明記すること。\n"
-                            "5. 医療専門家に向けた内容として、用語の正確性と論理性を重視すること。"
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": (
-                            "以下のコンテキストは、「学校心臓検診」に関する資料から抽出したテキストです。\n"
-                            "『重要度: 非常に関連性が高い』のものを最優先して使用してください。\n\n"
-                            f"コンテキスト:\n{context_text}\n\n質問:\n{question}"
-                        )
-                    }
-                ],
-                stream=False,
-            )
+            # キャッシュの確認とコンテキストの取得
+            prepared = self._prepare(question, rerank_budget_ms, filters)
+            if prepared['cached'] is not None:
+                return self._finish(prepared, prepared['cached'], include_timings)
+            if not prepared['retrieved']:
+                return self._finish(prepared, self._no_match(), include_timings)
+
+            # 生成バックエンドで回答を生成
+            with prepared['timings'].stage('generation'):
+                response = self.llm.chat_sync(prepared['messages'])
+
+            result = {
+                "answer": response['content'],
+                "contexts": prepared['contexts'],
+                "prompt_tokens": prepared['prompt_tokens'],
+                "prompt_eval_count": response['prompt_eval_count']
+            }
+            self._remember(prepared, result)
+            return self._finish(prepared, result, include_timings)
 
+        except LLMError as e:
+            self._count_error(e)
+            raise
+        except Exception as e:
+            self._count_error(e)
             return {
-                "answer": response.message.content,
-                "contexts": contexts_with_scores
+                "answer": f"エラー: 質問の処理中にエラーが発生しました - {str(e)}",
+                "contexts": []
             }
 
+    async def query_async(self, question: str, run_blocking=asyncio.to_thread, rerank_budget_ms: float | None = None,
+                          include_timings: bool = False, filters: dict | None = None) -> dict:
+        """質問に対する回答を生成（イベントループを止めない版）
+
+        検索（埋め込み・形態素解析）は run_blocking（asyncio.to_threadと同じ呼び出し方の
+        コルーチン関数）で別スレッドに渡し、生成は生成バックエンドの非同期クライアントで待つ。
+        run_blocking が送出した ServerBusyError と生成の失敗（LLMError）はそのまま呼び出し元に伝える。
+        """
+        if self.retriever is None:
+            return {
+                "answer": "エラー: ナレッジベースが空です。先にドキュメントを追加してください。",
+                "contexts": []
+            }
+
+        try:
+            prepared = await run_blocking(self._prepare, question, rerank_budget_ms, filters)
+            if prepared['cached'] is not None:
+                return self._finish(prepared, prepared['cached'], include_timings)
+            if not prepared['retrieved']:
+                return self._finish(prepared, self._no_match(), include_timings)
+            with prepared['timings'].stage('generation'):
+                response = await self.llm.chat(prepared['messages'])
+            result = {
+                "answer": response['content'],
+                "contexts": prepared['contexts'],
+                "prompt_tokens": prepared['prompt_tokens'],
+                "prompt_eval_count": response['prompt_eval_count']
+            }
+            self._remember(prepared, result)
+            return self._finish(prepared, result, include_timings)
+
+        except ServerBusyError:
+            raise
+        except LLMError as e:
+            self._count_error(e)
+            raise
         except Exception as e:
+            self._count_error(e)
             return {
                 "answer": f"エラー: 質問の処理中にエラーが発生しました - {str(e)}",
                 "contexts": []
             }
+
+    async def query_stream(self, question: str, run_blocking=asyncio.to_thread, rerank_budget_ms: float | None = None,
+                           include_timings: bool = False, filters: dict | None = None):
+        """質問に対する回答を逐次生成する非同期ジェネレータ
+
+        最初に検索したコンテキストを {"event": "contexts"} として返し、
+        続いて生成されたトークンを {"event": "token"} として順に返す。
+        最後に {"event": "done"}、失敗した場合は {"event": "error"}（"status" はHTTPの対応するステータス。
+        run_blocking が ServerBusyError を送出した場合は503）を返す。
+        キャッシュにある回答は1つの token イベントでまとめて返し、done に "cached" を付ける。
+        絞り込み条件に一致するチャンクがない場合は生成せず、NO_MATCH_ANSWER を返して done に "no_match" を付ける。
+        include_timings を指定すると done に段階ごとの処理時間（"timings"）を含める。
+        """
+        if self.retriever is None:
+            yield {"event": "error", "message": "エラー: ナレッジベースが空です。先にドキュメントを追加してください。"}
+            return
+
+        try:
+            # 検索はCPU処理のため、イベントループを止めないよう別スレッドで実行
+            prepared = await run_blocking(self._prepare, question, rerank_budget_ms, filters)
+            cached = prepared['cached']
+            if cached is not None:
+                yield {"event": "contexts", "contexts": cached['contexts']}
+                yield {"event": "token", "content": cached['answer']}
+                finished = self._finish(prepared, cached, include_timings)
+                yield {"event": "done", "cached": cached['cached'], **({"timings": finished['timings']} if include_timings else {})}
+                return
+            yield {"event": "contexts", "contexts": prepared['contexts']}
+            if not prepared['retrieved']:
+                # 一致するチャンクがなければ生成せず、その旨を1つの token イベントで返す
+                finished = self._finish(prepared, self._no_match(), include_timings)
+                yield {"event": "token", "content": self.NO_MATCH_ANSWER}
+                yield {"event": "done", "no_match": True, **({"timings": finished['timings']} if include_timings else {})}
+                return
+
+            # 回答を逐次生成（プロンプトの実際のトークン数は最後の断片に含まれる）
+            # 最初の断片までの時間（first_token）と生成全体の時間（generation）を記録する
+            parts, prompt_eval_count = [], None
+            generation_started = time.perf_counter()
+            async for part in self.llm.stream_chat(prepared['messages']):
+                prompt_eval_count = part['prompt_eval_count'] or prompt_eval_count
+                if part['content']:
+                    if not parts:
+                        prepared['timings'].record('first_token', time.perf_counter() - generation_started)
+                    parts.append(part['content'])
+                    yield {"event": "token", "content": part['content']}
+            prepared['timings'].record('generation', time.perf_counter() - generation_started)
+            result = {
+                "answer": ''.join(parts),
+                "contexts": prepared['contexts'],
+                "prompt_tokens": prepared['prompt_tokens'],
+                "prompt_eval_count": prompt_eval_count
+            }
+            self._remember(prepared, result)
+            finished = self._finish(prepared, result, include_timings)
+            yield {"event": "done", "prompt_tokens": prepared['prompt_tokens'], "prompt_eval_count": prompt_eval_count,
+                   **({"timings": finished['timings']} if include_timings else {})}
+
+        except ServerBusyError as e:
+            # 応答を返し始めているため、query_async と同じ503を error イベントで伝える
+            self._count_error(e)
+            yield {"event": "error", "message": "エラー: サーバーが混み合っています。しばらくしてから再度お試しください。",
+                   "status": 503}
+        except LLMError as e:
+            self._count_error(e)
+            yield {"event": "error", "message": str(e), "status": e.status_code}
+        except Exception as e:
+            self._count_error(e)
+            yield {"event": "error", "message": f"エラー: 質問の処理中にエラーが発生しました - {str(e)}", "status": 500}
+
+    async def query_batch(self, questions: list[str], concurrency: int = 4, run_blocking=asyncio.to_thread,
+                          rerank_budget_ms: float | None = None, include_timings: bool = False, filters: dict | None = None):
+        """複数の質問に回答する非同期ジェネレータ
+
+        検索はすべての質問をまとめて1回で行い、このバッチからの生成リクエストは同時に
+        concurrency 件までに制限する。回答は生成が終わった順に
+        {"index": 質問の番号, "question", "answer", "contexts"} として返す。
+        生成に失敗した質問は "answer" を None とし、"error" と "status" を付ける。
+        include_timings を指定すると "timings" にバッチ全体で行った検索と、その質問の生成の処理時間を含める。
+        """
+        if self.retriever is None:
+            for i, question in enumerate(questions):
+                yield {"index": i, "question": question,
+                       "answer": "エラー: ナレッジベースが空です。先にドキュメントを追加してください。", "contexts": []}
+            return
+
+        try:
+            prepared = await run_blocking(self._prepare_batch, questions, rerank_budget_ms, filters)
+        except Exception as e:
+            self._count_error(e)
+            for i, question in enumerate(questions):
+                yield {"index": i, "question": question,
+                       "answer": f"エラー: 質問の処理中にエラーが発生しました - {str(e)}", "contexts": []}
+            return
+
+        semaphore = asyncio.Semaphore(concurrency)
+        generations = {}
+
+        async def generate(question: str, item: dict) -> dict:
+            try:
+                async with semaphore:
+                    with item['timings'].stage('generation'):
+                        response = await self.llm.chat(item['messages'])
+            except LLMError as e:
+                self._count_error(e)
+                return {"answer": None, "error": str(e), "status": e.status_code, "contexts": item['contexts']}
+            result = {
+                "answer": response['content'],
+                "contexts": item['contexts'],
+                "prompt_tokens": item['prompt_tokens'],
+                "prompt_eval_count": response['prompt_eval_count']
+            }
+            self._remember(item, result)
+            return result
+
+        async def answer(i: int) -> tuple[int, dict]:
+            item = prepared[i]
+            if item['cached'] is not None:
+                return i, self._finish(item, item['cached'], include_timings)
+            if not item['retrieved']:
+                return i, self._finish(item, self._no_match(), include_timings)
+            # 正規化すると同じになる質問は1度だけ生成する
+            if item['key'] not in generations:
+                generations[item['key']] = asyncio.ensure_future(generate(questions[i], item))
+            result = await asyncio.shield(generations[item['key']])
+            return i, result if 'error' in result else self._finish(item, result, include_timings)
+
+        tasks = [asyncio.ensure_future(answer(i)) for i in range(len(questions))]
+        try:
+            for task in asyncio.as_completed(tasks):
+                i, result = await task
+                yield {"index": i, "question": questions[i], **result}
+        finally:
+            # 途中で切断された場合は残りの生成を取り消す
+            for task in tasks + list(generations.values()):
+                task.cancel()
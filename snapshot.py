@@ -0,0 +1,100 @@
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def _load_array(path: str) -> np.ndarray:
+    """.npyをメモリマップで読み込む（空の配列はメモリマップできないため通常どおり読む）"""
+    try:
+        return np.asarray(np.load(path, mmap_mode='r'))
+    except ValueError:
+        return np.load(path)
+
+
+class SnapshotStore:
+    """複数のワーカープロセスで共有する、読み取り専用の索引スナップショット
+
+    スナップショットは版番号つきのディレクトリ（000001/ など）に、配列（チャンクの本文・メタデータの列を含む）を
+    .npy、それ以外の値を manifest.json に書き出す。配列はメモリマップで読み込むため、
+    同じ版を読み込んだワーカー同士はOSのページキャッシュを共有し、プロセスごとのコピーを持たない。
+    書き込みは一時ディレクトリに書いてから名前を変え、最後に CURRENT（最新の版の名前）を
+    置き換えて確定するため、読み手は常に書き終わった版だけを見る。
+    """
+    FORMAT_VERSION = 2
+
+    def __init__(self, root: str, keep: int = 3):
+        self.root = root
+        self.keep = max(keep, 2)
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, *names: str) -> str:
+        return os.path.join(self.root, *names)
+
+    @contextmanager
+    def lock(self):
+        """スナップショットを書き込むプロセスを1つに限るためのファイルロック"""
+        with open(self._path('LOCK'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def current(self) -> str | None:
+        """最新の版の名前（まだ公開されていなければNone）"""
+        try:
+            with open(self._path('CURRENT'), 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def manifest(self, version: str) -> dict | None:
+        try:
+            with open(self._path(version, 'manifest.json'), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return manifest if manifest.get('format') == self.FORMAT_VERSION else None
+
+    def publish(self, arrays: dict[str, np.ndarray], manifest: dict) -> str:
+        """新しい版を書き出して最新にし、版の名前を返す（lock() の中で呼ぶ）"""
+        versions = self._versions()
+        version = f"{int(versions[-1]) + 1 if versions else 1:06d}"
+        tmp = self._path(f"{version}.tmp-{os.getpid()}")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(tmp, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump({**manifest, 'format': self.FORMAT_VERSION, 'version': version, 'arrays': list(arrays)}, f)
+        os.rename(tmp, self._path(version))
+
+        with open(self._path('CURRENT.tmp'), 'w', encoding='utf-8') as f:
+            f.write(version + '\n')
+        os.replace(self._path('CURRENT.tmp'), self._path('CURRENT'))
+        self._prune(version)
+        return version
+
+    def load(self, version: str) -> dict | None:
+        """版を読み込む（配列は読み取り専用のメモリマップ）。壊れている・削除済みの場合はNone"""
+        manifest = self.manifest(version)
+        if manifest is None:
+            return None
+        try:
+            arrays = {name: _load_array(self._path(version, f"{name}.npy")) for name in manifest['arrays']}
+        except (OSError, ValueError):
+            return None
+        return {'manifest': manifest, 'arrays': arrays}
+
+    def _versions(self) -> list[str]:
+        return sorted(name for name in os.listdir(self.root) if name.isdigit())
+
+    def _prune(self, latest: str):
+        """古い版を削除する（メモリマップ中のファイルは削除後もマップを閉じるまで読める）"""
+        versions = [version for version in self._versions() if version <= latest]
+        for version in versions[:-self.keep]:
+            shutil.rmtree(self._path(version), ignore_errors=True)
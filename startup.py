@@ -0,0 +1,62 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupTracker:
+    """起動処理の段階ごとの状態（pending / running / done / failed）と所要時間
+
+    /healthz と /readyz で進み具合を返すために使う。すべての段階が done になると ready になる。
+    """
+    def __init__(self, stages: list[str]):
+        self.started = time.monotonic()
+        self.attempts = 0
+        self._stages = {name: {'status': 'pending'} for name in stages}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """段階の開始・終了（例外が起きた場合は failed とエラー内容）を記録する"""
+        started = time.monotonic()
+        with self._lock:
+            self._stages[name] = {'status': 'running'}
+        try:
+            yield
+        except Exception as e:
+            with self._lock:
+                self._stages[name] = {'status': 'failed', 'error': str(e), 'seconds': round(time.monotonic() - started, 3)}
+            raise
+        with self._lock:
+            self._stages[name] = {'status': 'done', 'seconds': round(time.monotonic() - started, 3)}
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return all(stage['status'] == 'done' for stage in self._stages.values())
+
+    def report(self) -> dict:
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self._stages.items()}
+        return {
+            'ready': all(stage['status'] == 'done' for stage in stages.values()),
+            'uptime_s': round(time.monotonic() - self.started, 3),
+            'attempts': self.attempts,
+            'stages': stages,
+        }
+
+    def run_in_background(self, load, retry_delay: float = 1.0, max_retry_delay: float = 60.0) -> threading.Thread:
+        """load を別スレッドで実行し、失敗した場合は間隔を倍々に伸ばしながら成功するまで再試行する"""
+        def run():
+            delay = retry_delay
+            while True:
+                self.attempts += 1
+                try:
+                    load()
+                    return
+                except Exception:
+                    time.sleep(delay)
+                    delay = min(delay * 2, max_retry_delay)
+
+        thread = threading.Thread(target=run, name='startup', daemon=True)
+        thread.start()
+        return thread
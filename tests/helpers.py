@@ -0,0 +1,68 @@
+"""テスト用の部品（モデルを読み込まない埋め込み・生成バックエンドと、RAGSystemの作成）"""
+import json
+import os
+import zlib
+
+import numpy as np
+
+from rag_system import Embedder, RAGSystem
+
+
+class HashEmbedder(Embedder):
+    """モデルを読み込まない、文字のbigramのハッシュによる埋め込み（テスト用。埋め込んだテキストを encoded に記録する）"""
+    dimension = 64
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.encoded = []
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        self.encoded.extend(texts)
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for j in range(len(text) - 1):
+                embeddings[i, zlib.crc32(text[j:j + 2].encode('utf-8')) % self.dimension] += 1
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms > 0, norms, 1)
+
+
+class RecordingLLM:
+    """生成の呼び出し回数を数える生成バックエンド（テスト用）"""
+    def __init__(self):
+        self.calls = 0
+
+    def chat_sync(self, messages: list[dict]) -> dict:
+        self.calls += 1
+        return {'content': '回答', 'prompt_eval_count': 1}
+
+    async def chat(self, messages: list[dict]) -> dict:
+        return self.chat_sync(messages)
+
+    async def stream_chat(self, messages: list[dict]):
+        self.calls += 1
+        yield {'content': '回答', 'prompt_eval_count': 1}
+
+
+def write_jsonl(path, documents: list[dict]):
+    """文書をJSONLファイルに書き出す"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(doc, ensure_ascii=False) + '\n' for doc in documents)
+
+
+def make_rag(tmp_path, files: dict[str, list[dict]] | None = None, components: dict | None = None, **options) -> RAGSystem:
+    """tmp_path/knowledge_base に files（ファイル名 → 文書）を置いてRAGSystemを作る
+
+    components を渡すと部品（埋め込み・生成）を共有する（再起動や別ワーカーの再現に使う）。
+    """
+    data_dir = os.path.join(tmp_path, 'knowledge_base')
+    os.makedirs(data_dir, exist_ok=True)
+    for name, documents in (files or {}).items():
+        write_jsonl(os.path.join(data_dir, name), documents)
+    components = components or {'embedder': HashEmbedder(), 'llm': RecordingLLM()}
+    return RAGSystem(data_dir=data_dir, components=components, **options)
+
+
+def chunk_texts(rag: RAGSystem) -> list[str]:
+    """検索システムのチャンクの本文（並び順によらず比較できるよう整列）"""
+    chunks = rag.retriever.chunks if rag.retriever else []
+    return sorted(chunks.text(row) for row in range(len(chunks)))
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from helpers import make_rag, write_jsonl
+
+DOCUMENTS = [
+    {'id': '1', 'chapter': '第1章', 'text': 'QT延長の抽出基準は心拍数で補正したQT時間で判定する。'},
+    {'id': '2', 'chapter': '第1章', 'text': 'WPW症候群は心電図のデルタ波で見つかる。'},
+    {'id': '3', 'chapter': '第2章', 'text': '肥大型心筋症は突然死の原因になりうる。'},
+]
+
+
+@pytest.fixture
+def rag(tmp_path):
+    return make_rag(tmp_path, {'docs.jsonl': DOCUMENTS}, answer_cache_options={'semantic_threshold': 0.85})
+
+
+def test_exact_hit_after_normalization(rag):
+    first = rag.query('QT延長の抽出基準は？')
+    assert 'cached' not in first
+    second = rag.query('  ＱＴ延長の抽出基準は?  ')
+    assert second['cached'] == 'exact'
+    assert (second['answer'], second['contexts']) == (first['answer'], first['contexts'])
+    assert rag.llm.calls == 1
+    assert rag.answer_cache.stats()['exact_hits'] == 1
+
+
+def test_semantic_hit_above_threshold_only(rag):
+    rag.query('QT延長の抽出基準は？')
+    assert rag.query('QT延長の抽出基準を教えて')['cached'] == 'semantic'
+    assert 'cached' not in rag.query('WPW症候群の所見')
+    assert rag.llm.calls == 2
+    stats = rag.answer_cache.stats()
+    assert (stats['semantic_hits'], stats['entries']) == (1, 2)
+
+
+def test_cached_answers_are_scoped_by_filters(rag):
+    rag.query('QT延長の抽出基準は？', filters={'chapter': '第1章'})
+    assert 'cached' not in rag.query('QT延長の抽出基準は？', filters={'chapter': '第2章'})
+    assert rag.query('QT延長の抽出基準は？', filters={'chapter': '第1章'})['cached'] == 'exact'
+    assert rag.llm.calls == 2
+
+
+def test_upload_invalidates_cached_answers(rag, tmp_path):
+    rag.query('QT延長の抽出基準は？')
+    path = tmp_path / 'upload.jsonl'
+    write_jsonl(path, [{'id': '4', 'text': 'QT延長の抽出基準は学年ごとに異なる。'}])
+    rag.add_document(str(path), filename='new.jsonl')
+    assert rag.answer_cache.stats()['entries'] == 0
+    result = rag.query('QT延長の抽出基準は？')
+    assert 'cached' not in result
+    assert rag.llm.calls == 2
+    assert any('学年ごと' in context['text'] for context in result['contexts'])
+
+
+def test_stream_and_async_share_the_cache(rag):
+    asyncio.run(rag.query_async('QT延長の抽出基準は？'))
+
+    async def collect():
+        return [event async for event in rag.query_stream('QT延長の抽出基準を教えて')]
+
+    events = asyncio.run(collect())
+    assert events[-1] == {'event': 'done', 'cached': 'semantic'}
+    assert rag.llm.calls == 1
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from helpers import make_rag
+from rag_system import RAGSystem
+
+DOCUMENTS = [
+    {'id': '1', 'chapter': '第1章', 'section': '1.1', 'text': 'QT延長の抽出基準は心拍数で補正したQT時間で判定する。'},
+    {'id': '2', 'chapter': '第1章', 'section': '1.2', 'text': 'WPW症候群は心電図のデルタ波で見つかる。'},
+    {'id': '3', 'chapter': '第2章', 'section': '2.1', 'text': '肥大型心筋症は突然死の原因になりうる。'},
+]
+
+
+@pytest.fixture
+def rag(tmp_path):
+    return make_rag(tmp_path, {'docs.jsonl': DOCUMENTS})
+
+
+def test_query_with_matching_filter_generates(rag):
+    result = rag.query('QT延長の抽出基準', filters={'chapter': '第1章'})
+    assert result['answer'] == '回答'
+    assert result['contexts'] and 'no_match' not in result
+    assert rag.llm.calls == 1
+
+
+def test_query_without_matching_chunks_skips_generation(rag):
+    result = rag.query('QT延長の抽出基準', filters={'chapter': '存在しない章'})
+    assert result == {'answer': RAGSystem.NO_MATCH_ANSWER, 'contexts': [], 'no_match': True}
+    assert rag.llm.calls == 0
+
+
+def test_query_async_without_matching_chunks_skips_generation(rag):
+    result = asyncio.run(rag.query_async('QT延長', filters={'source': 'other.jsonl'}))
+    assert result['no_match'] and result['contexts'] == []
+    assert rag.llm.calls == 0
+
+
+def test_query_stream_without_matching_chunks_skips_generation(rag):
+    async def collect():
+        return [event async for event in rag.query_stream('QT延長', filters={'section': '9.9'})]
+
+    events = asyncio.run(collect())
+    assert [event['event'] for event in events] == ['contexts', 'token', 'done']
+    assert events[0]['contexts'] == [] and events[1]['content'] == RAGSystem.NO_MATCH_ANSWER and events[2]['no_match']
+    assert rag.llm.calls == 0
+
+
+def test_query_batch_without_matching_chunks_skips_generation(rag):
+    async def collect():
+        return [result async for result in rag.query_batch(['QT延長', 'WPW症候群'], filters={'chapter': '第9章'})]
+
+    results = asyncio.run(collect())
+    assert sorted(result['index'] for result in results) == [0, 1]
+    assert all(result['answer'] == RAGSystem.NO_MATCH_ANSWER and result['no_match'] for result in results)
+    assert rag.llm.calls == 0
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from benchmark import legacy_linear_fusion, synthetic_candidates
+from fusion import create_fusion
+from helpers import make_rag
+
+DOCUMENTS = [
+    {'id': '1', 'text': 'QT延長の抽出基準は心拍数で補正したQT時間で判定する。'},
+    {'id': '2', 'text': 'WPW症候群は心電図のデルタ波で見つかる。'},
+    {'id': '3', 'text': '肥大型心筋症は突然死の原因になりうる。'},
+    {'id': '4', 'text': 'QT時間の延長は失神の原因になりうる。'},
+    {'id': '5', 'text': '心電図検診では心拍数と調律を確認する。'},
+]
+
+
+@pytest.mark.parametrize('alpha', [0.0, 0.3, 0.5, 1.0])
+def test_linear_fusion_matches_previous_scoring(alpha):
+    fuse = create_fusion('linear')
+    for candidates in synthetic_candidates(200, 40, 20, seed=1):
+        for actual, expected in zip(fuse(*candidates, alpha), legacy_linear_fusion(*candidates, alpha)):
+            np.testing.assert_allclose(actual, expected, rtol=1e-12, atol=0)
+
+
+def test_linear_fusion_handles_empty_and_non_positive_branches():
+    fuse = create_fusion('linear')
+    cases = [
+        (np.arange(3), np.array([-0.5, -0.1, -0.2]), np.array([], dtype=np.int64), np.array([])),
+        (np.arange(3), np.zeros(3), np.array([1]), np.array([2.0])),
+        (np.array([], dtype=np.int64), np.array([]), np.array([0, 2]), np.array([1.0, 3.0])),
+    ]
+    for candidates in cases:
+        for actual, expected in zip(fuse(*candidates, 0.5), legacy_linear_fusion(*candidates, 0.5)):
+            np.testing.assert_allclose(actual, expected)
+
+
+@pytest.mark.parametrize('alpha', [0.2, 0.5, 0.8])
+def test_retrieve_ranks_like_previous_scoring(tmp_path, alpha):
+    retriever = make_rag(tmp_path, {'docs.jsonl': DOCUMENTS}).retriever
+    for query in ['QT延長の抽出基準', '心電図のデルタ波', '突然死の原因']:
+        vector_scores = np.asarray(retriever.embeddings, dtype=np.float32) @ retriever.embedder.encode_query(query)
+        bm25_ids, bm25_scores = retriever.bm25.get_sparse_scores(retriever.tokenizer.tokenize_query(query))
+        ids, scores, _, _ = legacy_linear_fusion(np.arange(len(vector_scores)), vector_scores, bm25_ids, bm25_scores, alpha)
+        expected = {retriever.chunks.text(int(i)): score for i, score in zip(ids, scores)}
+        results = retriever.retrieve(query, top_k=len(DOCUMENTS), alpha=alpha)
+        assert [view['score'] for view in results] == pytest.approx(sorted(expected.values(), reverse=True))
+        assert {view['text']: view['score'] for view in results} == pytest.approx(expected)
@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from helpers import HashEmbedder, RecordingLLM, chunk_texts, make_rag, write_jsonl
+
+QT = 'QT延長の抽出基準は心拍数で補正したQT時間で判定する。'
+WPW = 'WPW症候群は心電図のデルタ波で見つかる。'
+HCM = '肥大型心筋症は突然死の原因になりうる。'
+BASE = [
+    {'id': '1', 'chapter': '第1章', 'section': '1.1', 'text': QT},
+    {'id': '2', 'chapter': '第1章', 'section': '1.2', 'text': WPW},
+]
+NEW = [{'id': f'n{i}', 'chapter': '第2章', 'section': '2.1', 'text': f'{HCM}症例{i}では心エコーで壁厚を測る。'} for i in range(5)]
+QUESTIONS = ['QT延長の抽出基準', '心エコーで壁厚を測る症例', 'デルタ波']
+
+
+@pytest.fixture
+def upload(tmp_path):
+    """documents をアップロード用のファイルに書き、filename としてナレッジベースに追加する"""
+    def upload(rag, filename, documents):
+        path = tmp_path / 'upload.jsonl'
+        write_jsonl(path, documents)
+        return rag.add_document(str(path), filename=filename)
+    return upload
+
+
+def results(rag, question):
+    """検索結果の(本文, スコア)の一覧"""
+    return [(view['text'], round(view['score'], 6)) for view in rag.retriever.retrieve(question, top_k=10)]
+
+
+def restarted(rag, tmp_path):
+    """同じディレクトリから読み込み直したRAGSystem（再起動後の状態）"""
+    return make_rag(tmp_path, components=rag.components())
+
+
+def test_reupload_with_renamed_id_keeps_text(tmp_path, upload):
+    rag = make_rag(tmp_path)
+    upload(rag, 'a.jsonl', [{'id': '1', 'text': QT}])
+    report = upload(rag, 'a.jsonl', [{'id': '2', 'text': QT}])
+    assert (report['added'], report['removed'], report['chunks']) == (0, 0, 1)
+    assert chunk_texts(rag) == [QT]
+    assert chunk_texts(restarted(rag, tmp_path)) == [QT]
+
+
+def test_reupload_without_id_keeps_text(tmp_path, upload):
+    rag = make_rag(tmp_path)
+    upload(rag, 'a.jsonl', [{'id': '1', 'text': QT}, {'id': '2', 'text': WPW}])
+    report = upload(rag, 'a.jsonl', [{'text': QT}])
+    assert (report['added'], report['removed']) == (0, 1)
+    assert chunk_texts(rag) == [QT]
+    assert chunk_texts(restarted(rag, tmp_path)) == [QT]
+
+
+def test_reupload_with_duplicate_text_keeps_single_chunk(tmp_path, upload):
+    rag = make_rag(tmp_path, {'b.jsonl': [{'id': 'b1', 'text': WPW}]})
+    upload(rag, 'a.jsonl', [{'id': '1', 'text': QT}])
+    report = upload(rag, 'a.jsonl', [{'id': '1', 'text': QT}, {'id': '2', 'text': QT}, {'id': '3', 'text': WPW}])
+    assert (report['added'], report['removed'], report['chunks']) == (0, 0, 2)
+    # 他のファイルと本文が同じ文書は、そのファイルを置き換えてもこのファイルの所属で残る
+    report = upload(rag, 'b.jsonl', [{'id': 'b2', 'text': HCM}])
+    assert (report['added'], report['removed']) == (1, 0)
+    assert chunk_texts(rag) == sorted([QT, WPW, HCM])
+    assert chunk_texts(restarted(rag, tmp_path)) == sorted([QT, WPW, HCM])
+
+
+def test_reupload_replaces_changed_and_missing_documents(tmp_path, upload):
+    rag = make_rag(tmp_path)
+    upload(rag, 'a.jsonl', [{'id': '1', 'text': QT}, {'id': '2', 'text': WPW}])
+    report = upload(rag, 'a.jsonl', [{'id': '1', 'text': HCM}])
+    assert (report['added'], report['removed'], report['chunks']) == (1, 2, 1)
+    assert chunk_texts(rag) == [HCM]
+    assert chunk_texts(restarted(rag, tmp_path)) == [HCM]
+
+
+def test_upload_embeds_only_new_documents(tmp_path, upload):
+    rag = make_rag(tmp_path, {'base.jsonl': BASE}, ingest_batch_size=2)
+    rag.embedder.encoded.clear()
+    report = upload(rag, 'new.jsonl', NEW + BASE[:1])
+    assert (report['added'], report['removed'], report['chunks'], report['documents']) == (5, 0, 7, 6)
+    assert sorted(text.removeprefix(rag.embedder.passage_prefix) for text in rag.embedder.encoded) == sorted(doc['text'] for doc in NEW)
+    assert rag.document_count == 7
+
+
+def test_incremental_upload_matches_full_rebuild(tmp_path, upload):
+    rag = make_rag(tmp_path / 'incremental', {'base.jsonl': BASE}, ingest_batch_size=2)
+    upload(rag, 'new.jsonl', NEW)
+    rebuilt = make_rag(tmp_path / 'rebuilt', {'base.jsonl': BASE, 'new.jsonl': NEW})
+    for question in QUESTIONS:
+        assert results(rag, question) == results(rebuilt, question)
+    view = rag.retriever.retrieve('心エコーで壁厚を測る症例1', top_k=1)[0]
+    assert (view['source'], view['chapter'], view['id']) == ('new.jsonl', '第2章', 'n1')
+
+
+def test_restart_reuses_persisted_index(tmp_path, upload):
+    rag = make_rag(tmp_path, {'base.jsonl': BASE})
+    upload(rag, 'new.jsonl', NEW)
+    components = {'embedder': HashEmbedder(), 'llm': RecordingLLM()}
+    reloaded = make_rag(tmp_path, components=components)
+    assert components['embedder'].encoded == []
+    assert chunk_texts(reloaded) == chunk_texts(rag)
+    for question in QUESTIONS:
+        assert results(reloaded, question) == results(rag, question)
+
+
+def test_first_load_deduplicates_by_id_and_normalized_text(tmp_path):
+    rag = make_rag(tmp_path, {'a.jsonl': [{'id': '1', 'text': QT}, {'id': '2', 'text': WPW}]})
+    # 後から更新されたファイルの同じIDの文書が置き換え、全角・前後の空白だけが違う本文は同じ文書とみなす
+    write_jsonl(tmp_path / 'knowledge_base' / 'b.jsonl', [{'id': '1', 'text': HCM}, {'id': '9', 'text': '  ＷＰＷ症候群は心電図のデルタ波で見つかる。 '}])
+    a, b = tmp_path / 'knowledge_base' / 'a.jsonl', tmp_path / 'knowledge_base' / 'b.jsonl'
+    os.utime(a, ns=(1_000_000_000, 1_000_000_000))
+    os.utime(b, ns=(2_000_000_000, 2_000_000_000))
+    reloaded = restarted(rag, tmp_path)
+    assert chunk_texts(reloaded) == sorted([HCM, WPW])
+    assert reloaded.document_count == 2
+
+
+def test_reupload_removes_only_chunks_no_other_file_contains(tmp_path, upload):
+    rag = make_rag(tmp_path, {'b.jsonl': [{'id': 'b1', 'text': WPW}]})
+    upload(rag, 'a.jsonl', [{'id': '1', 'text': QT}, {'id': '2', 'text': WPW}])
+    report = upload(rag, 'a.jsonl', [{'id': '3', 'text': HCM}])
+    assert (report['added'], report['removed']) == (1, 1)
+    assert chunk_texts(rag) == sorted([WPW, HCM])
+    report = upload(rag, 'b.jsonl', [{'id': 'b2', 'text': QT}])
+    assert (report['added'], report['removed']) == (1, 1)
+    assert chunk_texts(rag) == sorted([QT, HCM])
+    assert chunk_texts(restarted(rag, tmp_path)) == sorted([QT, HCM])
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm_backend import LLMBackend, LLMTimeoutError
+
+
+class CountingBackend(LLMBackend):
+    """同時に実行中の生成の数の最大値を記録するバックエンド（テスト用）"""
+    def __init__(self, **kwargs):
+        super().__init__('counting', **kwargs)
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+
+    def _exit(self):
+        with self._lock:
+            self.running -= 1
+
+    async def _chat(self, messages: list[dict]) -> dict:
+        self._enter()
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            self._exit()
+        return {'content': 'async', 'prompt_eval_count': 1}
+
+    async def _stream(self, messages: list[dict]):
+        self._enter()
+        try:
+            await asyncio.sleep(0.05)
+            yield {'content': 'stream', 'prompt_eval_count': 1}
+        finally:
+            self._exit()
+
+    def _chat_sync(self, messages: list[dict]) -> dict:
+        self._enter()
+        try:
+            time.sleep(0.05)
+        finally:
+            self._exit()
+        return {'content': 'sync', 'prompt_eval_count': 1}
+
+
+def test_sync_and_async_callers_share_the_parallel_limit():
+    backend = CountingBackend(max_parallel=2)
+
+    async def stream():
+        return [part async for part in backend.stream_chat([])]
+
+    async def run_async():
+        await asyncio.gather(*[backend.chat([]) for _ in range(4)], *[stream() for _ in range(4)])
+
+    threads = [threading.Thread(target=backend.chat_sync, args=([],)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    asyncio.run(run_async())
+    for thread in threads:
+        thread.join()
+    assert backend.peak == 2
+    assert backend.running == 0
+
+
+def test_async_wait_for_a_slot_times_out_without_holding_it():
+    backend = CountingBackend(max_parallel=1)
+    assert backend._slots.acquire(timeout=1)
+    with pytest.raises(LLMTimeoutError):
+        asyncio.run(backend.chat([], timeout=0.1))
+    backend._slots.release()
+    assert backend.chat_sync([])['content'] == 'sync'
+    assert asyncio.run(backend.chat([]))['content'] == 'async'
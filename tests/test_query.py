@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from helpers import make_rag
+from metrics import ERRORS
+from worker_pool import ServerBusyError
+
+DOCUMENTS = [
+    {'id': '1', 'chapter': '第1章', 'text': 'QT延長の抽出基準は心拍数で補正したQT時間で判定する。'},
+    {'id': '2', 'chapter': '第1章', 'text': 'WPW症候群は心電図のデルタ波で見つかる。'},
+    {'id': '3', 'chapter': '第2章', 'text': '肥大型心筋症は突然死の原因になりうる。'},
+]
+
+
+@pytest.fixture
+def rag(tmp_path):
+    return make_rag(tmp_path, {'docs.jsonl': DOCUMENTS})
+
+
+def errors(cause: str) -> float:
+    return ERRORS._values.get((cause,), 0.0)
+
+
+async def busy(func, *args, **kwargs):
+    """待ち行列が満杯の run_blocking"""
+    raise ServerBusyError("Too many pending tasks")
+
+
+def test_query_stream_reports_busy_as_503(rag):
+    async def collect():
+        return [event async for event in rag.query_stream('QT延長', run_blocking=busy)]
+
+    busy_errors, internal_errors = errors('busy'), errors('internal')
+    events = asyncio.run(collect())
+    assert [event['event'] for event in events] == ['error']
+    assert events[0]['status'] == 503
+    assert errors('busy') == busy_errors + 1 and errors('internal') == internal_errors
+    assert rag.llm.calls == 0
+
+
+def test_query_async_propagates_busy(rag):
+    with pytest.raises(ServerBusyError):
+        asyncio.run(rag.query_async('QT延長', run_blocking=busy))
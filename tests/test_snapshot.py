@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+from helpers import HashEmbedder, RecordingLLM, chunk_texts, make_rag, write_jsonl
+
+QT = 'QT延長の抽出基準は心拍数で補正したQT時間で判定する。'
+WPW = 'WPW症候群は心電図のデルタ波で見つかる。'
+HCM = '肥大型心筋症は突然死の原因になりうる。'
+DOCUMENTS = [{'id': '1', 'chapter': '第1章', 'text': QT}, {'id': '2', 'chapter': '第1章', 'text': WPW}]
+
+
+def worker(tmp_path):
+    """同じナレッジベースとスナップショットを共有するワーカー（部品は共有しない）"""
+    return make_rag(tmp_path, components={'embedder': HashEmbedder(), 'llm': RecordingLLM()},
+                    snapshot_dir=os.path.join(tmp_path, 'snapshots'))
+
+
+@pytest.fixture
+def workers(tmp_path):
+    os.makedirs(tmp_path / 'knowledge_base')
+    write_jsonl(tmp_path / 'knowledge_base' / 'docs.jsonl', DOCUMENTS)
+    return worker(tmp_path), worker(tmp_path)
+
+
+@pytest.fixture
+def upload(tmp_path):
+    def upload(rag, filename, documents):
+        path = tmp_path / 'upload.jsonl'
+        write_jsonl(path, documents)
+        return rag.add_document(str(path), filename=filename)
+    return upload
+
+
+def test_workers_share_one_memory_mapped_snapshot(workers):
+    first, second = workers
+    assert first.snapshot_version == second.snapshot_version == first.snapshots.current()
+    # 2つ目のワーカーは公開済みの版を読み込むだけで、埋め込みを計算しない
+    assert second.embedder.encoded == []
+    assert chunk_texts(first) == chunk_texts(second) == sorted([QT, WPW])
+    assert isinstance(second.retriever.embeddings.base, np.memmap)
+    assert first.retriever.retrieve('QT延長', top_k=2)[0]['text'] == second.retriever.retrieve('QT延長', top_k=2)[0]['text'] == QT
+
+
+def test_upload_publishes_and_other_workers_refresh(workers, upload):
+    first, second = workers
+    second.query('QT延長の抽出基準は？')
+    previous = first.snapshot_version
+    report = upload(first, 'new.jsonl', [{'id': '3', 'chapter': '第2章', 'text': HCM}])
+    assert (report['added'], report['removed'], report['chunks']) == (1, 0, 3)
+    assert first.snapshot_version != previous and first.snapshot_version == first.snapshots.current()
+
+    assert chunk_texts(second) == sorted([QT, WPW])
+    assert second.refresh_snapshot()
+    assert not second.refresh_snapshot()
+    assert second.snapshot_version == first.snapshot_version
+    assert chunk_texts(second) == sorted([QT, WPW, HCM]) and second.document_count == 3
+    # 切り替えた後は古い回答を使わない
+    assert second.answer_cache.stats()['entries'] == 0
+    assert 'cached' not in second.query('QT延長の抽出基準は？')
+    assert second.llm.calls == 2
+
+
+def test_upload_counts_include_other_workers_publishes(workers, upload):
+    first, second = workers
+    upload(second, 'other.jsonl', [{'id': '9', 'text': HCM}])
+    # first は second の公開をまだ読み込んでいないが、差分は最新の版に対して数える
+    report = upload(first, 'docs.jsonl', [{'id': '1', 'text': QT}, {'id': '9', 'text': HCM}])
+    assert (report['added'], report['removed'], report['chunks']) == (0, 1, 2)
+    assert chunk_texts(first) == sorted([QT, HCM])
+    second.refresh_snapshot()
+    assert chunk_texts(second) == chunk_texts(first)
+
+
+def test_new_worker_republishes_when_knowledge_base_changed(tmp_path, workers):
+    first, _ = workers
+    version = first.snapshot_version
+    write_jsonl(tmp_path / 'knowledge_base' / 'added.jsonl', [{'id': '4', 'text': HCM}])
+    third = worker(tmp_path)
+    assert third.snapshot_version != version
+    assert chunk_texts(third) == sorted([QT, WPW, HCM])
+    assert first.refresh_snapshot() and chunk_texts(first) == chunk_texts(third)
@@ -0,0 +1,28 @@
+import pytest
+
+from rag_system import JapaneseTokenizer
+
+TEXTS = ['QT延長の抽出基準は心拍数で補正する。', 'WPW症候群は心電図のデルタ波で見つかる。', '肥大型心筋症は突然死の原因になりうる。'] * 4
+
+
+@pytest.fixture
+def tokenizer():
+    tokenizer = JapaneseTokenizer(workers=2, parallel_threshold=1)
+    yield tokenizer
+    tokenizer.close()
+
+
+def test_tokenize_many_matches_sequential_and_reuses_pool(tokenizer):
+    expected = [tokenizer.tokenize(text) for text in TEXTS]
+    assert tokenizer.tokenize_many(TEXTS) == expected
+    pool = tokenizer._pool
+    assert pool._mp_context.get_start_method() != 'fork'
+    assert tokenizer.tokenize_queries(TEXTS) == [tuple(words) for words in expected]
+    assert tokenizer._pool is pool
+
+
+def test_close_shuts_down_pool_and_recreates_on_demand(tokenizer):
+    tokenizer.tokenize_many(TEXTS)
+    tokenizer.close()
+    assert tokenizer._pool is None
+    assert tokenizer.tokenize_many(TEXTS[:2]) == [tokenizer.tokenize(text) for text in TEXTS[:2]]
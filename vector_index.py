@@ -0,0 +1,183 @@
+import copy
+
+import numpy as np
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコア上位k件のインデックスを降順で返す（全体のソートは行わない）"""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(scores, -k)[-k:]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(scores[candidates], kind='stable')[::-1]]
+
+
+def inner_product(matrix: np.ndarray, query: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    """行列の各行とクエリの内積
+
+    クエリが (クエリ数, 次元数) の行列の場合は (行数, クエリ数) のスコアを1回の行列積で求める。
+    float16 / int8 で保存された行列は一定行数ずつfloat32に変換して計算し、
+    行列全体のfloat32コピーを作らない。
+    """
+    query = np.asarray(query, dtype=np.float32).T
+    if matrix.dtype == np.float32:
+        return np.asarray(matrix @ query, dtype=np.float32)
+    scores = np.empty((len(matrix),) + query.shape[1:], dtype=np.float32)
+    for start in range(0, len(matrix), block_size):
+        scores[start:start + block_size] = matrix[start:start + block_size].astype(np.float32) @ query
+    return scores
+
+
+class FlatIndex:
+    """全チャンクとの内積による厳密なベクトル検索（デフォルト）"""
+    def __init__(self):
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+
+    def build(self, embeddings: np.ndarray):
+        """埋め込み行列全体から索引を構築"""
+        self.embeddings = embeddings
+
+    def add(self, embeddings: np.ndarray):
+        """チャンク追加後の埋め込み行列全体を受け取り、索引を更新"""
+        self.embeddings = embeddings
+
+    def copy(self) -> 'FlatIndex':
+        """元の索引での検索に影響を与えずに更新できる複製"""
+        return copy.copy(self)
+
+    def search(self, query: np.ndarray, k: int | None = None, rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """(チャンク番号, 内積スコア)を返す。kを省略すると全チャンクのスコアを返す
+
+        rows（昇順のチャンク番号）を指定すると、そのチャンクだけをスコアリングする。
+        """
+        scores = inner_product(self.embeddings if rows is None else self.embeddings[rows], query)
+        if k is None:
+            return np.arange(len(scores)) if rows is None else rows, scores
+        top = top_k_indices(scores, k)
+        return top if rows is None else rows[top], scores[top]
+
+    def search_batch(self, queries: np.ndarray, k: int | None = None,
+                     rows: np.ndarray | None = None) -> list[tuple[np.ndarray, np.ndarray]]:
+        """複数クエリの検索（全チャンク、または rows のチャンクとのスコアを1回の行列積で計算）"""
+        scores = inner_product(self.embeddings if rows is None else self.embeddings[rows], queries).T
+        if k is None:
+            ids = np.arange(scores.shape[1]) if rows is None else rows
+            return [(ids, row) for row in scores]
+        results = []
+        for row in scores:
+            top = top_k_indices(row, k)
+            results.append((top if rows is None else rows[top], row[top]))
+        return results
+
+
+class IVFIndex:
+    """k-meansでチャンクをクラスタに分割し、近いクラスタだけを探索する近似最近傍検索
+
+    nprobe（探索するクラスタ数）を増やすほど再現率が上がり、検索は遅くなる。
+    """
+    def __init__(self, nlist: int | None = None, nprobe: int = 8, n_iter: int = 10,
+                 train_size_per_list: int = 64, seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.train_size_per_list = train_size_per_list
+        self.seed = seed
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+        self.centroids = np.empty((0, 0), dtype=np.float32)
+        self.lists = []
+
+    def build(self, embeddings: np.ndarray):
+        """クラスタ中心を学習し、全チャンクを転置リストに割り当てる"""
+        self.embeddings = embeddings
+        n = len(embeddings)
+        nlist = min(self.nlist or max(1, int(np.sqrt(n))), max(n, 1))
+        rng = np.random.default_rng(self.seed)
+
+        # 学習はクラスタあたり一定数のサンプルで行い、大規模コーパスでも構築時間を抑える
+        sample_size = min(n, nlist * self.train_size_per_list)
+        sample = np.asarray(embeddings[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assignments = self._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=nlist)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        self.centroids = centroids
+
+        assignments = self._assign_batched(embeddings)
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(nlist + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+
+    def add(self, embeddings: np.ndarray):
+        """チャンク追加後の埋め込み行列全体を受け取り、新しい行を最も近いクラスタに追加"""
+        start = sum(len(ids) for ids in self.lists)
+        self.embeddings = embeddings
+        if not self.lists:
+            self.build(embeddings)
+            return
+        assignments = self._assign_batched(embeddings[start:])
+        for cluster in np.unique(assignments):
+            new_ids = np.flatnonzero(assignments == cluster) + start
+            self.lists[cluster] = np.concatenate([self.lists[cluster], new_ids])
+
+    def copy(self) -> 'IVFIndex':
+        """元の索引での検索に影響を与えずに更新できる複製（転置リストの配列は共有する）"""
+        clone = copy.copy(self)
+        clone.lists = list(self.lists)
+        return clone
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """各ベクトルを最も近い（ユークリッド距離）クラスタ中心に割り当てる"""
+        # ||x - c||^2 の最小化は 2 x・c - ||c||^2 の最大化と等価
+        scores = 2 * (vectors @ centroids.T) - np.einsum('ij,ij->i', centroids, centroids)
+        return np.argmax(scores, axis=1)
+
+    def _assign_batched(self, embeddings: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+        """メモリ使用量を抑えるため、一定件数ずつクラスタに割り当てる"""
+        return np.concatenate([
+            self._assign(np.asarray(embeddings[i:i + batch_size], dtype=np.float32), self.centroids)
+            for i in range(0, len(embeddings), batch_size)
+        ] or [np.empty(0, dtype=np.int64)])
+
+    def search(self, query: np.ndarray, k: int | None = None, rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """近いnprobe個のクラスタに属するチャンクのみをスコアリングする
+
+        kを省略すると探索したすべての候補を返す。rows（昇順のチャンク番号）を指定すると候補をそのチャンクに限り、
+        探索するクラスタの合計より rows が少なければ rows をすべてスコアリングする（厳密検索と同じ結果）。
+        """
+        probe = top_k_indices(self.centroids @ np.asarray(query, dtype=np.float32), min(self.nprobe, len(self.lists)))
+        if rows is not None and len(rows) <= sum(len(self.lists[cluster]) for cluster in probe):
+            ids = rows
+        else:
+            ids = np.concatenate([self.lists[cluster] for cluster in probe])
+            if rows is not None:
+                ids = ids[np.isin(ids, rows)]
+        scores = inner_product(self.embeddings[ids], query)
+        if k is None:
+            return ids, scores
+        top = top_k_indices(scores, k)
+        return ids[top], scores[top]
+
+    def search_batch(self, queries: np.ndarray, k: int | None = None,
+                     rows: np.ndarray | None = None) -> list[tuple[np.ndarray, np.ndarray]]:
+        """複数クエリの検索（探索するクラスタがクエリごとに異なるため1件ずつ検索）"""
+        return [self.search(query, k, rows) for query in queries]
+
+
+VECTOR_INDEXES = {
+    'flat': FlatIndex,
+    'ivf': IVFIndex,
+}
+
+
+def create_vector_index(name: str = 'flat', **options) -> FlatIndex | IVFIndex:
+    """名前からベクトル索引を作成"""
+    if name not in VECTOR_INDEXES:
+        raise ValueError(f"Unknown vector index: {name} (choose from {', '.join(VECTOR_INDEXES)})")
+    return VECTOR_INDEXES[name](**options)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+
+class ServerBusyError(RuntimeError):
+    """実行中・待機中のタスク数が上限に達している"""
+
+
+class BoundedExecutor:
+    """同時実行数と待ち行列の長さに上限を設けたスレッドプール
+
+    CPU負荷の高い同期処理（埋め込み・形態素解析・索引更新）をイベントループの外で実行する。
+    実行中と待機中を合わせて max_workers + max_queue 件を超えるタスクは
+    受け付けずに ServerBusyError を送出する（APIでは503を返す）。
+    """
+    def __init__(self, max_workers: int, max_queue: int, name: str = 'worker'):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.capacity = max_workers + max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """実行中・待機中のタスク数"""
+        return self._pending
+
+    @property
+    def is_full(self) -> bool:
+        return self._pending >= self.capacity
+
+    def _acquire(self):
+        with self._lock:
+            if self._pending >= self.capacity:
+                raise ServerBusyError(f"Too many pending tasks ({self._pending}/{self.capacity})")
+            self._pending += 1
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        """同期関数をプールに投入する（上限に達している場合はServerBusyError）"""
+        self._acquire()
+        try:
+            future = self._executor.submit(partial(func, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+        # 呼び出し元がキャンセルされても、スレッドでの処理が終わるまで枠を解放しない
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    async def run(self, func, *args, **kwargs):
+        """同期関数をプールで実行して結果を待つ（asyncio.to_threadと同じ呼び出し方）"""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class JobRegistry:
+    """バックグラウンドで実行するジョブ（索引の更新など）の状態を管理する
+
+    状態は queued → running → succeeded / failed と遷移し、成功したジョブは関数の戻り値を result に持つ。
+    古いジョブは max_jobs 件を超えた分から忘れる。
+    directory を指定すると状態をファイルにも書き出し、別のワーカープロセスで実行中のジョブも参照できる。
+    """
+    def __init__(self, max_jobs: int = 1000, directory: str | None = None):
+        self.max_jobs = max_jobs
+        self.directory = directory
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _file(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, job: dict):
+        """ジョブの状態をファイルに書き出す（置き換えは原子的に行う）"""
+        if not self.directory:
+            return
+        tmp = self._file(job['id']) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp, self._file(job['id']))
+
+    def submit(self, executor: BoundedExecutor, func, *args, description: str = '', **kwargs) -> str:
+        """ジョブを投入してIDを返す（executorが満杯の場合はServerBusyError）"""
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'description': description,
+            'status': 'queued',
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+            'result': None,
+        }
+
+        def run():
+            self._update(job_id, status='running', started_at=time.time())
+            return func(*args, **kwargs)
+
+        with self._lock:
+            self._jobs[job_id] = job
+            self._save(job)
+            while len(self._jobs) > self.max_jobs:
+                old_id, _ = self._jobs.popitem(last=False)
+                if self.directory and os.path.exists(self._file(old_id)):
+                    os.remove(self._file(old_id))
+        try:
+            future = executor.submit(run)
+        except ServerBusyError:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+                if self.directory and os.path.exists(self._file(job_id)):
+                    os.remove(self._file(job_id))
+            raise
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+                self._save(self._jobs[job_id])
+
+    def _finish(self, job_id: str, future: Future):
+        error = future.exception() if not future.cancelled() else RuntimeError("cancelled")
+        self._update(
+            job_id,
+            status='failed' if error else 'succeeded',
+            finished_at=time.time(),
+            error=str(error) if error else None,
+            result=None if error else future.result(),
+        )
+
+    def get(self, job_id: str) -> dict | None:
+        """ジョブの状態（存在しない場合はNone）"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return dict(job)
+        if not self.directory or not job_id.isalnum():
+            return None
+        try:
+            with open(self._file(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None